@@ -0,0 +1,302 @@
+# !/usr/bin/env python
+"""In this script, benchmark_doa will time the sound source localization
+pipeline on simulated rooms for every combination of the chosen settings and
+write one machine-readable record per run, so results can be compared from
+one run to the next.
+
+Example:
+    python benchmarks/benchmark_doa.py --algorithms SRP TOPS MUSIC \
+        --mics 4 6 --output bench_output.jsonl
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+
+import numpy as np
+
+from scipy.io import wavfile
+
+
+# SRP-PHAT is the near-field room search, the others are pyroomacoustics DOA
+ALGORITHMS = ['SRP', 'TOPS', 'MUSIC', 'CSSM', 'WAVES', 'SRP-PHAT']
+
+# kd_tree picks the densest candidate point, closest_approach solves for the
+# point closest to the ray segments, see SoundSourceLocation.locate_source
+LOCATORS = ['kd_tree', 'closest_approach']
+
+ROOM_DIMENSIONS = [50 / 100, 50 / 100, 50 / 100]
+MICROPHONE_CENTER = [25 / 100, 25 / 100, 3 / 100]
+SOURCE_LOCATION = [20 / 100, 30 / 100, 25 / 100]
+
+
+def peak_rss_megabytes():
+    """Returns the peak resident set size of this process and its finished
+       children, in megabytes. Note: Linux reports kilobytes, macOS bytes."""
+    scale = 1024 ** 2 if sys.platform == 'darwin' else 1024
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / scale
+
+
+def write_signal(directory, duration, sampling_rate, wav=None):
+    """Writes the source signal to a wav file and returns its path. Uses the
+       start of the given wav file, otherwise white noise."""
+
+    if wav is not None:
+        sampling_rate, signal = wavfile.read(wav)
+        signal = signal[:int(duration * sampling_rate)]
+    else:
+        rng = np.random.default_rng(0)
+        signal = rng.standard_normal(int(duration * sampling_rate)).astype(np.float32)
+
+    filename = os.path.join(directory, 'source.wav')
+    wavfile.write(filename, sampling_rate, signal)
+    return filename
+
+
+def doa_error(rays, mic_locations):
+    """Returns the median angle, in degrees, between the direction of each
+       ray and the true direction of the source from the center of the
+       microphone array. This measures the DOA algorithm on its own, while
+       the location error also depends on how the rays are clustered.
+
+       Args:
+           rays: (tuple) origin and direction of each ray, in room
+                 coordinates, see SoundSourceLocation.rays
+           mic_locations: (list) microphone locations relative to the center
+                          of the room
+
+       Returns:
+           (float) the median angle, or None without rays
+    """
+
+    if rays is None or len(rays[1]) == 0:
+        return None
+
+    array_center = np.mean(mic_locations, axis=0) + np.array(ROOM_DIMENSIONS) / 2
+    true_direction = np.array(SOURCE_LOCATION) - array_center
+    true_direction /= np.linalg.norm(true_direction)
+
+    cosines = np.clip(rays[1] @ true_direction, -1.0, 1.0)
+    return float(np.degrees(np.median(np.arccos(cosines))))
+
+
+def run_single(config):
+    """Runs the simulate, load, estimate and locate stages for one setting
+       and returns its record.
+
+       Args:
+           config: (dictionary) algorithm, number of microphones, microphone
+                   combinations number, FFT size, grid size, signal duration
+                   (seconds), speed of sound, wav file and locator
+
+       Returns:
+           (dictionary) the setting, the time of each stage (seconds), the
+           hits and misses of the DOA cache, the peak memory (megabytes),
+           the DOA error (degrees) and the location error (meters), see
+           doa_error
+    """
+
+    from scripts.profiling import Profiler
+
+    with Profiler() as profiler:
+        record = _run_stages(config)
+
+    # Time of the stages inside the pipeline, e.g. stft, doa and ipc, and the
+    # hits and misses of the DOA cache in every worker
+    summary = profiler.summary()
+    record['spans'] = {stage: values['total'] for stage, values in summary['stages'].items()}
+    record['caches'] = summary['caches']
+    return record
+
+
+def _run_stages(config):
+    from scripts.experiment import ExperimentalMicData
+    from scripts.sound_source_localization import SoundSourceLocation
+    from scripts.srp_phat import SRPPHATSoundSourceLocation
+    from scripts.determine_source import DetermineSourceLocation
+
+    stages = {}
+    start = time.perf_counter()
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = write_signal(directory, config['duration'], 16000, config.get('wav'))
+
+        stage_start = time.perf_counter()
+        experiment = ExperimentalMicData(filename,
+                                         number_of_mics=config['mics'],
+                                         custom_mic_setup='circular',
+                                         room_dim=ROOM_DIMENSIONS,
+                                         source_dim=SOURCE_LOCATION,
+                                         mic_location=MICROPHONE_CENTER,
+                                         phi=0.0,
+                                         r=0.1,
+                                         sound_speed=config['sound_speed'])
+        *_, converted_mic_locations, sample_rate = experiment.run(save=False)
+        stages['simulate'] = time.perf_counter() - stage_start
+
+        # The simulated signals are handed over in memory, without a mat file
+        stage_start = time.perf_counter()
+        sound_data = experiment.get_sound_data()
+        stages['load'] = time.perf_counter() - stage_start
+
+    settings = dict(number_of_mic_splits=1,
+                    sampling_rate=sample_rate,
+                    x_dim_max=ROOM_DIMENSIONS[0],
+                    y_dim_max=ROOM_DIMENSIONS[1],
+                    z_dim_max=ROOM_DIMENSIONS[2],
+                    grid_search=config.get('grid_search', 'flat'))
+    if config['algorithm'] == 'SRP-PHAT':
+        estimator = SRPPHATSoundSourceLocation(**settings)
+    else:
+        estimator = SoundSourceLocation(config['algorithm'], **settings)
+    estimator.mic_combinations_number = config['combinations']
+    estimator.fft_size = config['fft_size']
+    estimator.n_grid = config['n_grid']
+    estimator.sound_speed = config['sound_speed']
+
+    segments = config.get('locator', 'kd_tree') == 'closest_approach'
+
+    stage_start = time.perf_counter()
+    estimates = next(estimator.run_estimates(sound_data, segments=segments))
+    stages['estimate'] = time.perf_counter() - stage_start
+
+    stage_start = time.perf_counter()
+    if segments:
+        locations = (estimator.locate_source(estimates)[np.newaxis, :] if len(estimates)
+                     else np.empty((0, 3)))
+    else:
+        locator = DetermineSourceLocation(config['algorithm'], 'benchmark', estimates,
+                                          *converted_mic_locations,
+                                          room_dim=ROOM_DIMENSIONS,
+                                          rays=estimator.rays,
+                                          parameters=estimator.get_parameters())
+        locations = locator.use_kd_tree()
+    stages['locate'] = time.perf_counter() - stage_start
+
+    # Distance of the densest location from the source. It includes the
+    # clustering of the rays, so doa_error is the measure of the algorithm
+    location_error = (float(np.linalg.norm(locations[0] - np.array(SOURCE_LOCATION)))
+                      if len(locations) else None)
+
+    return dict(config,
+                wall_time=time.perf_counter() - start,
+                stages=stages,
+                candidates=int(len(estimates)),
+                peak_rss_mb=peak_rss_megabytes(),
+                doa_error=doa_error(estimator.rays, converted_mic_locations),
+                location_error=location_error)
+
+
+def sweep(args):
+    """Yields the configuration of every combination of the settings."""
+    for algorithm, mics, combinations, fft_size, n_grid, grid_search, duration, locator in \
+            itertools.product(args.algorithms, args.mics, args.combinations, args.fft_sizes,
+                              args.n_grids, args.grid_searches, args.durations, args.locators):
+        if combinations > mics:
+            continue
+        # SRP-PHAT searches the room grid, it has no rays
+        if algorithm == 'SRP-PHAT' and locator == 'closest_approach':
+            continue
+        yield {'algorithm': algorithm, 'mics': mics, 'combinations': combinations,
+               'fft_size': fft_size, 'n_grid': n_grid, 'grid_search': grid_search,
+               'duration': duration, 'locator': locator,
+               'sound_speed': args.sound_speed, 'wav': args.wav}
+
+
+def run_isolated(config):
+    """Runs one setting in a fresh interpreter so its peak memory is not
+       mixed with the settings before it."""
+
+    completed = subprocess.run([sys.executable, os.path.abspath(__file__),
+                                '--single', json.dumps(config)],
+                               capture_output=True, text=True, check=False)
+    if completed.returncode != 0:
+        return dict(config, doa_error=None, location_error=None, failed=completed.stderr.strip().splitlines()[-1:])
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def write_csv(records, filename):
+    """Writes the records to a csv file with one column per stage."""
+
+    stage_names = sorted({name for record in records for name in record.get('stages', {})})
+    columns = ['algorithm', 'mics', 'combinations', 'fft_size', 'n_grid', 'grid_search',
+               'duration', 'locator', 'wall_time', 'candidates', 'peak_rss_mb', 'doa_error', 'location_error'] + stage_names
+
+    with open(filename, mode='w', newline='') as benchmark_file:
+        writer = csv.writer(benchmark_file, delimiter=',')
+        writer.writerow(columns)
+        for record in records:
+            stages = record.get('stages', {})
+            writer.writerow([stages.get(column, record.get(column)) for column in columns])
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--algorithms', nargs='+', default=ALGORITHMS, choices=ALGORITHMS)
+    parser.add_argument('--mics', nargs='+', type=int, default=[4, 6, 8])
+    parser.add_argument('--combinations', nargs='+', type=int, default=[3])
+    parser.add_argument('--fft-sizes', nargs='+', type=int, default=[256])
+    parser.add_argument('--n-grids', nargs='+', type=int, default=[1000])
+    parser.add_argument('--grid-searches', nargs='+', default=['flat'],
+                        choices=['flat', 'hierarchical'])
+    parser.add_argument('--locators', nargs='+', default=['kd_tree'], choices=LOCATORS,
+                        help='how the source is picked from the rays')
+    parser.add_argument('--durations', nargs='+', type=float, default=[1.0],
+                        help='signal length in seconds')
+    parser.add_argument('--sound-speed', type=float, default=343.0,
+                        help='speed of sound of the simulated room and the estimator')
+    parser.add_argument('--wav', default=None,
+                        help='source signal, e.g. a CMU ARCTIC file. Default: white noise')
+    parser.add_argument('--output', default='bench_output.jsonl',
+                        help='json lines file the records are appended to')
+    parser.add_argument('--csv', default=None, help='also write the records to a csv file')
+    parser.add_argument('--no-isolate', action='store_true',
+                        help='run every setting in this process')
+    parser.add_argument('--single', default=None, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    warnings.simplefilter('ignore')
+
+    if args.single is not None:
+        print(json.dumps(run_single(json.loads(args.single))))
+        return
+
+    run_information = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'python': platform.python_version(),
+                       'numpy': np.__version__,
+                       'machine': platform.machine(),
+                       'cpus': os.cpu_count()}
+
+    records = []
+    with open(args.output, mode='a') as output_file:
+        for config in sweep(args):
+            record = run_single(config) if args.no_isolate else run_isolated(config)
+            record['run'] = run_information
+            records.append(record)
+
+            output_file.write(json.dumps(record) + '\n')
+            output_file.flush()
+            print(f"{record['algorithm']} mics={record['mics']} locator={record['locator']} "
+                  f"wall_time={record.get('wall_time', float('nan')):.2f}s "
+                  f"doa_error={record.get('doa_error')} "
+                  f"location_error={record.get('location_error')}")
+
+    if args.csv:
+        write_csv(records, args.csv)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+# !/usr/bin/env python
+"""In this script, batch will localize the sound source of every recording in
+a corpus. Each recording is one job, jobs run in parallel with a bounded
+number of workers, and the source locations are streamed into a single csv
+file as each job finishes. A checkpoint file records every finished job, so
+a crashed run picks up where it stopped when it is started again.
+
+Example:
+    python batch.py --glob '/data/CMU_ARCTIC/cmu_us_bdl_arctic/wav/*.wav' \
+        --output results.csv --jobs 4
+"""
+
+import argparse
+import csv
+import glob
+import hashlib
+import json
+import os
+import sys
+import time
+
+from functools import partial
+
+from scripts.experiment import ExperimentalMicData
+from scripts.preprocess import PrepareData
+from scripts.sound_source_localization import SoundSourceLocation
+from scripts.determine_source import DetermineSourceLocation
+from scripts.utils import RIRCache, get_worker_pool, run_in_workers
+
+
+OUTPUT_COLUMNS = ['file', 'method', 'source', 'width', 'depth', 'length',
+                  'density', 'seconds']
+OUTPUT_HEADER = "".join([",".join(OUTPUT_COLUMNS), '\r\n'])
+
+# Simulated set up of the benchmarks, used for every .wav recording
+DEFAULT_SETTINGS = {'room_dim': [50 / 100, 50 / 100, 50 / 100],
+                    'source_dim': [20 / 100, 30 / 100, 25 / 100],
+                    'mic_location': [25 / 100, 25 / 100, 3 / 100],
+                    'number_of_mics': 4,
+                    'custom_mic_setup': 'circular',
+                    'phi': 0.0,
+                    'r': 0.1,
+                    'mic_locations': None,
+                    'sampling_rate': 16000}
+
+
+def read_manifest(manifest):
+    """Returns the recordings listed in a manifest file, one path per line.
+       Blank lines and lines starting with # are skipped, and relative paths
+       are relative to the manifest.
+
+       Args:
+           manifest: (string) path of the manifest file
+
+       Returns:
+           (list) path of each recording
+    """
+
+    head = os.path.dirname(os.path.abspath(manifest))
+
+    with open(manifest) as manifest_file:
+        lines = [line.strip() for line in manifest_file]
+
+    return [os.path.join(head, line) for line in lines
+            if line and not line.startswith('#')]
+
+
+def find_recordings(manifest=None, pattern=None):
+    """Returns the recordings of a manifest file or matching a glob pattern,
+       without duplicates and in a stable order.
+
+       Raises:
+           ValueError: if neither or both are given
+    """
+
+    if (manifest is None) == (pattern is None):
+        raise ValueError("Error. Give either a manifest or a glob pattern.")
+
+    if manifest is not None:
+        return list(dict.fromkeys(read_manifest(manifest)))
+    return sorted(glob.glob(pattern, recursive=True))
+
+
+def localize_file(sample_filepath, method_name='SRP', settings=None, work_dir=None,
+                  rir_cache=None):
+    """Runs the pipeline of main.py on one recording. A .wav file is first
+       simulated in the room of the settings, a .mat file is read as it is
+       with the microphone locations of the settings. In a worker of
+       BatchRunner, the microphone combinations run on the worker's own
+       EstimatorPool.
+
+       Args:
+           sample_filepath: (string) path of the recording
+           method_name: (string) direction of arrival algorithm
+           settings: (dictionary) room, source and microphone set up, see
+                     DEFAULT_SETTINGS
+           work_dir: (string) directory the simulated .mat files are saved
+                     in. Default: None, the simulated signals are only kept
+                     in memory
+           rir_cache: (string) directory of the room impulse response
+                      cache, shared by every recording simulated in the
+                      same room. Default: None, no cache
+
+       Returns:
+           (list) one output row per source location found
+    """
+
+    start = time.perf_counter()
+
+    settings = dict(DEFAULT_SETTINGS, **(settings or {}))
+    room_dimensions = settings['room_dim']
+    _, tail = os.path.split(sample_filepath)
+
+    if sample_filepath.endswith('.wav'):
+        experiment = ExperimentalMicData(sample_filepath,
+                                         rir_cache=None if rir_cache is None else RIRCache(rir_cache),
+                                         **{key: value for key, value in settings.items()
+                                            if key not in ('mic_locations', 'sampling_rate')})
+
+        # Every job saves its own file, so parallel jobs do not overwrite each other
+        if work_dir is not None:
+            path_hash = hashlib.sha1(sample_filepath.encode()).hexdigest()[:8]
+            experiment.name_to_save_file = os.path.join(
+                work_dir, "".join([os.path.splitext(tail)[0], '_', path_hash, '.mat']))
+
+        *_, mic_locations, sampling_rate = experiment.run(save=work_dir is not None)
+        sound_data = experiment.get_sound_data()
+    else:
+        if settings['mic_locations'] is None:
+            raise ValueError("Error. Microphone locations are required for .mat recordings.")
+        mic_locations, sampling_rate = settings['mic_locations'], settings['sampling_rate']
+        sound_data = next(PrepareData(sample_filepath, *mic_locations).load_file())
+
+    estimator = SoundSourceLocation(method_name,
+                                    number_of_mic_splits=3,
+                                    sampling_rate=sampling_rate,
+                                    s1_bool=None,
+                                    x_dim_max=room_dimensions[0],
+                                    y_dim_max=room_dimensions[1],
+                                    z_dim_max=room_dimensions[2],
+                                    pool=get_worker_pool())
+    source_estimates = next(estimator.run_estimates(sound_data))
+    source = DetermineSourceLocation(method_name, tail, source_estimates,
+                                     *mic_locations, room_dim=room_dimensions,
+                                     rays=estimator.rays,
+                                     parameters=estimator.get_parameters())
+    locations = source.use_kd_tree()
+
+    seconds = time.perf_counter() - start
+    return [[sample_filepath, method_name, i, *location.tolist(), int(density), seconds]
+            for i, (location, density) in enumerate(zip(locations, source.source_densities))]
+
+
+class BatchRunner:
+    """BatchRunner runs one job per recording on a pool of worker processes
+       and streams each job's rows into a single csv file. Only a few jobs
+       beyond the number of workers are queued at a time, so a corpus is
+       never held in memory at once.
+
+       After the rows of a job are written, the job and the size of the csv
+       file are appended to the checkpoint file. On start, jobs already in
+       the checkpoint are skipped and the csv file is cut back to the last
+       recorded size, dropping rows of a job that was interrupted. A csv
+       file with rows but no checkpoint entry is never cut.
+
+       The CPUs are split between the jobs: each worker runs the microphone
+       combinations of its job on its own EstimatorPool, see
+       get_worker_processes.
+
+       Attributes:
+           recordings: (list) path of each recording
+           output: (string) path of the csv file
+           job: function of one recording path returning its output rows.
+                Default: localize_file
+           jobs: (integer) largest number of jobs run at once. Default is
+                 the number of CPUs
+           checkpoint: (string) path of the checkpoint file. Default is the
+                       output path followed by .checkpoint
+           failures: (dictionary) error message of each failed recording
+    """
+
+    def __init__(self, recordings, output, job=localize_file, jobs=None, checkpoint=None):
+        """Initializes BatchRunner with recordings, output, job, jobs, and
+           checkpoint."""
+
+        self.recordings = list(recordings)
+        self.output = output
+        self.job = job
+        self.jobs = jobs or os.cpu_count()
+        self.checkpoint = checkpoint or ".".join([output, 'checkpoint'])
+
+        if self.jobs < 1:
+            raise ValueError("Error. Number of jobs must be at least 1.")
+
+        self.failures = {}
+
+    def resume(self):
+        """Returns the recordings finished by an earlier run, and cuts the
+           csv file back to the size recorded with the last of them.
+
+           Raises:
+               FileExistsError: if the csv file has rows but no checkpoint
+                                entry to resume from
+        """
+
+        finished, size, entries = set(), None, []
+
+        if os.path.exists(self.checkpoint):
+            with open(self.checkpoint) as checkpoint_file:
+                for line in checkpoint_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Half written line of a crash
+                        break
+                    entries.append(line if line.endswith('\n') else line + '\n')
+                    finished.add(entry['file'])
+                    size = entry['size']
+
+            with open(self.checkpoint, 'w') as checkpoint_file:
+                checkpoint_file.writelines(entries)
+
+        if os.path.exists(self.output):
+            if size is None:
+                # Only a header written by a run that finished no job is dropped
+                with open(self.output, newline='') as output_file:
+                    if output_file.read(len(OUTPUT_HEADER) + 1) not in ('', OUTPUT_HEADER):
+                        raise FileExistsError("Error. {} has rows but no checkpoint to resume "
+                                              "from. Move or remove it first.".format(self.output))
+                size = 0
+
+            with open(self.output, 'r+') as output_file:
+                output_file.truncate(size)
+
+        return finished
+
+    def run(self):
+        """Runs every recording not finished yet.
+
+           Returns:
+               (integer) number of recordings finished by this run
+        """
+
+        finished = self.resume()
+        pending = [path for path in self.recordings if path not in finished]
+        completed = 0
+
+        with open(self.output, 'a', newline='') as output_file, \
+                open(self.checkpoint, 'a') as checkpoint_file:
+
+            writer = csv.writer(output_file)
+            if output_file.tell() == 0:
+                writer.writerow(OUTPUT_COLUMNS)
+
+            for index, future in run_in_workers(self.job, pending, self.jobs):
+                path = pending[index]
+
+                try:
+                    rows = future.result()
+                except Exception as error:
+                    # Left out of the checkpoint, so it is retried on resume
+                    self.failures[path] = repr(error)
+                    print("Failed: {}: {!r}".format(path, error), file=sys.stderr)
+                    continue
+
+                writer.writerows(rows)
+                output_file.flush()
+                os.fsync(output_file.fileno())
+
+                checkpoint_file.write(json.dumps({'file': path,
+                                                  'size': output_file.tell()}) + '\n')
+                checkpoint_file.flush()
+                os.fsync(checkpoint_file.fileno())
+                completed += 1
+
+        return completed
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    recordings = parser.add_mutually_exclusive_group(required=True)
+    recordings.add_argument('--manifest', help='file listing one recording per line')
+    recordings.add_argument('--glob', dest='pattern', help='glob pattern of the recordings')
+    parser.add_argument('--output', default='results.csv')
+    parser.add_argument('--checkpoint', default=None,
+                        help='checkpoint file. Default: <output>.checkpoint')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='largest number of recordings run at once')
+    parser.add_argument('--method', default='SRP')
+    parser.add_argument('--work-dir', default=None,
+                        help='also save the simulated .mat files in this directory')
+    parser.add_argument('--rir-cache', default=None,
+                        help='directory of the room impulse response cache')
+    parser.add_argument('--mic-locations', default=None,
+                        help='json file of the microphone locations of .mat recordings')
+    parser.add_argument('--sampling-rate', type=int, default=16000,
+                        help='sampling frequency of .mat recordings')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    settings = {'sampling_rate': args.sampling_rate}
+    if args.mic_locations is not None:
+        with open(args.mic_locations) as mic_file:
+            settings['mic_locations'] = json.load(mic_file)
+
+    if args.work_dir is not None:
+        os.makedirs(args.work_dir, exist_ok=True)
+
+    runner = BatchRunner(find_recordings(args.manifest, args.pattern), args.output,
+                         job=partial(localize_file, method_name=args.method,
+                                     settings=settings, work_dir=args.work_dir,
+                                     rir_cache=args.rir_cache),
+                         jobs=args.jobs, checkpoint=args.checkpoint)
+    completed = runner.run()
+
+    print("Finished {} recordings, {} failed. Results: {}".format(
+        completed, len(runner.failures), args.output))
+    return 1 if runner.failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,13 +2,29 @@
 """This script will find the most likely location of the sound source."""
 
 import csv
+import json
+import os
+import time
+import warnings
 import numpy as np
+
+from functools import partial
 import matplotlib.pyplot as plt
 
 from scipy import spatial
 from mpl_toolkits.mplot3d import Axes3D
 
-from scripts.sound_source_localization import SoundSourceLocation
+from scripts.profiling import get_profiler
+from scripts.sound_source_localization import SoundSourceLocation, ESTIMATOR_PARAMETERS
+from scripts.utils import CandidateStore, save_npz, get_worker_pool, run_in_workers
+from scripts.validations import validate_output_format
+
+
+OUTPUT_COLUMNS = ['Width', 'Depth', 'Length']
+
+# Attributes of the locator saved with the source locations of a .npz output
+# file, along with the parameters of the estimator
+OUTPUT_PARAMETERS = ('algo_name', 'cluster_radius', 'number_of_modes')
 
 
 # TODO:
@@ -22,12 +38,56 @@ class DetermineSourceLocation(SoundSourceLocation):
        Attributes:
            source_name: (string) file name
            all_source_estimates: (numpy array) array of all the potential
-                                  source locations
+                                  source locations, or a CandidateStore
+                                  holding them on disk. The estimates
+                                  inside the room are copied into the
+                                  KD-tree, so they must fit in memory
            _microphone_locations: (list) microphone locations
            default: (boolean)
            room_dim: (list) room dimensions
            center_of_room: (numpy array) center of room
            filename: (string) file name to save output file and picture as
+           cluster_radius: (float) radius (in meters) of the ball used to
+                           count neighbouring points. Default: 0.01
+           number_of_modes: (integer) number of densest locations to return,
+                            e.g. 2 for S1 and S2. Default is num_sources
+           density_samples: (integer) largest number of points at which the
+                            density is measured. Larger clouds use a random
+                            subset, still counted against every point.
+                            Default: 100000
+           source_locations: (numpy array) densest locations found by
+                             use_kd_tree, densest first
+           source_densities: (numpy array) number of points around each
+                             source location, or of rays when rays are given
+           rays: (tuple) origin and direction of each ray the estimates were
+                 expanded from, in the same coordinates, e.g.
+                 SoundSourceLocation.rays. Rays overlap near where they
+                 start, so a location is ranked by the number of distinct
+                 rays passing within the cluster radius of it, leaving out
+                 the start of each ray. Default: None, ranked by the number
+                 of points
+           ray_labels: (numpy array) source label of each ray, see
+                       SoundSourceLocation.ray_labels
+           labels: (numpy array) source label of each estimate, from
+                   SoundSourceLocation.process_labeled_estimates. Each label
+                   is clustered on its own. Default: None, unlabeled
+           source_confidences: (numpy array) confidence of each labeled
+                               source location, see find_labeled_locations
+           timings: (dictionary) seconds spent in each clustering step
+           output_format: (string) 'npz' saves the source locations as a
+                          binary .npz file with the microphone locations,
+                          room dimensions and parameters, see
+                          load_source_locations. 'csv' saves them as text.
+                          Default is 'npz'
+           output_dtype: (numpy dtype) float type of the saved locations.
+                         Default: float32
+           compress: (boolean) compresses the .npz file. Default: True
+           parameters: (dictionary) parameters of the estimator that found
+                       the estimates, see SoundSourceLocation.get_parameters.
+                       They are saved with the source locations, and
+                       num_sources, sound_speed and mic_combinations_number
+                       also name the output file. Default: None, no
+                       estimator parameters are saved
     """
 
     def __init__(self, algo_name, source_name, all_source_estimates, *args, **kwargs):
@@ -35,6 +95,14 @@ class DetermineSourceLocation(SoundSourceLocation):
            all_source_estimates, and args."""
 
         SoundSourceLocation.__init__(self, algo_name)
+
+        self.parameters = kwargs.get('parameters')
+        if self.parameters is not None:
+            self.parameters = dict(self.parameters)
+            for name in ESTIMATOR_PARAMETERS:
+                if name in self.parameters:
+                    setattr(self, name, self.parameters[name])
+
         self.source_name = source_name
         self.all_source_estimates = all_source_estimates
         self._microphone_locations = args
@@ -44,6 +112,32 @@ class DetermineSourceLocation(SoundSourceLocation):
 
         self.center_of_room = np.array(self.room_dim)/2
 
+        self.cluster_radius = kwargs.get('cluster_radius') or 0.01
+        self.number_of_modes = kwargs.get('number_of_modes') or self.num_sources
+        self.density_samples = kwargs.get('density_samples') or 100000
+
+        self.labels = kwargs.get('labels')
+        if self.labels is not None:
+            self.labels = np.asarray(self.labels)
+            if isinstance(all_source_estimates, CandidateStore) \
+                    or len(self.labels) != len(all_source_estimates):
+                raise ValueError("Error. Labels must match the estimates "
+                                 "one to one, in memory.")
+
+        self.rays = kwargs.get('rays')
+        self.ray_labels = kwargs.get('ray_labels')
+        if self.ray_labels is not None:
+            self.ray_labels = np.asarray(self.ray_labels)
+
+        self.source_locations = None
+        self.source_densities = None
+        self.source_confidences = None
+        self.timings = {}
+
+        self.output_format, self.output_dtype = validate_output_format(
+            kwargs.get('output_format') or 'npz', kwargs.get('output_dtype') or np.float32)
+        self.compress = kwargs.get('compress', True)
+
         self.filename = "_".join(['mic', str(self.mic_combinations_number),
                                   str(self.source_name),
                              "".join(['sound_source_localization_c',
@@ -56,14 +150,26 @@ class DetermineSourceLocation(SoundSourceLocation):
 
     def room_filter_out(self):
         """Filters out potential source locations outside of
-           the room dimensions."""
-
-        return self.all_source_estimates[(self.all_source_estimates[:, 0] >= 0)
-                                         & (self.all_source_estimates[:, 0] <= self.room_dim[0])
-                                         & (self.all_source_estimates[:, 1] >= 0)
-                                         & (self.all_source_estimates[:, 1] <= self.room_dim[1])
-                                         & (self.all_source_estimates[:, 2] >= 0)
-                                         & (self.all_source_estimates[:, 2] <= self.room_dim[2])]
+           the room dimensions. Estimates in a CandidateStore are filtered
+           a chunk at a time into a memory-mapped file next to the store.
+           The KD-tree of find_modes copies the points it is built on, so
+           only the estimates outside the room are never held in memory."""
+
+        with get_profiler().span('filtering'):
+            if isinstance(self.all_source_estimates, CandidateStore):
+                return self.all_source_estimates.filter(
+                    self.inside_room,
+                    os.path.join(self.all_source_estimates.directory, 'inside_room.npy'))
+            return self.all_source_estimates[self.inside_room(self.all_source_estimates)]
+
+    def inside_room(self, points):
+        """Returns a boolean mask of the points inside the room dimensions."""
+        return ((points[:, 0] >= 0)
+                & (points[:, 0] <= self.room_dim[0])
+                & (points[:, 1] >= 0)
+                & (points[:, 1] <= self.room_dim[1])
+                & (points[:, 2] >= 0)
+                & (points[:, 2] <= self.room_dim[2]))
 
     # DEBUG Purposes:
     def plot_everything(self):
@@ -112,21 +218,191 @@ class DetermineSourceLocation(SoundSourceLocation):
         plt.show()
 
         if write_to_file:
-            self.write_to_csv(new_pts)
+            self.write_output(new_pts)
 
     def use_kd_tree(self):
-        """Optional: Use the KD Tree Structure to find S1 and S2 sources.
+        """Use the KD Tree Structure to find S1 and S2 sources. See
+           find_densest_locations, or find_labeled_locations when the
+           estimates are labeled by source.
+
+           Returns:
+               (numpy array) the densest source locations, densest first
+        """
+
+        with get_profiler().span('clustering'):
+            if self.labels is not None:
+                return self.find_labeled_locations()
+            return self.find_densest_locations()
+
+    def find_densest_locations(self):
+        """Uses the KD Tree Structure to find S1 and S2 sources. The density
+           of a point is the number of points within the cluster radius.
+           The densest point is picked, refined to the mean of its
+           neighbours, and everything near it is suppressed before picking
+           the next one.
 
            Runtime Complexity:
                Best Case: O(log(n))
                Worst Case: O(n)
+
+           Returns:
+               (numpy array) the densest source locations, densest first
         """
 
+        self.timings = {}
+        start = time.perf_counter()
+        points = self.room_filter_out()
+        self.add_timing('filter', start)
+
+        self.source_locations, self.source_densities = self.find_modes(points,
+                                                                       self.number_of_modes,
+                                                                       self.rays)
+        return self.source_locations
+
+    def find_labeled_locations(self):
+        """Finds one location per source label, clustering the estimates of
+           each label on their own. The confidence of a source is the share
+           of the label's rays passing within the cluster radius of its
+           location, or of the label's points when the rays are not
+           labeled. It goes from 0 when the label's estimates scatter over
+           the room to 1 when all of them meet at the location.
+
+           Returns:
+               (numpy array) the location of each source, in label order.
+               A label without estimates inside the room is NaN
+        """
+
+        self.timings = {}
+        start = time.perf_counter()
+        with get_profiler().span('filtering'):
+            inside = self.inside_room(self.all_source_estimates)
+            points, labels = self.all_source_estimates[inside], self.labels[inside]
+        self.add_timing('filter', start)
+
+        number_of_labels = int(self.labels.max()) + 1 if len(self.labels) else 0
+        self.source_locations = np.full((number_of_labels, 3), np.nan)
+        self.source_densities = np.zeros(number_of_labels, dtype=int)
+        self.source_confidences = np.zeros(number_of_labels)
+
+        for label in range(number_of_labels):
+            rays = self.rays
+            if rays is not None and self.ray_labels is not None:
+                rays = tuple(values[self.ray_labels == label] for values in rays)
+
+            label_points = points[labels == label]
+            locations, densities = self.find_modes(label_points, 1, rays)
+            if len(locations) == 0:
+                continue
+
+            self.source_locations[label] = locations[0]
+            self.source_densities[label] = densities[0]
+
+            if rays is not None and self.ray_labels is not None:
+                share = self.count_rays(locations, *rays)[0] / max(len(rays[0]), 1)
+            else:
+                distances = np.linalg.norm(label_points - locations[0], axis=1)
+                share = np.count_nonzero(distances <= self.cluster_radius) / len(label_points)
+            self.source_confidences[label] = share
+
+        return self.source_locations
+
+    def find_modes(self, points, number_of_modes, rays=None):
+        """Returns the densest locations of the points and their densities,
+           densest first. See find_densest_locations. With rays, the
+           locations crossed by the most rays come first, and the number of
+           points breaks ties.
+
+           Args:
+               points: (numpy array) potential source locations in the room
+               number_of_modes: (integer) number of locations to find
+               rays: (tuple) origin and direction of each ray. Default: None
+
+           Returns:
+               locations: (numpy array) the densest locations
+               densities: (numpy array) number of points, or of rays, around
+                          each location
+        """
+
+        if points.size == 0:
+            return np.empty((0, 3)), np.empty(0, dtype=int)
+
         # Put the whole list into a tree data data structure
-        tree = spatial.KDTree(self.room_filter_out())
+        start = time.perf_counter()
+        tree = spatial.cKDTree(points)
+        self.add_timing('build', start)
+
+        # Only measure the density at a subset of the points of large clouds
+        start = time.perf_counter()
+        if len(points) > self.density_samples:
+            seeds = np.random.default_rng(0).choice(len(points), self.density_samples,
+                                                    replace=False)
+        else:
+            seeds = np.arange(len(points))
+        density = tree.query_ball_point(points[seeds], self.cluster_radius,
+                                        return_length=True, workers=-1)
+        score = density
+        if rays is not None:
+            density = self.count_rays(points[seeds], *rays)
+            score = density * (len(points) + 1) + score
+        self.add_timing('density', start)
+
+        start = time.perf_counter()
+        available = np.ones(len(seeds), dtype=bool)
+        seed_tree = spatial.cKDTree(points[seeds])
+        locations, densities = [], []
+
+        for _ in range(number_of_modes):
+            if not available.any():
+                break
+
+            densest = np.flatnonzero(available)[np.argmax(score[available])]
+            neighbours = tree.query_ball_point(points[seeds[densest]], self.cluster_radius)
+
+            locations.append(points[neighbours].mean(axis=0))
+            densities.append(density[densest])
+
+            # Suppress the mode so the next one is a different source
+            available[seed_tree.query_ball_point(locations[-1],
+                                                 2 * self.cluster_radius)] = False
+
+        self.add_timing('modes', start)
+
+        return np.array(locations), np.array(densities)
+
+    def count_rays(self, points, origins, directions, chunk_size=2**20):
+        """Returns the number of rays passing within the cluster radius of
+           each point. A ray only counts from the cluster radius away from
+           its origin, so rays starting close together do not count as
+           meeting there.
+
+           Args:
+               points: (numpy array) locations to count the rays around
+               origins: (numpy array) start of each ray, shape (n_rays, 3)
+               directions: (numpy array) unit direction of each ray, shape
+                           (n_rays, 3)
+               chunk_size: (integer) largest number of point and ray pairs
+                           measured at once. Default: 2**20
+
+           Returns:
+               (numpy array) number of rays around each point
+        """
+
+        counts = np.zeros(len(points), dtype=int)
+        if len(origins) == 0:
+            return counts
 
-        # Debug:
-        return None
+        step = max(chunk_size // len(origins), 1)
+        for start in range(0, len(points), step):
+            offsets = points[start:start + step, np.newaxis, :] - origins[np.newaxis, :, :]
+            along = np.einsum('prk,rk->pr', offsets, directions)
+            across = np.einsum('prk,prk->pr', offsets, offsets) - along ** 2
+            counts[start:start + step] = ((along > self.cluster_radius)
+                                          & (across <= self.cluster_radius ** 2)).sum(axis=1)
+        return counts
+
+    def add_timing(self, step, start):
+        """Adds the seconds since start to the time spent in the step."""
+        self.timings[step] = self.timings.get(step, 0.0) + time.perf_counter() - start
 
     def _plot(self, source, s_source, save_plot=False, write_to_file=False):
         """Plots the microphones and sound source on a 3-d plot.
@@ -138,7 +414,7 @@ class DetermineSourceLocation(SoundSourceLocation):
                            microphone configurations and actual source
                            location. Default: False.
                write_to_file: (boolean) saves potential source locations
-                              to a csv file. Default: False.
+                              to a file, see write_output. Default: False.
         """
 
         # Are there are more than 1 sources?
@@ -184,33 +460,176 @@ class DetermineSourceLocation(SoundSourceLocation):
                 plt.close(fig)
 
             if write_to_file:
-                self.write_to_csv(source)
+                self.write_output(source)
 
         else:
             print(f"Nothing to convert. Points do not exist inside the "
                   f"boundaries of the environment for "
                   f"{str(self.source_name)}_{str(self.algo_name)}")
 
+    def write_output(self, source):
+        """Saves the potential source locations in the output format.
+
+           Args:
+               source: (numpy array) potential source locations
+
+           Returns:
+               (string) path of the saved file
+        """
+        if self.output_format == 'csv':
+            return self.write_to_csv(source)
+        return self.write_to_npz(source)
+
+    def write_to_npz(self, source):
+        """Write to a .npz file to save the data, along with the microphone
+           locations, room dimensions and parameters it was found with.
+
+           Args:
+               source: (numpy array) potential source locations
+
+           Returns:
+               (string) path of the saved file
+        """
+        filename = ".".join([self.filename, 'npz'])
+        parameters = dict(self.parameters or {})
+        parameters.update({name: getattr(self, name) for name in OUTPUT_PARAMETERS})
+
+        with get_profiler().span('output'):
+            save_npz(filename,
+                     {'locations': np.asarray(source, dtype=self.output_dtype),
+                      'columns': np.array(OUTPUT_COLUMNS),
+                      'mic_locations': np.array(self._set_microphone_locations(), dtype=float),
+                      'room_dim': np.array(self.room_dim, dtype=float),
+                      'source_name': np.array(str(self.source_name)),
+                      'parameters': np.array(json.dumps(parameters,
+                                                        default=lambda value: np.asarray(value).tolist()))},
+                     compress=self.compress)
+
+        return filename
+
     def write_to_csv(self, source):
         """Write to a csv file to save the data.
 
            Args:
                source: (numpy array) potential source locations
         """
-        with open(".".join([self.filename, 'csv']), mode='w') as sound_source_file:
+        with get_profiler().span('output'), \
+                open(".".join([self.filename, 'csv']), mode='w') as sound_source_file:
             writer = csv.writer(sound_source_file, delimiter=',')
 
             # First Row of Data, names of the columns
-            writer.writerow(['Width', 'Depth', 'Length'])
+            writer.writerow(OUTPUT_COLUMNS)
 
             # Write the rest of the results
             writer.writerows(source)
 
         print('Done')
+        return sound_source_file.name
 
     def sprint(self):
-        """Runs all the functions."""
+        """Runs all the functions.
+
+           Returns:
+               (numpy array) the densest source locations, densest first
+        """
         self.plot_everything()
-        # self.use_kd_tree()
+        return self.use_kd_tree()
+
+
+def load_source_locations(filename):
+    """Returns the source locations of a .npz output file, see
+       DetermineSourceLocation.write_to_npz, as saved, with no text to parse.
+
+       Args:
+           filename: (string) path of the .npz file
+
+       Returns:
+           (numpy array) source locations, one [width, depth, length] row
+           per location
+           (dictionary) columns, mic_locations, room_dim, source_name and
+           parameters it was saved with. The parameters of the estimator
+           are only there when they were given to DetermineSourceLocation
+    """
+
+    with np.load(filename) as output:
+        locations = output['locations']
+        metadata = {'columns': output['columns'].tolist(),
+                    'mic_locations': output['mic_locations'],
+                    'room_dim': output['room_dim'],
+                    'source_name': str(output['source_name']),
+                    'parameters': json.loads(str(output['parameters']))}
+
+    return locations, metadata
+
+
+def localize_cycle(estimator, sound_data, room_dim):
+    """Returns the densest source locations of one heart cycle and the
+       number of points around each. In a worker of localize_cycles, the
+       microphone combinations run on the worker's own EstimatorPool.
+
+       Args:
+           estimator: (SoundSourceLocation) finds the potential estimates
+           sound_data: (dictionary) microphone locations and signal data of
+                       the cycle
+           room_dim: (list) room dimensions
+
+       Returns:
+           locations: (numpy array) the densest source locations
+           densities: (numpy array) number of points around each location
+    """
+
+    worker_pool = get_worker_pool()
+    if worker_pool is not None:
+        estimator.pool = worker_pool
+
+    estimates = estimator.process_potential_estimates(sound_data)
+    source = DetermineSourceLocation(estimator.algo_name, 'cycle', estimates,
+                                     room_dim=room_dim, number_of_modes=estimator.num_sources,
+                                     rays=estimator.rays, parameters=estimator.get_parameters())
+    return source.use_kd_tree(), source.source_densities
+
+
+def localize_cycles(estimator, cycles, room_dim, jobs=None):
+    """Localizes every heart cycle in parallel, one cycle per worker, and
+       puts the results together. Cycles are read from the iterable only a
+       few at a time beyond the number of workers, see run_in_workers. The
+       location of a source over the whole recording is the median of its
+       location in each cycle, and the spread is the median distance of the
+       cycles from it.
+
+       Args:
+           estimator: (SoundSourceLocation) finds the potential estimates
+           cycles: (iterable) sound data of each cycle, e.g.
+                   PrepareData(..., segment_cycles=True).load_file()
+           room_dim: (list) room dimensions
+           jobs: (integer) largest number of cycles localized at once.
+                 Default is the number of CPUs
+
+       Returns:
+           (dictionary) 'locations' (n_cycles, n_sources, 3) location of
+           each source in each cycle, NaN when a cycle found fewer,
+           'densities' (n_cycles, n_sources) number of points around each,
+           'location' (n_sources, 3) median location of each source and
+           'spread' (n_sources) median distance of the cycles from it
+    """
 
-        # filtered_list = self.room_filter_out()
+    results = {index: future.result()
+               for index, future in run_in_workers(partial(localize_cycle, estimator,
+                                                           room_dim=room_dim),
+                                                   cycles, jobs)}
+    results = [results[i] for i in range(len(results))]
+
+    locations = np.full((len(results), estimator.num_sources, 3), np.nan)
+    densities = np.zeros((len(results), estimator.num_sources), dtype=int)
+    for i, (cycle_locations, cycle_densities) in enumerate(results):
+        locations[i, :len(cycle_locations)] = cycle_locations
+        densities[i, :len(cycle_densities)] = cycle_densities
+
+    with warnings.catch_warnings():
+        # A source no cycle found is left as NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        location = np.nanmedian(locations, axis=0)
+        spread = np.nanmedian(np.linalg.norm(locations - location, axis=2), axis=0)
+
+    return {'locations': locations, 'densities': densities,
+            'location': location, 'spread': spread}
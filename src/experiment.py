@@ -25,6 +25,12 @@ class ExperimentalMicData:
         Attributes:
             filename: (string) name of the file
             number_of_mics: (integer) the number of microphones to use
+            rir_cache: (RIRCache) on-disk cache of the room impulse
+                       responses, reused by every run with the same room,
+                       source and microphones. Default: None, they are
+                       computed on every run
+            sound_speed: (float) speed of sound (m/s) of the simulated room.
+                         Default: None, pyroomacoustics' default of 343 m/s
             **kwargs: the room dimensions and the source dimensions and
                       microphone locations
     """
@@ -32,11 +38,13 @@ class ExperimentalMicData:
     @validate_file_path
     @validate_room_source_dim_and_mic_loc
     def __init__(self, filename, number_of_mics=4, custom_mic_setup=None,
-                 **kwargs):
-        """Initializes ExperimentalMicData with filename, number_of_mics, and
-           **kwargs."""
+                 rir_cache=None, sound_speed=None, **kwargs):
+        """Initializes ExperimentalMicData with filename, number_of_mics,
+           rir_cache, sound_speed, and **kwargs."""
         self.filename = filename
         self.number_of_mics = number_of_mics
+        self.rir_cache = rir_cache
+        self.sound_speed = sound_speed
 
         *self.room_dim, = iter(kwargs.get('room_dim'))
         *self.source_dim, = iter(kwargs.get('source_dim'))
@@ -98,6 +106,8 @@ class ExperimentalMicData:
         """Sets up the simulated room (shoebox) with the room dimensions
            and the sampling rate of the sound source."""
         self.room = pra.ShoeBox(self.set_room_dimensions(), fs=sample_fs)
+        if self.sound_speed is not None:
+            self.room.set_sound_speed(self.sound_speed)
 
     def set_sound_source(self, sample_signal):
         """Add a source somewhere in the room"""
@@ -115,6 +125,8 @@ class ExperimentalMicData:
         """
         self.room.add_microphone_array(pra.MicrophoneArray(self.mics,
                                                            fs=sample_fs))
+        if self.rir_cache is not None:
+            self.rir_cache.compute_rir(self.room)
         self.room.simulate()
 
     def determine_angle_and_distance(self):
@@ -162,11 +174,39 @@ class ExperimentalMicData:
         savemat(self.name_to_save_file, dict_to_save)
         print("Saved file: {}".format(self.name_to_save_file))
 
-    def run(self, plot=False):
+    def get_converted_mic_locations(self):
+        """Returns the microphone locations relative to the center of the
+           room, one row per microphone in x,y,z order."""
+        return np.subtract(self.mics.T, self.set_room_dimensions()/2).tolist()
+
+    def get_sound_data(self):
+        """Returns the simulated recording in the format of
+           PrepareData.load_file, without writing it to a mat file: for
+           each microphone, its location relative to the center of the room
+           and its signal.
+
+           Returns:
+               (dictionary) microphone locations and signal data
+        """
+
+        converted_mic_locations = self.get_converted_mic_locations()
+
+        return {"".join(['mic', str(i + 1)]): (location, signal)
+                for i, (location, signal) in enumerate(zip(converted_mic_locations,
+                                                           self.room.mic_array.signals))}
+
+    def run(self, plot=False, save=True):
         """Sets the sound source and microphones. Records, and saves data
            into a mat file. Plots the microphones and sound source in a 3-d
            plot if necessary. Note: the microphone locations are recorded
            under a new coordinate system in relation to the center of the room.
+
+           Args:
+               plot: (boolean) plots the room. Default: False
+               save: (boolean) saves the signals to the mat file. When False,
+                     the returned file name is None and the signals are
+                     handed over in memory with get_sound_data.
+                     Default: True
            """
 
         sampling_rate, signal = self._read_wav_file()
@@ -179,14 +219,12 @@ class ExperimentalMicData:
         if plot:
             self._plot()
 
-        mic_list = ['mic'+str(i) for i in range(1, self.number_of_mics + 1)]
-        test_dict = dict(zip(mic_list, self.room.mic_array.signals))
-
-        self._save_file(test_dict)
+        if save:
+            mic_list = ['mic'+str(i) for i in range(1, self.number_of_mics + 1)]
+            test_dict = dict(zip(mic_list, self.room.mic_array.signals))
 
-        # Note: transposed microphones, so that one row is x,y,z order
-        converted_mic_locations = np.subtract(self.mics.T,
-                                              self.set_room_dimensions()/2).tolist()
+            self._save_file(test_dict)
 
-        return self.determine_angle_and_distance(), self.name_to_save_file, \
-               converted_mic_locations, sampling_rate
+        return self.determine_angle_and_distance(), \
+               self.name_to_save_file if save else None, \
+               self.get_converted_mic_locations(), sampling_rate
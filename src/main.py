@@ -2,16 +2,33 @@
 """This is the main driver file."""
 
 import os
+import sys
 
 from scripts.experiment import ExperimentalMicData
-from scripts.preprocess import PrepareData
 from scripts.sound_source_localization import SoundSourceLocation
 from scripts.determine_source import DetermineSourceLocation
+from scripts.profiling import Profiler
+from scripts.utils import ResultCache
 
 # TODO: Test CustomMicrophone
 
 
-def main():
+def main(profile_name=None):
+    """Runs the pipeline. When a profile name is given, the time spent in
+       each stage is written to <profile_name>.json and <profile_name>.csv,
+       along with a cProfile dump in <profile_name>.prof."""
+
+    if profile_name is None:
+        return run()
+
+    with Profiler(".".join([profile_name, 'prof'])) as profiler:
+        run()
+
+    profiler.to_json(".".join([profile_name, 'json']))
+    profiler.to_csv(".".join([profile_name, 'csv']))
+
+
+def run():
 
     head = '/home/akhil/Sound-Source-Localization/data/CMU_ARCTIC/cmu_us_bdl_arctic/wav/'
     sample_filename = "".join([head, 'arctic_a0001.wav'])
@@ -24,28 +41,36 @@ def main():
     microphone_location = [15 / 100, 0 / 100, 3 / 100]
     source_location = [2.5 / 100, 4.5 / 100, 7.8 / 100]
 
-    distance, *true_angles, output_file_name, converted_mic_locations, \
-    sample_rate = ExperimentalMicData(sample_filename,
-                                      number_of_mics=3,
-                                      custom_mic_setup='square',
-                                      room_dim=room_dimensions,
-                                      source_dim=source_location,
-                                      mic_location=microphone_location,
-                                      n=3,
-                                      phi=0.2,
-                                      d=0.4).run(plot=True)
-    test_data = PrepareData(output_file_name, *converted_mic_locations).load_file()
-    sample_mic_signal_loc_dict = next(test_data)
-    source_estimates = SoundSourceLocation(method_name,
-                                           number_of_mic_splits=3,
-                                           s1_bool=None,
-                                           x_dim_max=room_dimensions[0],
-                                           y_dim_max=room_dimensions[1],
-                                           z_dim_max=room_dimensions[2]).run_estimates(sample_mic_signal_loc_dict)
-    ts1 = DetermineSourceLocation(method_name, tail, *source_estimates,
+    # The simulated signals are handed over in memory, without a mat file
+    experiment = ExperimentalMicData(sample_filename,
+                                     number_of_mics=3,
+                                     custom_mic_setup='square',
+                                     room_dim=room_dimensions,
+                                     source_dim=source_location,
+                                     mic_location=microphone_location,
+                                     n=3,
+                                     phi=0.2,
+                                     d=0.4)
+    distance, *true_angles, _, converted_mic_locations, \
+    sample_rate = experiment.run(plot=True, save=False)
+    sample_mic_signal_loc_dict = experiment.get_sound_data()
+
+    # Reruns of the same recording and settings read the estimates back
+    result_cache = ResultCache(os.path.join('output', 'result_cache'))
+    estimator = SoundSourceLocation(method_name,
+                                    number_of_mic_splits=3,
+                                    s1_bool=None,
+                                    x_dim_max=room_dimensions[0],
+                                    y_dim_max=room_dimensions[1],
+                                    z_dim_max=room_dimensions[2],
+                                    result_cache=result_cache)
+    source_estimates = next(estimator.run_estimates(sample_mic_signal_loc_dict))
+    ts1 = DetermineSourceLocation(method_name, tail, source_estimates,
                                   *converted_mic_locations,
-                                  room_dim=room_dimensions).sprint()
+                                  room_dim=room_dimensions,
+                                  rays=estimator.rays,
+                                  parameters=estimator.get_parameters()).sprint()
 
 
 if __name__ == '__main__':
-    main()
+    main(*sys.argv[1:2])
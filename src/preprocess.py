@@ -2,11 +2,144 @@
 """In this script, preprocess will extract the sound data ond locations into
 one dictionary."""
 
+import re
 import sys
 import pathlib
+import numpy as np
 import scipy.io as sio
 
-from scripts.validations import validate_file_path, validate_signal_data
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+from scripts.profiling import get_profiler
+from scripts.segmentation import get_envelope, find_cycle_boundaries
+from scripts.validations import validate_file_path, validate_signal_data, \
+    validate_time_window
+
+
+# MATLAB v7.3 files are HDF5 files that start with this text
+MAT_V73_HEADER = b'MATLAB 7.3 MAT-file'
+
+
+def get_mic_number(name):
+    """Returns the sort key of a microphone variable name, its number, so
+       mic10 comes after mic9. Names without a number come last."""
+    match = re.search(r'mic(\d+)', name)
+    return (0, int(match.group(1))) if match else (1, 0)
+
+
+class MatFileChannels:
+    """MatFileChannels gives lazy access to each microphone channel of a
+       .mat file, so only the samples asked for are decoded. MATLAB v7.3
+       files are HDF5 and are sliced on disk through h5py, an optional
+       dependency. Older files cannot be sliced on disk, so each variable is
+       decoded once, on its first read, and kept.
+
+       Attributes:
+           filepath: (string) path of the .mat file
+           names: (list) microphone variable names, in file order. HDF5
+                  lists them alphabetically, so they are put in microphone
+                  number order instead
+           lengths: (dictionary) number of samples of each channel
+    """
+
+    def __init__(self, filepath):
+        """Initializes MatFileChannels with filepath."""
+        self.filepath = filepath
+
+        with open(filepath, 'rb') as mat_file:
+            self._hdf5 = mat_file.read(len(MAT_V73_HEADER)) == MAT_V73_HEADER
+
+        if self._hdf5:
+            if h5py is None:
+                raise ImportError("Error. Reading MATLAB v7.3 files requires h5py.")
+            self._file = h5py.File(filepath, 'r')
+            shapes = {name: self._file[name].shape
+                      for name in sorted(self._file.keys(), key=get_mic_number)
+                      if 'mic' in name}
+        else:
+            self._file = None
+            shapes = {name: shape for name, shape, _ in sio.whosmat(filepath)
+                      if 'mic' in name}
+
+        self.names = list(shapes)
+        self.lengths = {name: max(shape) for name, shape in shapes.items()}
+        self._decoded = {}
+
+    def read(self, name, start=None, stop=None):
+        """Returns the samples of one channel between start and stop.
+
+           Args:
+               name: (string) microphone variable name
+               start: (integer) first sample. Default: the beginning
+               stop: (integer) sample after the last. Default: the end
+
+           Returns:
+               (numpy array) the samples, one dimensional
+        """
+
+        window = slice(start, stop)
+
+        if self._hdf5:
+            # MATLAB stores a row vector as one column in HDF5
+            dataset = self._file[name]
+            if dataset.shape[-1] == 1:
+                return dataset[window, 0]
+            return dataset[0, window]
+
+        if name not in self._decoded:
+            self._decoded[name] = sio.loadmat(self.filepath, variable_names=[name])[name][0]
+
+        # A copy, so a window does not keep the whole channel in memory
+        return self._decoded[name][window].copy()
+
+    def channel(self, name):
+        """Returns a lazy array of one channel, read when sliced."""
+        return LazyChannel(self, name)
+
+    def close(self):
+        self._decoded = {}
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class LazyChannel:
+    """LazyChannel is one microphone channel of a .mat file that is only
+       read from disk when it is sliced.
+
+       Attributes:
+           channels: (MatFileChannels) the open file
+           name: (string) microphone variable name
+    """
+
+    def __init__(self, channels, name):
+        """Initializes LazyChannel with channels and name."""
+        self.channels = channels
+        self.name = name
+
+    @property
+    def shape(self):
+        return (self.channels.lengths[self.name],)
+
+    def __len__(self):
+        return self.channels.lengths[self.name]
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice) or index.step not in (None, 1):
+            raise TypeError("Error. A lazy channel can only be sliced.")
+        return self.channels.read(self.name, index.start, index.stop)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:], dtype=dtype)
 
 
 class PrepareData:
@@ -20,14 +153,34 @@ class PrepareData:
                        cycles. Default is False
             s1_bool: (boolean) specifies whether to look for S1 or S2
                      sound source. Default: True
+            trusted: (boolean) skips validating the signals, e.g. for files
+                     written by ExperimentalMicData. Default: False
+            time_window: (tuple) start and stop time (in seconds) of the part
+                         of the recording to load, e.g. one heart cycle.
+                         Default: None, the whole recording
+            sampling_rate: (integer) sampling frequency of the recording,
+                           used to convert the time window to samples.
+                           Default: 16000 Hz
+            segment_cycles: (boolean) load_file yields one heart cycle at a
+                            time instead of the whole recording.
+                            Default: False
+            cycles: (list) first and last (exclusive) sample of each heart
+                    cycle found, set while load_file segments the recording
     """
 
     @validate_file_path
-    def __init__(self, filepath, *args, recovered=False):
-        """Initializes PrepareData with filepath, and recovered."""
+    def __init__(self, filepath, *args, recovered=False, trusted=False,
+                 time_window=None, sampling_rate=16000, segment_cycles=False):
+        """Initializes PrepareData with filepath, recovered, trusted,
+           time_window, sampling_rate, and segment_cycles."""
 
         self.filepath = filepath
         self.recovered = recovered
+        self.trusted = trusted
+        self.time_window = validate_time_window(time_window)
+        self.sampling_rate = sampling_rate
+        self.segment_cycles = segment_cycles
+        self.cycles = None
 
         self.s1_bool = True
 
@@ -47,9 +200,50 @@ class PrepareData:
 
     def load_file(self):
         """Loads in .mat file. Otherwise yield a list-- microphones, signals,
-           microphone locations-- and S1 boolean.
+           microphone locations-- and S1 boolean. When segmenting cycles, one
+           is yielded per heart cycle, each read from the file when it is
+           reached.
         """
-        yield self._read_mat_file(self.filepath)
+        if self.segment_cycles:
+            yield from self._read_cycles(self.filepath)
+        else:
+            yield self._read_mat_file(self.filepath)
+
+    def _read_cycles(self, sample_filepath):
+        """Finds the heart cycles from the envelope of every channel, read
+           one channel at a time, then reads and yields the signals of one
+           cycle at a time.
+
+           Args:
+                sample_filepath: (string) name of file path
+
+           Yields:
+               dictionary of microphone locations and signal data of one
+               heart cycle
+
+            Raises:
+                FileNotFoundError: if .mat file cannot be found
+        """
+
+        try:
+            channels = MatFileChannels(sample_filepath)
+        except OSError:
+            raise FileNotFoundError("Error. File not found.") from None
+
+        with channels:
+            start, stop = self.get_sample_window()
+            start = start or 0
+
+            with get_profiler().span('segmentation'):
+                envelope = get_envelope((channels.read(name, start, stop) for name in channels.names),
+                                        self.sampling_rate)
+                self.cycles = [(start + cycle_start, start + cycle_stop) for cycle_start, cycle_stop
+                               in find_cycle_boundaries(envelope, self.sampling_rate)]
+
+            for cycle_start, cycle_stop in self.cycles:
+                with get_profiler().span('load'):
+                    data = [channels.read(name, cycle_start, cycle_stop) for name in channels.names]
+                yield self._get_mic_signal_location(data, trusted=self.trusted)
 
     def _read_mat_file(self, sample_filepath):
         """Reads in the .mat file and check if the file does in fact exist.
@@ -65,9 +259,10 @@ class PrepareData:
         """
 
         try:
-            data = {key: value[0] for key, value in
-                    sio.loadmat(sample_filepath).items() if 'mic' in key}
-            return self._get_mic_signal_location(list(data.values()))
+            with get_profiler().span('load'), MatFileChannels(sample_filepath) as channels:
+                start, stop = self.get_sample_window()
+                data = [channels.read(name, start, stop) for name in channels.names]
+            return self._get_mic_signal_location(data, trusted=self.trusted)
 
         except OSError:
             # Check if the python version is 3.6 or greater
@@ -79,6 +274,13 @@ class PrepareData:
                 pass
             raise FileNotFoundError("Error. File not found.") from None
 
+    def get_sample_window(self):
+        """Returns the first and last (exclusive) sample of the time window,
+           or None for both when the whole recording is loaded."""
+        if self.time_window is None:
+            return None, None
+        return tuple(int(round(seconds * self.sampling_rate)) for seconds in self.time_window)
+
     @validate_signal_data
     def _get_mic_signal_location(self, data):
         """Returns for each of the n microphones, its locations and associated
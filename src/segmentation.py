@@ -0,0 +1,102 @@
+# !/usr/bin/env python
+"""In this script, segmentation will split a heart sound recording into its
+cycles. The heart sounds (S1 and S2) are found as peaks of the envelope of
+all the microphones, and each cycle ends halfway through the longer pause
+after S2 (diastole)."""
+
+import numpy as np
+
+from scipy.ndimage import uniform_filter1d
+from scipy.signal import find_peaks
+
+
+def get_envelope(signals, sampling_rate, window=0.02):
+    """Returns the envelope of the recording, the sum over the microphones
+       of the moving root mean square of each signal. Each signal is scaled
+       by its largest value first, so no microphone outweighs the others.
+       The signals are read one at a time.
+
+       Args:
+           signals: (iterable) signal of each microphone
+           sampling_rate: (integer) sampling frequency of the signals
+           window: (float) length of the moving window in seconds.
+                   Default: 0.02
+
+       Returns:
+           (numpy array) the envelope, one value per sample
+    """
+
+    width = max(int(round(window * sampling_rate)), 1)
+    envelope = None
+
+    for signal in signals:
+        signal = np.asarray(signal, dtype=float)
+        scale = np.max(np.abs(signal), initial=0.0)
+        rms = np.sqrt(uniform_filter1d((signal / scale if scale > 0 else signal) ** 2,
+                                       width, mode='nearest'))
+        envelope = rms if envelope is None else envelope + rms
+
+    if envelope is None:
+        raise ValueError("Error. No signals to segment.")
+    return envelope
+
+
+def find_heart_sounds(envelope, sampling_rate, min_gap=0.1, threshold=0.2):
+    """Returns the sample index of each heart sound, the peaks of the
+       envelope that stand out from it by more than the threshold.
+
+       Args:
+           envelope: (numpy array) envelope of the recording
+           sampling_rate: (integer) sampling frequency of the envelope
+           min_gap: (float) shortest time between two heart sounds in
+                    seconds. Default: 0.1
+           threshold: (float) smallest prominence of a heart sound, as a
+                      fraction of the largest value of the envelope.
+                      Default: 0.2
+
+       Returns:
+           (numpy array) index of each heart sound
+    """
+
+    peaks, _ = find_peaks(envelope, distance=max(int(min_gap * sampling_rate), 1),
+                          prominence=threshold * np.max(envelope, initial=0.0))
+    return peaks
+
+
+def find_cycle_boundaries(envelope, sampling_rate, **kwargs):
+    """Returns the first and last (exclusive) sample of each heart cycle.
+       Systole (S1 to S2) is shorter than diastole (S2 to S1), so the pauses
+       between heart sounds alternate between short and long. A cycle
+       boundary is put halfway through each long pause. When the pauses do
+       not differ, every heart sound is its own cycle. The first cycle
+       starts, and the last one ends, half a long pause away from the
+       outer heart sounds.
+
+       Args:
+           envelope: (numpy array) envelope of the recording
+           sampling_rate: (integer) sampling frequency of the envelope
+           kwargs: min_gap and threshold, see find_heart_sounds
+
+       Returns:
+           (list) start and stop sample of each cycle, in time order
+    """
+
+    heart_sounds = find_heart_sounds(envelope, sampling_rate, **kwargs)
+    if len(heart_sounds) < 2:
+        return [(0, len(envelope))] if len(heart_sounds) else []
+
+    gaps = np.diff(heart_sounds)
+    if gaps.max() > 1.2 * gaps.min():
+        long_pauses = gaps > (gaps.min() + gaps.max()) / 2
+    else:
+        long_pauses = np.ones(len(gaps), dtype=bool)
+
+    middles = (heart_sounds[:-1] + gaps // 2)[long_pauses]
+
+    boundaries = np.concatenate([[max(heart_sounds[0] - gaps[long_pauses].min() // 2, 0)],
+                                 middles,
+                                 [min(heart_sounds[-1] + gaps[long_pauses].min() // 2,
+                                      len(envelope))]])
+
+    return [(int(start), int(stop)) for start, stop in zip(boundaries[:-1], boundaries[1:])
+            if np.any((heart_sounds >= start) & (heart_sounds < stop))]
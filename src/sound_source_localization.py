@@ -2,15 +2,25 @@
 """In this script, run_sound_source will find the all potential candidates for
 where the sound source is located."""
 
-from itertools import combinations
+import copy
+import hashlib
+import json
+import time
+from itertools import combinations, permutations
 
 import numpy as np
 import pyroomacoustics as pra
 
-from scripts.utils import MultiProcessingWithReturnValue
+from scripts.geometry import ray_box_intervals, sample_ray_intervals, \
+    ray_box_endpoints, make_ray_segments, segment_closest_approach, \
+    spherical_cap_points, combination_geometry
+from scripts.profiling import get_profiler, ProfiledCall
+from scripts.utils import MultiProcessingWithReturnValue, SharedArray, \
+    LRUCache
 from scripts.validations import validate_difference_of_arrivals, \
     ValidateCentroid, validate_get_mic_with_sound_data, validate_splits,\
-    validate_instance_type
+    validate_ray_sampling, validate_mic_locations, \
+    validate_grid_search, validate_combination_pruning
 
 
 # TODO:
@@ -19,6 +29,27 @@ from scripts.validations import validate_difference_of_arrivals, \
 #       the desired result?
 
 
+# DOA objects with their search grid, keyed by the microphone geometry and
+# estimator parameters. Each worker process keeps its own cache, which
+# persists across recordings when the worker pool is reused.
+DOA_CACHE = LRUCache(maxsize=256)
+
+# Attributes that hold the state of a run rather than its configuration,
+# left out of the result cache key
+RUNTIME_ATTRIBUTES = ('pool', 'result_cache', 'combination_scores', 'power', 'rays',
+                      'ray_labels')
+
+# Attributes set by a run that are saved with its estimates in the result
+# cache and restored on a hit
+CACHED_ATTRIBUTES = ('combination_scores', 'power')
+
+# Attributes of the estimator that shape its estimates, saved along with the
+# source locations, see get_parameters
+ESTIMATOR_PARAMETERS = ('num_sources', 'mic_combinations_number', 'sampling_rate',
+                        'sound_speed', 'fft_size', 'freq_range', 'n_grid', 'grid_search',
+                        'tol', 'ray_sampling')
+
+
 class SoundSourceLocation:
     """SoundSourceLocation finds the potential location points of a
        sound source using a distance of arrival (DOA) method via a
@@ -37,9 +68,31 @@ class SoundSourceLocation:
         fft_size: (integer) specific FFT size. Default is 256
         freq_range: (list) specific frequency range to isolate for.
                     Default range is 0 - 256 Hz
+        n_grid: (integer) number of points on the DOA search sphere
+        grid_search: (string) 'flat' searches the n_grid sphere once, while
+                     'hierarchical' searches a coarse sphere and then
+                     refines around its best peaks. Default is 'flat'
+        n_coarse_grid: (integer) number of points on the coarse sphere
+        refine_levels: (integer) number of refinement levels
+        refine_peaks: (integer) number of peaks refined at each level
+        refine_points: (integer) number of points around each peak
+        refine_shrink: (float) how much the refined area shrinks at each level
         tol: (float) specific tolerance to use for distance between
              each point in the radius
         radius: (numpy array) values for radius
+        ray_sampling: (string) how each direction becomes candidate points.
+                      'radius' multiplies it by the whole radius, 'clipped'
+                      keeps only the radius values inside the room, and
+                      'endpoints' keeps where the ray enters and leaves the
+                      room. Default is 'radius'
+        combination_budget: (integer) largest number of microphone
+                            combinations to run, the best scored first.
+                            Default: None, every combination
+        combination_threshold: (float) smallest score, from 0 to 1, of a
+                               microphone combination to run. Default:
+                               None, every combination
+        combination_scores: (numpy array) score of each combination of the
+                            last recording, see score_combinations
 
         s1_bool: (boolean) indicates whether to find S1 or S2 sound source.
                   Default is True
@@ -51,11 +104,26 @@ class SoundSourceLocation:
                    -- ex. height
         transform: (boolean) DEBUG -- figure out whether to use the new version
                     or the deprecated version
+        pool: (EstimatorPool) long-lived worker pool reused across
+              run_estimates calls. Default: None, a pool is created
+              for every recording
+        result_cache: (ResultCache) on-disk cache of the estimates, keyed
+                      by the recording and every parameter of the
+                      estimator. Default: None, always computed
+        rays: (tuple) origin and direction of each ray of the last
+              recording, re-centered like the estimates, for
+              DetermineSourceLocation to count the rays around a location.
+              None when the estimates are not made of rays
+        ray_labels: (numpy array) source label of each ray, when the
+                    estimates are labeled
     """
 
     def __init__(self, algo_name, num_sources=1, number_of_mic_splits=5,
                  sampling_rate=16000, s1_bool=True, x_dim_max=0.34925,
-                 y_dim_max=0.219964, z_dim_max=0.2413, transform=False):
+                 y_dim_max=0.219964, z_dim_max=0.2413, transform=False,
+                 pool=None, ray_sampling='radius', grid_search='flat',
+                 combination_budget=None, combination_threshold=None,
+                 result_cache=None):
         """Initializes SoundSourceLocation with algo_name, num_sources."""
 
         self.algo_name = algo_name
@@ -69,8 +137,19 @@ class SoundSourceLocation:
         self.sampling_rate = sampling_rate
         self.fft_size = 256
         self.freq_range = [0, 250]
+        self.n_grid = 1000
+        self.grid_search = validate_grid_search(grid_search)
+        self.n_coarse_grid = 100
+        self.refine_levels = 4
+        self.refine_peaks = 3
+        self.refine_points = 24
+        self.refine_shrink = 0.5
         self.tol = 1e-3  # 3e-3
         self.radius = np.arange(0, 0.5, self.tol)[:, np.newaxis]
+        self.ray_sampling = validate_ray_sampling(ray_sampling)
+        self.combination_budget, self.combination_threshold = \
+            validate_combination_pruning(combination_budget, combination_threshold)
+        self.combination_scores = None
 
         self.s1_bool = s1_bool
 
@@ -81,6 +160,102 @@ class SoundSourceLocation:
         # TODO: DEBUG
         self.transform = transform
 
+        self.pool = pool
+        self.result_cache = result_cache
+        self.rays = None
+        self.ray_labels = None
+
+    def __getstate__(self):
+        """The worker pool stays in the parent process."""
+        state = self.__dict__.copy()
+        state['pool'] = None
+        return state
+
+    def get_parameters(self):
+        """Returns the parameters the estimates were found with, keyed by
+           attribute name, along with the name of the estimator class."""
+        parameters = {name: getattr(self, name) for name in ESTIMATOR_PARAMETERS}
+        parameters['estimator'] = type(self).__name__
+        return parameters
+
+    def get_result_key(self, all_sound_data, labeled=False):
+        """Returns the key of the estimates in the result cache, a hash of
+           every microphone location and signal and every parameter of the
+           estimator, such as algo_name, fft_size, freq_range, sound_speed,
+           tol and n_grid.
+
+           Args:
+               all_sound_data: (numpy array) the entire microphone signal data
+               labeled: (boolean) whether the estimates are labeled by source
+
+            Returns:
+                (string) the key
+        """
+
+        digest = hashlib.sha256()
+
+        for i in range(len(all_sound_data)):
+            mic = "".join(['mic', str(i+1)])
+            location, signal = all_sound_data[mic]
+            signal = np.ascontiguousarray(signal)
+            digest.update(mic.encode())
+            digest.update(np.asarray(location, dtype=float).tobytes())
+            digest.update(" ".join([signal.dtype.str, str(signal.shape)]).encode())
+            digest.update(signal.tobytes())
+
+        def describe(value):
+            if isinstance(value, np.ndarray):
+                return [value.dtype.str, value.shape,
+                        hashlib.sha256(np.ascontiguousarray(value).tobytes()).hexdigest()]
+            return repr(value)
+
+        parameters = {name: value for name, value in vars(self).items()
+                      if name not in RUNTIME_ATTRIBUTES}
+        digest.update(json.dumps([type(self).__name__, labeled, parameters],
+                                 sort_keys=True, default=describe).encode())
+
+        return digest.hexdigest()
+
+    def get_cached_estimates(self, all_sound_data, labeled=False):
+        """Returns the estimates from the result cache, computing and adding
+           them when they are not in it yet. The rays, ray labels, combination
+           scores and SRP-PHAT power are saved with them and restored on a
+           hit. See process_potential_estimates and
+           process_labeled_estimates."""
+
+        if self.result_cache is None:
+            if labeled:
+                return self.process_labeled_estimates(all_sound_data)
+            return self.process_potential_estimates(all_sound_data)
+
+        key = self.get_result_key(all_sound_data, labeled)
+        result = self.result_cache.get(key)
+
+        if result is None:
+            if labeled:
+                estimates, labels = self.process_labeled_estimates(all_sound_data)
+                result = {'estimates': estimates, 'labels': labels,
+                          'ray_labels': self.ray_labels}
+            else:
+                result = {'estimates': self.process_potential_estimates(all_sound_data)}
+            if self.rays is not None:
+                result['origins'], result['directions'] = self.rays
+            for name in CACHED_ATTRIBUTES:
+                result[name] = getattr(self, name, None)
+            self.result_cache.put(key, {name: value for name, value in result.items()
+                                        if value is not None})
+        else:
+            self.rays = ((result['origins'], result['directions'])
+                         if 'origins' in result else None)
+            self.ray_labels = result.get('ray_labels')
+            for name in CACHED_ATTRIBUTES:
+                if hasattr(self, name):
+                    setattr(self, name, result.get(name))
+
+        if labeled:
+            return result['estimates'], result['labels']
+        return result['estimates']
+
     @staticmethod
     @ValidateCentroid
     def get_centroid(*args):
@@ -95,6 +270,23 @@ class SoundSourceLocation:
         microphone_array = np.array(*args)
         return np.sum(microphone_array, axis=0) / len(*args)
 
+    @staticmethod
+    def get_centroids(mic_locations, combination_indices):
+        """Returns the center of every microphone combination at once. The
+           locations are expected to be validated already.
+
+            Args:
+                mic_locations: (numpy array) location of each microphone,
+                               shape (n_mics, 3)
+                combination_indices: (numpy array) microphone indices of each
+                                     combination, shape (n_combinations, k)
+
+            Returns:
+                (numpy array) the center of each combination, shape
+                (n_combinations, 3)
+        """
+        return mic_locations[combination_indices].mean(axis=1)
+
     def set_room_dimensions(self):
         """Returns the numpy array of the room dimensions with the format:
            Width, Depth, and Length.
@@ -132,6 +324,42 @@ class SoundSourceLocation:
 
         return signal_list, mic_location
 
+    def transform_signal(self, signal):
+        """Returns the short time fourier transform of a single microphone
+           signal with the format: frequency bins by frames.
+
+            Args:
+                signal: (numpy array) microphone signal
+
+            Returns:
+                (numpy array) short time fourier transformed signal
+        """
+
+        # TODO: Figure out this deprecation
+        if self.transform:
+            return pra.stft(signal, self.fft_size, self.fft_size // 2,
+                            transform=np.fft.rfft).T
+        return pra.transform.stft.analysis(signal, self.fft_size,
+                                           self.fft_size // 2).T
+
+    def build_stft_cache(self, all_sound_data):
+        """Returns the short time fourier transform of every microphone
+           signal, keyed by microphone. Each channel is transformed once,
+           so the cost grows with the number of microphones rather than
+           the number of microphone combinations.
+
+            Args:
+                all_sound_data: dictionary of microphone, location and
+                                sound data
+
+            Returns:
+                (dictionary) microphone and its transformed signal
+        """
+
+        with get_profiler().span('stft'):
+            return {mic: self.transform_signal(loc_and_signal[1])
+                    for mic, loc_and_signal in all_sound_data.items()}
+
     @validate_difference_of_arrivals
     def get_difference_of_arrivals(self, signal_list, *mic_location):
         """Returns an azimuth and co-latitude for each pair of
@@ -146,74 +374,131 @@ class SoundSourceLocation:
                  doa.colatitude_recon: (float) Co-latitude angle
         """
 
+        # Create an array of a short fourier transformed frequency signal
+        stft_signal = np.array([self.transform_signal(signal)
+                                for signal in signal_list])
+
+        return self.locate_directions(stft_signal, *mic_location)
+
+    def locate_directions(self, stft_signal, *mic_location):
+        """Returns an azimuth and co-latitude for already transformed
+           microphone signals. Note: all angles are returned in radians
+
+            Args:
+                stft_signal: (numpy array) short time fourier transformed
+                             signals with the format: microphones, frequency
+                             bins, and frames
+                *mic_location: (list) location of each microphone
+
+            Returns:
+                 doa.azimuth_recon: (float) Azimuth angle
+                 doa.colatitude_recon: (float) Co-latitude angle
+        """
+
         # Add n-microphone array in [x,y,z] order
         microphones = np.vstack(list(zip(*mic_location)))
 
-        # TODO: Figure out this deprecation
-        # Create an array of a short fourier transformed frequency signal
-        if self.transform:
-            stft_signal = np.array([pra.stft(signal,
-                                             self.fft_size,
-                                             self.fft_size // 2,
-                                             transform=np.fft.rfft).T
-                                    for signal in signal_list])
-        else:
-            stft_signal = np.array([pra.transform.stft.analysis(signal,
-                                                                self.fft_size,
-                                                                self.fft_size // 2).T
-                                    for signal in signal_list])
+        doa = self.get_doa(microphones)
 
-        # Construct the new DOA object
-        # Note: Transpose order of microphones
-        doa = pra.doa.algorithms.get(self.algo_name)(L=microphones.T,
-                                                     fs=self.sampling_rate,
-                                                     nfft=self.fft_size,
-                                                     c=self.sound_speed,
-                                                     num_src=self.num_sources,
-                                                     max_four=4, dim=3,
-                                                     n_grid=1000)
+        # Note: the cached object may have found fewer sources last time
+        with get_profiler().span('doa'):
+            doa.locate_sources(stft_signal, num_src=self.num_sources,
+                               freq_range=self.freq_range)
 
-        doa.locate_sources(stft_signal, freq_range=self.freq_range)
+            if self.grid_search == 'hierarchical':
+                doa = self.refine_directions(doa, stft_signal)
 
         return doa.azimuth_recon, doa.colatitude_recon
 
-    def split_and_conquer(self, the_centroid, cartesian_arr):
-        """Returns the cartesian array multiplied by the radius and recenter
-           for each source when looking for multiple sources.
+    def refine_directions(self, doa, stft_signal):
+        """Returns a DOA object searched coarse to fine. Starting from the
+           peaks of the coarse sphere, each level only evaluates the
+           pseudo-spectrum on small caps around the best peaks of the level
+           before, and the caps shrink at every level. The cached coarse
+           object is left as it is.
 
             Args:
-                the_centroid: the specific centroid associated with each
-                              microphone combination
-                cartesian_arr: the cartesian array before the multiplication
-                               of the radius
+                doa: the DOA object, already located on the coarse sphere
+                stft_signal: (numpy array) short time fourier transformed
+                             signals with the format: microphones, frequency
+                             bins, and frames
 
             Returns:
-                (numpy array) cartesian coordinates for each source
+                the DOA object located on the finest caps
+        """
 
-            Raises:
-                TypeError: Cartesian array is not a numpy array
-            """
+        # Spacing of the coarse sphere, which each level divides
+        cap_radius = np.sqrt(4 * np.pi / doa.grid.n_points)
+
+        refined = copy.copy(doa)
+        for _ in range(self.refine_levels):
+            peaks = refined.grid.find_peaks(k=max(self.refine_peaks, self.num_sources))
+            directions = np.vstack([spherical_cap_points(refined.grid.cartesian[:, peak],
+                                                         cap_radius, self.refine_points)
+                                    for peak in peaks])
 
-        if not validate_instance_type(cartesian_arr, np.ndarray):
-            raise TypeError("Error. Cartesian array is not a numpy array")
+            refined.grid = pra.doa.GridSphere(cartesian_points=directions.T)
+            refined.mode_vec = pra.doa.ModeVector(refined.L, refined.fs, refined.nfft,
+                                                  refined.c, refined.grid)
+            refined.locate_sources(stft_signal, num_src=self.num_sources,
+                                   freq_range=self.freq_range)
 
-        # Split up the array into the separate parts based on
-        # how many sources there are
-        array_split = np.vsplit(cartesian_arr.T, self.num_sources)
+            cap_radius *= self.refine_shrink
 
-        # Multiply each respective part by the radius and recenter it
-        # with the centroid
-        for i in range(self.num_sources):
-            array_split[i] = self.radius * array_split[i] + np.array(the_centroid)[np.newaxis, :]
+        return refined
 
-        return np.vstack(array_split)
+    def get_doa(self, microphones):
+        """Returns the DOA object for the microphone geometry. The object,
+           along with its search grid, is built once and reused from the
+           DOA cache for every later recording with the same geometry. The
+           lookup is timed as a doa_setup span labeled with whether it was
+           cached, so the hits of every worker reach the profiler.
+
+            Args:
+                microphones: (numpy array) microphone locations, one row per
+                             microphone in [x,y,z] order
+
+            Returns:
+                the DOA object
+        """
+
+        key = (self.algo_name, tuple(np.ravel(microphones).tolist()),
+               self.sampling_rate, self.fft_size, self.sound_speed,
+               self.num_sources, self.get_grid_size(), tuple(self.freq_range))
+
+        with get_profiler().span('doa_setup', cached=key in DOA_CACHE):
+            return DOA_CACHE.get_or_create(key, lambda: self.construct_doa(microphones))
+
+    def construct_doa(self, microphones):
+        """Returns a new DOA object for the microphone geometry.
+
+            Args:
+                microphones: (numpy array) microphone locations, one row per
+                             microphone in [x,y,z] order
+
+            Returns:
+                the DOA object
+        """
+
+        # Construct the new DOA object
+        # Note: Transpose order of microphones
+        return pra.doa.algorithms.get(self.algo_name)(L=microphones.T,
+                                                      fs=self.sampling_rate,
+                                                      nfft=self.fft_size,
+                                                      c=self.sound_speed,
+                                                      num_src=self.num_sources,
+                                                      max_four=4, dim=3,
+                                                      n_grid=self.get_grid_size())
+
+    def get_grid_size(self):
+        """Returns the number of points on the first sphere searched."""
+        return self.n_coarse_grid if self.grid_search == 'hierarchical' else self.n_grid
 
     def get_estimates(self, sound_data, *mic_split):
-        """Returns the numpy array of location estimates for each microphone
-           combination pairing and associated sound data. First, the signal
-           and microphone locations are acquired. Next the centroid is gathered.
-           Finally, the azimuth and co-latitude angles are generated and converted
-           to cartesian coordinates, which are then multiplied by the radius.
+        """Returns the numpy array of location estimates for one microphone
+           combination looked up by name. The azimuth and co-latitude angles
+           are found and expanded along the radius from the centroid, the
+           same way as every combination in estimate_combinations.
 
            Args:
                sound_data: (numpy array) the specific sound data for microphone
@@ -226,23 +511,370 @@ class SoundSourceLocation:
 
         signal, mic_locations = self.get_mic_match_with_sound_data(sound_data,
                                                                    *mic_split)
-        centroid = self.get_centroid(mic_locations)
         azimuth_recon, colatitude_recon = self.get_difference_of_arrivals(signal,
                                                                           mic_locations)
 
-        cartesian_coordinates = np.array([np.cos(azimuth_recon)*np.sin(colatitude_recon),
-                                          np.sin(azimuth_recon)*np.sin(colatitude_recon),
-                                          np.cos(colatitude_recon)])
+        return self.estimate_combinations(validate_mic_locations(mic_locations),
+                                          np.arange(len(mic_locations))[np.newaxis, :],
+                                          [azimuth_recon], [colatitude_recon])
+
+    def locate_combination(self, shared_signals, *combination):
+        """Returns the centroid and the azimuth and co-latitude angles for one
+           microphone combination, reading the transformed signals and the
+           microphone locations from shared memory.
+
+           Args:
+               shared_signals: (tuple) SharedArray of the transformed signals
+                               and SharedArray of the microphone locations
+               *combination: (integer) indices of the microphones
+
+            Returns:
+                centroid: (numpy array) center of the microphones
+                azimuth_recon: (numpy array) Azimuth angles
+                colatitude_recon: (numpy array) Co-latitude angles
+        """
+
+        shared_spectra, shared_locations = shared_signals
+        indices = list(combination)
+
+        # The geometry was validated once in map_combinations
+        mic_locations = shared_locations.array[indices]
+        centroid = mic_locations.mean(axis=0)
+        azimuth_recon, colatitude_recon = self.locate_directions(shared_spectra.array[indices],
+                                                                 mic_locations)
+
+        return centroid, azimuth_recon, colatitude_recon
+
+    def clip_rays_to_room(self, origins, directions):
+        """Returns the points of every ray that lie inside the room.
+
+           Args:
+               origins: (numpy array) start of each ray, shape (n, 3)
+               directions: (numpy array) unit direction of each ray, shape (n, 3)
+
+            Returns:
+                (numpy array) Array of the estimates
+        """
+
+        # The microphone locations are relative to the center of the room
+        half_room = self.set_room_dimensions() / 2
+        t_enter, t_exit = ray_box_intervals(origins, directions, -half_room,
+                                            half_room, t_max=self.radius[-1, 0])
+
+        if self.ray_sampling == 'endpoints':
+            return ray_box_endpoints(origins, directions, t_enter, t_exit)
+        return sample_ray_intervals(origins, directions, t_enter, t_exit, self.tol)
+
+    @staticmethod
+    def directions_to_cartesian(azimuth_recon, colatitude_recon):
+        """Returns the unit direction of each azimuth and co-latitude angle,
+           shape (n, 3)."""
+        return np.column_stack([np.cos(azimuth_recon)*np.sin(colatitude_recon),
+                                np.sin(azimuth_recon)*np.sin(colatitude_recon),
+                                np.cos(colatitude_recon)])
+
+    def expand_rays(self, origins, directions):
+        """Returns the points along every ray at once. With the default ray
+           sampling the result is written into one preallocated array of
+           shape (n_rays * n_radius, 3), ray by ray.
+
+           Args:
+               origins: (numpy array) start of each ray, shape (n_rays, 3)
+               directions: (numpy array) unit direction of each ray, shape
+                           (n_rays, 3)
+
+            Returns:
+                (numpy array) Array of the estimates
+        """
+
+        with get_profiler().span('ray_expansion'):
+            if self.ray_sampling != 'radius':
+                return self.clip_rays_to_room(origins, directions)
+
+            points = np.empty((len(directions), len(self.radius), 3))
+            np.multiply(self.radius[np.newaxis, :, :], directions[:, np.newaxis, :], out=points)
+            points += origins[:, np.newaxis, :]
+
+            return points.reshape(-1, 3)
+
+    def estimate_combinations(self, mic_locations, combination_indices,
+                              azimuth_recon, colatitude_recon):
+        """Returns the location estimates of every microphone combination
+           in one set of array operations: the centroids are gathered from
+           the combination indices, and each direction is expanded along
+           the radius.
+
+           Args:
+               mic_locations: (numpy array) validated location of each
+                              microphone, shape (n_mics, 3)
+               combination_indices: (numpy array) microphone indices of each
+                                    combination, shape (n_combinations, k)
+               azimuth_recon: (list) azimuth angles found by each combination
+               colatitude_recon: (list) co-latitude angles found by each
+                                 combination
+
+            Returns:
+                (numpy array) Array of the estimates
+        """
+
+        return self.expand_rays(*self.get_rays(mic_locations, combination_indices,
+                                               azimuth_recon, colatitude_recon))
+
+    def get_rays(self, mic_locations, combination_indices, azimuth_recon,
+                 colatitude_recon):
+        """Returns the origin (the centroid) and unit direction of one ray
+           per source found by each microphone combination. See
+           estimate_combinations for the arguments.
+
+            Returns:
+                origins: (numpy array) start of each ray, shape (n_rays, 3)
+                directions: (numpy array) direction of each ray, shape
+                            (n_rays, 3)
+        """
+
+        azimuth_recon = [np.atleast_1d(azimuth) for azimuth in azimuth_recon]
+        colatitude_recon = [np.atleast_1d(colatitude) for colatitude in colatitude_recon]
+
+        centroids = self.get_centroids(mic_locations, combination_indices)
+        origins = np.repeat(centroids, [len(azimuth) for azimuth in azimuth_recon], axis=0)
+        directions = self.directions_to_cartesian(np.concatenate(azimuth_recon),
+                                                  np.concatenate(colatitude_recon))
+
+        return origins, directions
+
+    def get_mic_locations(self, all_sound_data):
+        """Returns the validated microphone locations, shape (n_mics, 3),
+           in microphone order."""
+        mics = ["".join(['mic', str(i+1)]) for i in range(len(all_sound_data))]
+        return validate_mic_locations([all_sound_data[mic][0] for mic in mics])
+
+    def get_combination_indices(self, number_of_mics):
+        """Returns the microphone indices of every combination in the order
+           map_combinations runs them. Combinations are split up into equal
+           chunks, which are interleaved across the workers.
+
+           Args:
+               number_of_mics: (integer) number of microphones
+
+            Returns:
+                (numpy array) microphone indices, shape (n_combinations, k)
+        """
+
+        mic_list_comb = list(combinations(range(number_of_mics), self.mic_combinations_number))
+
+        splits = validate_splits(len(mic_list_comb) // self.number_of_mic_splits)
+
+        # Split up the mic list into chunks of the same size
+        mic_split_list = [mic_list_comb[i * splits:(i+1) * splits]
+                          for i in range((len(mic_list_comb)+splits-1) // splits)]
+
+        return np.array([mic_split_list[i][j] for j in range(splits)
+                         for i in range(self.number_of_mic_splits)]).reshape(-1, self.mic_combinations_number)
+
+    def select_combinations(self, all_sound_data):
+        """Returns the microphone indices of the combinations to run and,
+           when they were pruned, the transformed signals used to score
+           them so they are not transformed again.
+
+           Args:
+               all_sound_data: (numpy array) the entire microphone signal data
+
+            Returns:
+                combination_indices: (numpy array) microphone indices, shape
+                                     (n_combinations, k)
+                stft_cache: (dictionary) transformed signal of each
+                            microphone, or None when nothing was pruned
+        """
+
+        combination_indices = self.get_combination_indices(len(all_sound_data))
+        if self.combination_budget is None and self.combination_threshold is None:
+            return combination_indices, None
+
+        stft_cache = self.build_stft_cache(all_sound_data)
+        return self.prune_combinations(self.get_mic_locations(all_sound_data),
+                                       combination_indices, stft_cache), stft_cache
+
+    def prune_combinations(self, mic_locations, combination_indices, stft_cache):
+        """Returns only the combinations scoring at least the combination
+           threshold, and of those at most the combination budget with the
+           highest scores, in their original order. The best combination is
+           always kept.
+
+           Args:
+               mic_locations: (numpy array) validated location of each
+                              microphone, shape (n_mics, 3)
+               combination_indices: (numpy array) microphone indices of each
+                                    combination, shape (n_combinations, k)
+               stft_cache: (dictionary) transformed signal of each microphone
+
+            Returns:
+                (numpy array) microphone indices of the combinations kept
+        """
+
+        with get_profiler().span('pruning'):
+            self.combination_scores = self.score_combinations(mic_locations, combination_indices,
+                                                              stft_cache)
+
+            keep = np.ones(len(combination_indices), dtype=bool)
+            if self.combination_threshold is not None:
+                keep &= self.combination_scores >= self.combination_threshold
+            if self.combination_budget is not None:
+                best = np.zeros_like(keep)
+                best[np.argsort(-self.combination_scores, kind='stable')[:self.combination_budget]] = True
+                keep &= best
+            if not keep.any():
+                keep[np.argmax(self.combination_scores)] = True
+
+            return combination_indices[keep]
+
+    def score_combinations(self, mic_locations, combination_indices, stft_cache):
+        """Returns a score from 0 to 1 of how informative each microphone
+           combination is likely to be, the product of a geometry score and
+           a signal score. The geometry score is the aperture of the
+           combination, relative to the widest one, times its conditioning,
+           which is 0 for collinear microphones. The signal score is the
+           mean coherence of the microphone pairs of the combination times
+           the signal to noise ratio of its noisiest microphone, relative to
+           the best microphone.
+
+           Args:
+               mic_locations: (numpy array) validated location of each
+                              microphone, shape (n_mics, 3)
+               combination_indices: (numpy array) microphone indices of each
+                                    combination, shape (n_combinations, k)
+               stft_cache: (dictionary) transformed signal of each microphone
+
+            Returns:
+                (numpy array) score of each combination
+        """
+
+        aperture, conditioning = combination_geometry(mic_locations, combination_indices)
+        geometry_score = aperture / max(aperture.max(), 1e-12) * conditioning
+
+        spectra = np.array([stft_cache["".join(['mic', str(i+1)])]
+                            for i in range(len(mic_locations))])
+        spectra = spectra[:, self.get_frequency_bins(spectra.shape[1])]
+
+        snr = self.get_channel_snr(spectra)
+        snr_score = snr / snr.max() if snr.max() > 0 else np.ones_like(snr)
+        coherence = self.get_coherence(spectra)
+
+        pair_coherence = np.mean([coherence[combination_indices[:, a], combination_indices[:, b]]
+                                  for a, b in combinations(range(combination_indices.shape[1]), 2)],
+                                 axis=0)
+        signal_score = pair_coherence * snr_score[combination_indices].min(axis=1)
+
+        return geometry_score * signal_score
+
+    def get_frequency_bins(self, number_of_bins):
+        """Returns the frequency bins inside the frequency range, or every
+           bin when none are."""
+        frequencies = np.arange(number_of_bins) * self.sampling_rate / self.fft_size
+        in_range = (frequencies >= self.freq_range[0]) & (frequencies <= self.freq_range[1])
+        return in_range if in_range.any() else np.ones(number_of_bins, dtype=bool)
+
+    @staticmethod
+    def get_channel_snr(spectra):
+        """Returns the signal to noise ratio (in dB) of each microphone, the
+           ratio of its loud frames (95th percentile of the frame energy) to
+           its quiet frames (5th percentile).
 
-        if self.num_sources > 1:
-            return self.split_and_conquer(centroid, cartesian_coordinates)
-        return self.radius * cartesian_coordinates.T + np.array(centroid)[np.newaxis, :]
+           Args:
+               spectra: (numpy array) transformed signal of each microphone,
+                        shape (n_mics, n_bins, n_frames)
+
+            Returns:
+                (numpy array) signal to noise ratio of each microphone
+        """
+
+        energy = np.sum(np.abs(spectra) ** 2, axis=1)
+        loud, quiet = np.percentile(energy, [95, 5], axis=1)
+        return np.maximum(10 * np.log10(np.maximum(loud, 1e-20) / np.maximum(quiet, 1e-20)), 0)
+
+    @staticmethod
+    def get_coherence(spectra):
+        """Returns the magnitude squared coherence of every pair of
+           microphones, averaged over the frequency bins.
+
+           Args:
+               spectra: (numpy array) transformed signal of each microphone,
+                        shape (n_mics, n_bins, n_frames)
+
+            Returns:
+                (numpy array) coherence of each pair, shape (n_mics, n_mics)
+        """
+
+        cross = np.einsum('ift,jft->ijf', spectra, np.conj(spectra)) / spectra.shape[2]
+        power = np.real(np.einsum('iif->if', cross))
+        coherence = np.abs(cross) ** 2 / np.maximum(power[:, np.newaxis, :] * power[np.newaxis, :, :],
+                                                    1e-20)
+        return coherence.mean(axis=2)
+
+    def map_combinations(self, all_sound_data, func, combination_indices=None,
+                         stft_cache=None):
+        """Returns the output of the function for every microphone
+           combination. Microphone combinations are split up into equal
+           chunks and to be used in multiple threads to decrease time to find
+           estimates. Each microphone signal is transformed only once and
+           placed in shared memory, so the workers only receive microphone
+           indices. When a profiler is active, the spans recorded in the
+           workers are merged into it, and the time spent outside the workers
+           (dispatch, pickling and waiting) is recorded as ipc.
+
+           Args:
+               all_sound_data: (numpy array) the entire microphone signal data
+               func: the function to run on each combination, called with the
+                     shared signals and the microphone indices
+               combination_indices: (numpy array) microphone indices of each
+                                    combination to run. Default: those from
+                                    get_combination_indices
+               stft_cache: (dictionary) transformed signal of each
+                           microphone, when already built. Default: None
+
+            Returns:
+                (list) the output for each microphone combination
+        """
+
+        mics = ["".join(['mic', str(i+1)]) for i in range(len(all_sound_data))]
+
+        if combination_indices is None:
+            combination_indices = self.get_combination_indices(len(mics))
+
+        if stft_cache is None:
+            stft_cache = self.build_stft_cache(all_sound_data)
+        spectra = np.array([stft_cache[mic] for mic in mics])
+        mic_locations = self.get_mic_locations(all_sound_data)
+
+        profiler = get_profiler()
+        if profiler.enabled:
+            func = ProfiledCall(func, 'combination')
+
+        with SharedArray.from_array(spectra) as shared_spectra, \
+                SharedArray.from_array(mic_locations) as shared_locations:
+            shared_signals = (shared_spectra, shared_locations)
+            sound_data_and_each_mic_split = ((shared_signals, tuple(combination))
+                                             for combination in combination_indices.tolist())
+            start = time.perf_counter()
+            output = MultiProcessingWithReturnValue(func,
+                                                    *sound_data_and_each_mic_split).pooled(self.pool)
+            pool_seconds = time.perf_counter() - start
+
+        if not profiler.enabled:
+            return output
+
+        busy = {}
+        for _, records in output:
+            profiler.extend(records)
+            for record in records:
+                if record['stage'] == 'combination':
+                    busy[record['worker']] = busy.get(record['worker'], 0.0) + record['seconds']
+        profiler.add('ipc', max(pool_seconds - max(busy.values(), default=0.0), 0.0))
+
+        return [result for result, _ in output]
 
     def process_potential_estimates(self, all_sound_data):
         """Returns all the estimates for all the microphone combinations
            and re-centers according to the room dimension specifications.
-           Microphone combinations are split up into equal chunks and
-           to be used in multiple threads to decrease time to find estimates.
 
            Args:
                all_sound_data: (numpy array) the entire microphone signal data
@@ -252,38 +884,253 @@ class SoundSourceLocation:
                 to the room specifications.
         """
 
-        mics = ["".join(['mic', str(i+1)]) for i in range(len(list(all_sound_data.keys())))]
+        origins, directions = self.locate_rays(all_sound_data)
+        potential_sources = self.expand_rays(origins, directions)
 
-        mic_list_comb = list(combinations(mics, self.mic_combinations_number))
+        # Re-center the points, add the x,y,z location of the center of the
+        # room to the obtained point. Format: (Width, Depth, Length)
+        potential_sources += self.set_room_dimensions() / 2
+        self.rays = (origins + self.set_room_dimensions() / 2, directions)
+        self.ray_labels = None
 
-        splits = validate_splits(len(mic_list_comb) // self.number_of_mic_splits)
+        return potential_sources
 
-        # Split up the mic list into chunks of the same size
-        mic_split_list = [mic_list_comb[i * splits:(i+1) * splits]
-                          for i in range((len(mic_list_comb)+splits-1) // splits)]
+    def store_potential_estimates(self, all_sound_data, store, rays_per_chunk=1000,
+                                  append=False):
+        """Writes all the estimates to an on-disk candidate store, a chunk
+           of rays at a time, instead of building them in memory. The
+           estimates are re-centered the same way as in
+           process_potential_estimates.
 
-        sound_data_and_each_mic_split = ((all_sound_data, mic_split_list[i][j])
-                                         for j in range(splits)
-                                         for i in range(self.number_of_mic_splits))
-        all_estimates = np.array(MultiProcessingWithReturnValue(self.get_estimates,
-                                                                *sound_data_and_each_mic_split).pooled())
+           Args:
+               all_sound_data: (numpy array) the entire microphone signal data
+               store: (CandidateStore) where to write the estimates
+               rays_per_chunk: (integer) number of rays expanded at a time.
+                               Default: 1000
+               append: (boolean) adds the estimates to those already in the
+                       store. Default: False
 
-        # Reshape them to (_, 3) which is proper format
-        potential_sources = np.reshape(all_estimates,
-                                       (all_estimates.shape[0]*all_estimates.shape[1],
-                                        all_estimates.shape[2]))
+            Returns:
+                (CandidateStore) the store
 
-        # Re-center the points, add the x,y,z location of the center of the
-        # room to the obtained point
+            Raises:
+                ValueError: if the store already holds estimates, e.g. of an
+                            earlier run into the same directory, and append
+                            is False
+        """
+
+        if len(store) and not append:
+            raise ValueError("Error. The candidate store already holds estimates. "
+                             "Clear it first, or pass append=True.")
+
+        origins, directions = self.locate_rays(all_sound_data)
         center_of_room = self.set_room_dimensions() / 2
+        self.rays = (origins + center_of_room, directions)
+
+        for start in range(0, len(directions), rays_per_chunk):
+            potential_sources = self.expand_rays(origins[start:start + rays_per_chunk],
+                                                 directions[start:start + rays_per_chunk])
+            potential_sources += center_of_room
+            store.append(potential_sources)
+
+        return store
+
+    def locate_rays(self, all_sound_data):
+        """Returns the rays of every microphone combination, relative to the
+           center of the room. The workers only find the directions, the
+           rays are put together afterwards.
+
+           Args:
+               all_sound_data: (numpy array) the entire microphone signal data
+
+            Returns:
+                origins: (numpy array) start of each ray, shape (n_rays, 3)
+                directions: (numpy array) direction of each ray, shape
+                            (n_rays, 3)
+        """
+
+        combination_indices, stft_cache = self.select_combinations(all_sound_data)
+        all_directions = self.map_combinations(all_sound_data, self.locate_combination,
+                                               combination_indices, stft_cache)
+
+        return self.get_rays(self.get_mic_locations(all_sound_data), combination_indices,
+                             [azimuth for _, azimuth, _ in all_directions],
+                             [colatitude for _, _, colatitude in all_directions])
+
+    def process_labeled_estimates(self, all_sound_data):
+        """Returns all the estimates like process_potential_estimates, along
+           with the source each one belongs to, so several sources are found
+           in one pass. The rays of each source are expanded separately.
+
+           Args:
+               all_sound_data: (numpy array) the entire microphone signal data
+
+            Returns:
+                potential_sources: (numpy array) the potential estimates
+                                   re-centered according to the room
+                                   specifications, grouped by source
+                labels: (numpy array) source label of each estimate
+        """
+
+        origins, directions, ray_labels = self.locate_labeled_rays(all_sound_data)
+
+        potential_sources, labels = [], []
+        for label in range(self.num_sources):
+            potential_sources.append(self.expand_rays(origins[ray_labels == label],
+                                                      directions[ray_labels == label]))
+            labels.append(np.full(len(potential_sources[-1]), label))
+
+        potential_sources = np.vstack(potential_sources)
+        potential_sources += self.set_room_dimensions() / 2
+        self.rays = (origins + self.set_room_dimensions() / 2, directions)
+        self.ray_labels = ray_labels
+
+        return potential_sources, np.concatenate(labels)
+
+    def locate_labeled_rays(self, all_sound_data):
+        """Returns the rays of every microphone combination, like
+           locate_rays, and the source label of each ray. See label_rays.
+
+           Args:
+               all_sound_data: (numpy array) the entire microphone signal data
+
+            Returns:
+                origins: (numpy array) start of each ray, shape (n_rays, 3)
+                directions: (numpy array) direction of each ray, shape
+                            (n_rays, 3)
+                labels: (numpy array) source label of each ray
+        """
+
+        combination_indices, stft_cache = self.select_combinations(all_sound_data)
+        all_directions = self.map_combinations(all_sound_data, self.locate_combination,
+                                               combination_indices, stft_cache)
+
+        origins, directions = self.get_rays(self.get_mic_locations(all_sound_data),
+                                            combination_indices,
+                                            [azimuth for _, azimuth, _ in all_directions],
+                                            [colatitude for _, _, colatitude in all_directions])
+        counts = [len(np.atleast_1d(azimuth)) for _, azimuth, _ in all_directions]
 
-        # Reconvert all the potential source points
-        # Format: (Width, Depth, Length)
-        return np.add(center_of_room, potential_sources)
+        return origins, directions, self.label_rays(directions, counts)
 
-    def run_estimates(self, *args):
+    def label_rays(self, directions, counts):
+        """Returns the source label of each ray. Each combination finds its
+           sources in its own order, so its directions are matched to the
+           mean direction of each source so far, taking the assignment with
+           the largest sum of cosines. The sources are first ordered as
+           found by the first combination that finds all of them.
+
+           Args:
+               directions: (numpy array) unit direction of each ray, grouped
+                           by combination, shape (n_rays, 3)
+               counts: (list) number of rays of each combination
+
+            Returns:
+                (numpy array) label of each ray, from 0 to num_sources - 1
+
+            Raises:
+                ValueError: if a combination has more rays than num_sources
+        """
+
+        if any(count > self.num_sources for count in counts):
+            raise ValueError("Error. A combination found more directions than "
+                             "the number of sources.")
+
+        offsets = np.cumsum([0] + list(counts))
+        labels = np.empty(len(directions), dtype=int)
+
+        complete = [i for i, count in enumerate(counts) if count == self.num_sources]
+        if not complete:
+            # Nothing to match against, keep the order each combination found
+            return np.concatenate([np.arange(count) for count in counts]).astype(int)
+
+        first = complete[0]
+        sums = directions[offsets[first]:offsets[first + 1]].copy()
+
+        for i, count in enumerate(counts):
+            block = directions[offsets[i]:offsets[i + 1]]
+            means = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+            cosines = block @ means.T
+
+            assignment = max(permutations(range(self.num_sources), count),
+                             key=lambda labels_: cosines[np.arange(count), labels_].sum())
+
+            labels[offsets[i]:offsets[i + 1]] = assignment
+            if i != first:
+                np.add.at(sums, list(assignment), block)
+
+        return labels
+
+    def process_potential_segments(self, all_sound_data):
+        """Returns one ray segment per source direction and microphone
+           combination instead of hundreds of points along each ray. Each
+           record holds the centroid (origin) re-centered according to the
+           room specifications, the unit direction, and the range of
+           distances along the ray that are inside the room. Rays that miss
+           the room are left out.
+
+           Args:
+               all_sound_data: (numpy array) the entire microphone signal data
+
+            Returns:
+                (numpy array) records with the RAY_SEGMENT_DTYPE format
+        """
+
+        origins, directions = self.locate_rays(all_sound_data)
+
+        # Re-center the centroids, add the x,y,z location of the center of
+        # the room. Format: (Width, Depth, Length)
+        room_dim = self.set_room_dimensions()
+        origins = origins + room_dim / 2
+        self.rays = (origins, directions)
+        self.ray_labels = None
+
+        with get_profiler().span('ray_expansion'):
+            t_min, t_max = ray_box_intervals(origins, directions, np.zeros(3),
+                                             room_dim, t_max=self.radius[-1, 0])
+            return make_ray_segments(origins, directions, t_min, t_max)
+
+    @staticmethod
+    def locate_source(segments, robust=True):
+        """Returns the point closest to all the ray segments, only counting
+           the part of each ray inside the room, see
+           segment_closest_approach.
+
+           Args:
+               segments: (numpy array) records with the RAY_SEGMENT_DTYPE
+                         format
+               robust: (boolean) reweight the rays so outliers count less.
+                       Default is True
+
+            Returns:
+                (numpy array) the source location
+        """
+
+        with get_profiler().span('clustering'):
+            return segment_closest_approach(segments, robust=robust)
+
+    def run_estimates(self, *args, store=None, labeled=False, append=False,
+                      segments=False):
         """Runs process potential estimates to extract the potential
-           locations of the sound source."""
+           locations of the sound source. With segments, the ray segments
+           of process_potential_segments are yielded instead, for
+           locate_source. When a CandidateStore is given,
+           the estimates are written to it and the store is yielded, see
+           store_potential_estimates for append. When
+           labeled, the estimates and the source label of each are
+           yielded, see process_labeled_estimates. In-memory estimates
+           are read from the result cache when one is set."""
 
         mic_info = args[0]
-        yield self.process_potential_estimates(mic_info)
+        if segments:
+            if store is not None or labeled:
+                raise ValueError("Error. Ray segments are neither labeled nor stored.")
+            yield self.process_potential_segments(mic_info)
+        elif labeled:
+            if store is not None:
+                raise ValueError("Error. Labeled estimates are only kept in memory.")
+            yield self.get_cached_estimates(mic_info, labeled=True)
+        elif store is not None:
+            yield self.store_potential_estimates(mic_info, store, append=append)
+        else:
+            yield self.get_cached_estimates(mic_info)
@@ -0,0 +1,243 @@
+# !/usr/bin/env python
+"""In this script, srp_phat will search the room volume for the sound source
+with the steered response power and phase transform (SRP-PHAT)."""
+
+from itertools import combinations
+
+import numpy as np
+
+from scipy.ndimage import maximum_filter
+
+from scripts.profiling import get_profiler
+from scripts.sound_source_localization import SoundSourceLocation
+from scripts.utils import LRUCache
+
+
+# Time difference of arrival tables, keyed by the microphone geometry, the
+# room grid and the lag resolution. Built once per geometry and reused for
+# every later recording.
+TDOA_CACHE = LRUCache(maxsize=16)
+
+
+class SRPPHATSoundSourceLocation(SoundSourceLocation):
+    """SRPPHATSoundSourceLocation finds the sound source by steering the
+       microphones to every point of a 3-D grid over the room, rather than
+       to far-field directions, which suits sources as close to the array
+       as heart sounds. The time difference of arrival of every microphone
+       pair at every grid point is precomputed once per geometry as a lag
+       lookup table. Each recording then only needs the batched GCC-PHAT
+       of every pair and a gather from the table.
+
+       Attributes:
+           grid_spacing: (float) distance between neighbouring grid points
+                         in meters. Default: 0.01
+           interpolation: (integer) factor by which the cross-correlations
+                          are upsampled, so delays are resolved to a
+                          fraction of a sample. Default: 4
+           grid_shape: (tuple) number of grid points along each dimension
+           grid: (numpy array) grid points relative to the center of the
+                 room, shape (n_points, 3)
+           power: (numpy array) steered response power at each grid point
+                  of the last recording
+    """
+
+    def __init__(self, grid_spacing=0.01, interpolation=4, **kwargs):
+        """Initializes SRPPHATSoundSourceLocation with grid_spacing,
+           interpolation, and kwargs."""
+
+        SoundSourceLocation.__init__(self, 'SRP', **kwargs)
+
+        if grid_spacing <= 0:
+            raise ValueError("Error. Grid spacing must be positive.")
+        if interpolation < 1:
+            raise ValueError("Error. Interpolation must be at least 1.")
+
+        self.grid_spacing = grid_spacing
+        self.interpolation = int(interpolation)
+
+        self.grid_shape, self.grid = self.get_room_grid()
+        self.power = None
+
+    def get_parameters(self):
+        """Returns the parameters of SoundSourceLocation.get_parameters and
+           the grid spacing and interpolation."""
+        parameters = SoundSourceLocation.get_parameters(self)
+        parameters.update(grid_spacing=self.grid_spacing, interpolation=self.interpolation)
+        return parameters
+
+    def get_room_grid(self):
+        """Returns the shape of the grid and its points, spaced evenly over
+           the room and relative to its center like the microphone
+           locations."""
+
+        half_room = self.set_room_dimensions() / 2
+        axes = [np.arange(-half, half + self.grid_spacing / 2, self.grid_spacing)
+                for half in half_room]
+        grid_shape = tuple(len(axis) for axis in axes)
+
+        return grid_shape, np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+
+    @property
+    def number_of_lags(self):
+        """Length of the upsampled cross-correlation of each pair."""
+        return self.fft_size * self.interpolation
+
+    def get_tdoa_table(self, mic_locations):
+        """Returns the lag lookup table for the microphone geometry, from
+           the TDOA cache when it was already built. The lookup is timed as
+           a doa_setup span labeled with whether it was cached.
+
+            Args:
+                mic_locations: (numpy array) location of each microphone,
+                               shape (n_mics, 3)
+
+            Returns:
+                pairs: (numpy array) microphone indices of each pair
+                table: (numpy array) lag of each pair at each grid point,
+                       shape (n_pairs, n_points)
+        """
+
+        key = (tuple(np.ravel(mic_locations).tolist()), self.grid_shape,
+               self.grid_spacing, tuple(self.set_room_dimensions().tolist()),
+               self.sampling_rate, self.sound_speed, self.number_of_lags)
+
+        with get_profiler().span('doa_setup', cached=key in TDOA_CACHE):
+            return TDOA_CACHE.get_or_create(key, lambda: self.build_tdoa_table(mic_locations))
+
+    def check_pair_delays(self, pairs, mic_locations):
+        """Checks that no microphone pair can be further apart in time than
+           half the cross-correlation, past which its lags would wrap around
+           and alias to the lags of the opposite sign. No grid point is
+           further apart in time for a pair than the pair itself.
+
+            Args:
+                pairs: (numpy array) microphone indices of each pair
+                mic_locations: (numpy array) location of each microphone,
+                               shape (n_mics, 3)
+
+            Raises:
+                ValueError: When the largest pair delay reaches half the FFT
+                            size.
+        """
+
+        spacing = np.linalg.norm(mic_locations[pairs[:, 0]] - mic_locations[pairs[:, 1]], axis=1)
+        max_delay = spacing.max() / self.sound_speed * self.sampling_rate
+
+        if max_delay >= self.fft_size / 2:
+            needed = int(2 ** np.ceil(np.log2(2 * max_delay + 1)))
+            raise ValueError("Error. Microphone pairs are up to {:.1f} samples apart, which "
+                             "needs an FFT size of at least {}, not {}. Increase the FFT "
+                             "size or check the sound speed.".format(max_delay, needed,
+                                                                     self.fft_size))
+
+    def build_tdoa_table(self, mic_locations):
+        """Returns the microphone pairs and the lag, in upsampled samples,
+           of each pair at each grid point. A negative delay wraps around
+           to the end of the cross-correlation.
+
+            Args:
+                mic_locations: (numpy array) location of each microphone,
+                               shape (n_mics, 3)
+
+            Returns:
+                pairs: (numpy array) microphone indices of each pair
+                table: (numpy array) lag of each pair at each grid point,
+                       shape (n_pairs, n_points)
+
+            Raises:
+                ValueError: When a pair's delay reaches half the FFT size.
+        """
+
+        pairs = np.array(list(combinations(range(len(mic_locations)), 2)))
+        self.check_pair_delays(pairs, mic_locations)
+
+        # Distance from every microphone to every grid point
+        distances = np.linalg.norm(self.grid[np.newaxis, :, :] -
+                                   mic_locations[:, np.newaxis, :], axis=2)
+
+        tdoa = (distances[pairs[:, 0]] - distances[pairs[:, 1]]) / self.sound_speed
+        lags = np.rint(tdoa * self.sampling_rate * self.interpolation).astype(np.int64)
+
+        return pairs, np.mod(lags, self.number_of_lags).astype(np.int32)
+
+    def get_cross_correlations(self, spectra, pairs):
+        """Returns the GCC-PHAT of every microphone pair at once. Each
+           frame's cross-spectrum keeps only its phase, the frames are
+           averaged, and the bins outside the frequency range are dropped.
+
+            Args:
+                spectra: (numpy array) short time fourier transform of each
+                         microphone with the format: microphones, frequency
+                         bins, and frames
+                pairs: (numpy array) microphone indices of each pair
+
+            Returns:
+                (numpy array) upsampled cross-correlation of each pair, shape
+                (n_pairs, number_of_lags)
+        """
+
+        cross_spectra = spectra[pairs[:, 0]] * np.conj(spectra[pairs[:, 1]])
+        cross_spectra /= np.maximum(np.abs(cross_spectra), 1e-14)
+        cross_spectra = cross_spectra.mean(axis=2)
+
+        frequencies = np.arange(cross_spectra.shape[1]) * self.sampling_rate / self.fft_size
+        in_range = (frequencies >= self.freq_range[0]) & (frequencies <= self.freq_range[1])
+        cross_spectra[:, ~in_range] = 0
+
+        return np.fft.irfft(cross_spectra, n=self.number_of_lags, axis=1)
+
+    def steered_power(self, spectra, mic_locations):
+        """Returns the steered response power at every grid point, the sum
+           over all pairs of each pair's cross-correlation at the lag of
+           that grid point.
+
+            Args:
+                spectra: (numpy array) short time fourier transform of each
+                         microphone with the format: microphones, frequency
+                         bins, and frames
+                mic_locations: (numpy array) location of each microphone,
+                               shape (n_mics, 3)
+
+            Returns:
+                (numpy array) power at each grid point
+        """
+
+        pairs, table = self.get_tdoa_table(mic_locations)
+
+        with get_profiler().span('doa'):
+            cross_correlations = self.get_cross_correlations(spectra, pairs)
+            return np.take_along_axis(cross_correlations, table, axis=1).sum(axis=0)
+
+    def find_peaks(self, power):
+        """Returns the indices of the grid points with the highest power
+           that are also local maxima, one for each source."""
+
+        if self.num_sources == 1:
+            return np.array([np.argmax(power)])
+
+        volume = power.reshape(self.grid_shape)
+        peaks = np.flatnonzero(volume == maximum_filter(volume, size=3, mode='nearest'))
+
+        return peaks[np.argsort(power[peaks])[::-1][:self.num_sources]]
+
+    def process_potential_estimates(self, all_sound_data):
+        """Returns the grid point of highest power for each source,
+           re-centered according to the room dimension specifications.
+
+           Args:
+               all_sound_data: (numpy array) the entire microphone signal data
+
+            Returns:
+                numpy array of the source locations, one row per source
+        """
+
+        mic_locations = self.get_mic_locations(all_sound_data)
+
+        stft_cache = self.build_stft_cache(all_sound_data)
+        spectra = np.array([stft_cache["".join(['mic', str(i+1)])]
+                            for i in range(len(mic_locations))])
+
+        self.power = self.steered_power(spectra, mic_locations)
+
+        # Re-center the points. Format: (Width, Depth, Length)
+        return self.grid[self.find_peaks(self.power)] + self.set_room_dimensions() / 2
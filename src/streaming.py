@@ -0,0 +1,226 @@
+# !/usr/bin/env python
+"""In this script, streaming will localize the sound source block by block
+while the microphone signals are still being recorded."""
+
+from itertools import combinations
+
+import numpy as np
+import pyroomacoustics as pra
+
+from scripts.sound_source_localization import SoundSourceLocation
+from scripts.validations import validate_mic_locations
+
+
+class StreamingSoundSourceLocation(SoundSourceLocation):
+    """StreamingSoundSourceLocation finds the direction of arrival of a sound
+       source from fixed-size blocks of audio. Each hop of the short time
+       fourier transform updates a running spatial covariance with
+       exponential forgetting, so memory stays bounded no matter how long
+       the recording is. Only SRP (PHAT weighted) and MUSIC are supported.
+
+       Like the other estimators, parameters such as sound_speed, freq_range,
+       n_grid and fft_size can be set after construction. The arrays derived
+       from them (hop, combinations, centroids, freq_bins, grid and steering)
+       are rebuilt at the next block when any of them changed, and the
+       stream starts over, see reset.
+
+       Attributes:
+           mic_locations: (numpy array) location of each microphone, one row
+                          per microphone in [x,y,z] order
+           forgetting_factor: (float) weight of the previous covariance at
+                              each hop, between 0 and 1. Default: 0.95
+           hop: (integer) number of samples between frames
+           combinations: (numpy array) microphone indices of each combination
+           centroids: (numpy array) center of each combination
+           freq_bins: (numpy array) frequency bins in the frequency range
+           grid: (GridSphere) candidate directions
+           steering: (numpy array) steering vectors with the format:
+                     combinations, frequency bins, microphones and directions
+           covariance: (numpy array) running spatial covariance of every
+                       microphone for each frequency bin
+           frames_processed: (integer) number of frames seen so far
+    """
+
+    def __init__(self, algo_name, mic_locations, forgetting_factor=0.95,
+                 **kwargs):
+        """Initializes StreamingSoundSourceLocation with algo_name,
+           mic_locations, forgetting_factor, and kwargs."""
+
+        SoundSourceLocation.__init__(self, algo_name, **kwargs)
+
+        if self.algo_name not in ('SRP', 'MUSIC'):
+            raise ValueError("Error. Streaming only supports SRP and MUSIC.")
+        if not 0 < forgetting_factor < 1:
+            raise ValueError("Error. Forgetting factor must be between 0 and 1.")
+
+        self.mic_locations = validate_mic_locations(mic_locations)
+        self.forgetting_factor = forgetting_factor
+
+        self._setup_key = None
+        self.update_setup()
+
+        self._buffer = None
+        self.covariance = None
+        self.frames_processed = 0
+        self.reset()
+
+    def update_setup(self):
+        """Builds the arrays derived from the microphone locations and the
+           parameters, unless none of them changed since the last time.
+
+           Returns:
+               (boolean) whether the arrays were rebuilt
+        """
+
+        key = (np.asarray(self.mic_locations, dtype=float).tobytes(),
+               self.mic_combinations_number, self.sampling_rate, self.fft_size,
+               self.sound_speed, tuple(self.freq_range), self.n_grid)
+        if key == self._setup_key:
+            return False
+        self._setup_key = key
+
+        self.hop = self.fft_size // 2
+
+        self.combinations = np.array(list(combinations(range(len(self.mic_locations)),
+                                                       self.mic_combinations_number)))
+        self.centroids = self.get_centroids(self.mic_locations, self.combinations)
+
+        # Same frequency bins as pyroomacoustics picks for the range
+        low, high = (int(np.round(f / self.sampling_rate * self.fft_size))
+                     for f in self.freq_range)
+        self.freq_bins = np.arange(max(low, 0), min(high, self.fft_size // 2 + 1))
+
+        self.grid = pra.doa.GridSphere(n_points=self.n_grid)
+        self.steering = self._steering_vectors()
+
+        return True
+
+    def _steering_vectors(self):
+        """Returns the far-field steering vectors of every combination for
+           every frequency bin and direction on the grid."""
+
+        omega = 2 * np.pi * self.sampling_rate * self.freq_bins / self.fft_size
+        directions = np.vstack([self.grid.x, self.grid.y, self.grid.z])
+
+        # Time of flight, shape (combinations, microphones, directions)
+        tau = self.mic_locations[self.combinations] @ directions / self.sound_speed
+
+        return np.exp(1j * omega[np.newaxis, :, np.newaxis, np.newaxis] * tau[:, np.newaxis, :, :])
+
+    def reset(self):
+        """Forgets the buffered samples and the running covariance."""
+        self._buffer = np.zeros((len(self.mic_locations), 0))
+        self.covariance = np.zeros((len(self.freq_bins), len(self.mic_locations),
+                                    len(self.mic_locations)), dtype=complex)
+        self.frames_processed = 0
+
+    def _update_covariance(self, frame):
+        """Adds one frame of every microphone to the running covariance."""
+
+        spectrum = np.fft.rfft(frame, axis=1)[:, self.freq_bins].T
+
+        # PHAT weighting: only the phase of each bin is kept for SRP
+        if self.algo_name == 'SRP':
+            spectrum = spectrum / np.maximum(np.abs(spectrum), 1e-14)
+
+        outer = spectrum[:, :, np.newaxis] * np.conj(spectrum)[:, np.newaxis, :]
+        self.covariance = (self.forgetting_factor * self.covariance +
+                           (1 - self.forgetting_factor) * outer)
+        self.frames_processed += 1
+
+    def steered_power(self):
+        """Returns the SRP power or MUSIC pseudo-spectrum of each combination
+           over the grid, with the format: combinations by directions."""
+
+        # Covariance of each combination, shape (combinations, freq, mics, mics)
+        sub_covariance = self.covariance[:, self.combinations[:, :, np.newaxis],
+                                         self.combinations[:, np.newaxis, :]].transpose(1, 0, 2, 3)
+
+        if self.algo_name == 'SRP':
+            return np.einsum('cfig,cfij,cfjg->cg', np.conj(self.steering),
+                             sub_covariance, self.steering).real
+
+        # MUSIC: the eigenvectors of the smallest eigenvalues span the noise
+        noise_subspace = np.linalg.eigh(sub_covariance)[1][..., :-self.num_sources]
+        projection = np.einsum('cfmk,cfmg->cfkg', np.conj(noise_subspace), self.steering)
+        denominator = np.maximum(np.sum(np.abs(projection) ** 2, axis=2), 1e-14)
+
+        return np.sum(1.0 / denominator, axis=1) / len(self.freq_bins)
+
+    def _locate(self):
+        """Returns the azimuth and co-latitude of each combination and the
+           candidate points along them."""
+
+        power = self.steered_power()
+
+        if self.num_sources == 1:
+            peaks = np.argmax(power, axis=1)[:, np.newaxis]
+        else:
+            peaks = []
+            for combination_power in power:
+                self.grid.set_values(combination_power)
+                peaks.append(self.grid.find_peaks(k=self.num_sources))
+            peaks = np.array(peaks)
+
+        azimuth_recon = self.grid.azimuth[peaks]
+        colatitude_recon = self.grid.colatitude[peaks]
+
+        candidates = self.estimate_combinations(self.mic_locations, self.combinations,
+                                                azimuth_recon, colatitude_recon)
+
+        # Re-center the points. Format: (Width, Depth, Length)
+        return azimuth_recon, colatitude_recon, candidates + self.set_room_dimensions() / 2
+
+    def process_block(self, block):
+        """Returns an update for every hop completed by the new block of
+           samples. Samples that do not yet fill a frame are kept for the
+           next block.
+
+           Args:
+               block: (numpy array) new samples with the format: microphones
+                      by samples
+
+           Returns:
+               (list) dictionary for each hop with the frame number, the
+               azimuth and co-latitude of each combination (in radians) and
+               the candidate points
+
+           Raises:
+               ValueError: if the block does not have one row per microphone
+        """
+
+        block = np.atleast_2d(block)
+        if block.shape[0] != len(self.mic_locations):
+            raise ValueError("Error. Block must have one row per microphone.")
+
+        # A parameter changed since the last block
+        if self.update_setup():
+            self.reset()
+
+        self._buffer = np.hstack([self._buffer, block])
+
+        updates, start = [], 0
+        while start + self.fft_size <= self._buffer.shape[1]:
+            self._update_covariance(self._buffer[:, start:start + self.fft_size])
+            azimuth_recon, colatitude_recon, candidates = self._locate()
+            updates.append({'frame': self.frames_processed,
+                            'azimuth': azimuth_recon,
+                            'colatitude': colatitude_recon,
+                            'candidates': candidates})
+            start += self.hop
+
+        # Only keep the overlap needed for the next frame
+        self._buffer = self._buffer[:, start:]
+
+        return updates
+
+    def run_stream(self, blocks):
+        """Yields an update after every hop of the stream of blocks.
+
+           Args:
+               blocks: (iterable) numpy arrays with the format: microphones
+                       by samples
+        """
+
+        for block in blocks:
+            yield from self.process_block(block)
@@ -0,0 +1,145 @@
+import csv
+import json
+import os
+import tempfile
+import unittest
+import numpy as np
+import scipy.io as sio
+
+from scripts.batch import BatchRunner, find_recordings, read_manifest, localize_file
+
+
+def fake_job(path):
+    if 'broken' in path:
+        raise ValueError("Error. Broken recording.")
+    return [[path, 'SRP', 0, 0.1, 0.2, 0.3, 5, 0.0]]
+
+
+def read_rows(path):
+    with open(path, newline='') as output_file:
+        return list(csv.reader(output_file))
+
+
+class BatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.output = os.path.join(self.directory.name, 'results.csv')
+        self.test_recordings = ["".join(['arctic_a000', str(i), '.wav']) for i in range(1, 6)]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+
+class FindRecordingsTestCase(BatchTestCase):
+    """
+    Test that recordings are listed from a manifest or a glob pattern.
+    """
+
+    def test_manifest(self):
+        manifest = os.path.join(self.directory.name, 'manifest.txt')
+        with open(manifest, 'w') as manifest_file:
+            manifest_file.write("# corpus\na.wav\n\nsub/b.wav\na.wav\n")
+
+        self.assertEqual(read_manifest(manifest),
+                         [os.path.join(self.directory.name, name)
+                          for name in ('a.wav', 'sub/b.wav', 'a.wav')])
+        self.assertEqual(len(find_recordings(manifest=manifest)), 2)
+
+    def test_glob(self):
+        for name in ('b.wav', 'a.wav', 'c.mat'):
+            open(os.path.join(self.directory.name, name), 'w').close()
+        self.assertEqual([os.path.basename(path) for path in
+                          find_recordings(pattern=os.path.join(self.directory.name, '*.wav'))],
+                         ['a.wav', 'b.wav'])
+
+    def test_neither(self):
+        with self.assertRaises(ValueError):
+            find_recordings()
+
+
+class BatchRunnerTestCase(BatchTestCase):
+    """
+    Test that jobs are streamed into one csv file and resumed from the
+    checkpoint.
+    """
+
+    def test_runs_every_recording(self):
+        runner = BatchRunner(self.test_recordings, self.output, job=fake_job, jobs=2)
+        self.assertEqual(runner.run(), 5)
+
+        rows = read_rows(self.output)
+        self.assertEqual(rows[0][0], 'file')
+        self.assertEqual(sorted(row[0] for row in rows[1:]), self.test_recordings)
+
+    def test_failed_recording_is_retried(self):
+        runner = BatchRunner(self.test_recordings + ['broken.wav'], self.output,
+                             job=fake_job, jobs=2)
+        self.assertEqual(runner.run(), 5)
+        self.assertIn('broken.wav', runner.failures)
+
+        runner = BatchRunner(self.test_recordings + ['broken.wav'], self.output,
+                             job=fake_job, jobs=2)
+        self.assertEqual(runner.run(), 0)
+        self.assertEqual(list(runner.failures), ['broken.wav'])
+
+    def test_resume_after_crash(self):
+        BatchRunner(self.test_recordings[:2], self.output, job=fake_job, jobs=1).run()
+
+        # Rows of an interrupted job and half a checkpoint line
+        with open(self.output, 'a') as output_file:
+            output_file.write('interrupted.wav,SRP,0')
+        with open(".".join([self.output, 'checkpoint']), 'a') as checkpoint_file:
+            checkpoint_file.write('{"file": "interr')
+
+        runner = BatchRunner(self.test_recordings, self.output, job=fake_job, jobs=2)
+        self.assertEqual(runner.run(), 3)
+
+        rows = read_rows(self.output)
+        self.assertEqual(sorted(row[0] for row in rows[1:]), self.test_recordings)
+        with open(runner.checkpoint) as checkpoint_file:
+            self.assertEqual(len([json.loads(line) for line in checkpoint_file]), 5)
+
+    def test_output_without_checkpoint(self):
+        with open(self.output, 'w') as output_file:
+            output_file.write('file,method\nearlier.wav,SRP\n')
+
+        with self.assertRaises(FileExistsError):
+            BatchRunner(self.test_recordings, self.output, job=fake_job, jobs=1).run()
+        self.assertEqual(read_rows(self.output)[1], ['earlier.wav', 'SRP'])
+
+    def test_header_without_checkpoint(self):
+        BatchRunner(self.test_recordings[:1], self.output, job=fake_job, jobs=1).run()
+        with open(self.output, newline='') as output_file:
+            header = output_file.readline()
+        with open(self.output, 'w', newline='') as output_file:
+            output_file.write(header)
+        os.remove(".".join([self.output, 'checkpoint']))
+
+        BatchRunner(self.test_recordings, self.output, job=fake_job, jobs=1).run()
+        self.assertEqual(len(read_rows(self.output)), 6)
+
+    def test_invalid_jobs(self):
+        with self.assertRaises(ValueError):
+            BatchRunner(self.test_recordings, self.output, job=fake_job, jobs=-1)
+
+
+class LocalizeFileTestCase(BatchTestCase):
+    """
+    Test that external .mat recordings are validated.
+    """
+
+    def test_invalid_mat_recording(self):
+        sample_filepath = os.path.join(self.directory.name, 'recording.mat')
+        signals = np.ones((3, 100))
+        signals[1, 10] = np.nan
+        sio.savemat(sample_filepath, {"".join(['mic', str(i + 1)]): signal
+                                      for i, signal in enumerate(signals)})
+
+        with self.assertRaises(ValueError):
+            localize_file(sample_filepath, settings={'mic_locations': [[0.0, 0.0, 0.0],
+                                                                       [0.1, 0.0, 0.0],
+                                                                       [0.0, 0.1, 0.0]]})
+
+
+if __name__ == '__main__':
+    unittest.main()
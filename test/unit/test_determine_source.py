@@ -0,0 +1,298 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+
+from itertools import combinations
+
+from scripts.determine_source import DetermineSourceLocation, load_source_locations, \
+    localize_cycles
+from scripts.sound_source_localization import SoundSourceLocation
+from scripts.utils import CandidateStore
+
+
+class CloudEstimator:
+    """Stands in for SoundSourceLocation: each cycle's estimates are a tight
+       cloud around the point stored in its sound data."""
+    algo_name = 'SRP'
+    num_sources = 1
+    rays = None
+
+    def get_parameters(self):
+        return {'num_sources': self.num_sources}
+
+    def process_potential_estimates(self, sound_data):
+        rng = np.random.default_rng(0)
+        return np.array(sound_data['source']) + rng.normal(0, 1e-3, (200, 3))
+
+
+class DetermineSourceLocationTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.test_s1 = np.array([0.1, 0.1, 0.1])
+        self.test_s2 = np.array([0.3, 0.3, 0.3])
+
+        # A tight cloud around each source, a looser one around S2 and
+        # points spread over the whole room
+        test_points = np.vstack([self.test_s1 + rng.normal(0, 1e-3, (400, 3)),
+                                 self.test_s2 + rng.normal(0, 1e-3, (200, 3)),
+                                 rng.uniform(0, 0.4, (300, 3)),
+                                 [[1.0, 1.0, 1.0]]])
+        self.test_points = test_points
+        self.src = DetermineSourceLocation('SRP', 'test', test_points,
+                                           room_dim=[0.4, 0.4, 0.4],
+                                           number_of_modes=2)
+
+
+class UseKDTreeTestCase(DetermineSourceLocationTestCase):
+    """
+    Test that the densest locations are found
+    """
+
+    def test_densest_locations(self):
+        test_locations = self.src.use_kd_tree()
+        self.assertEqual(test_locations.shape, (2, 3))
+        self.assertTrue(np.allclose(test_locations[0], self.test_s1, atol=2e-3))
+        self.assertTrue(np.allclose(test_locations[1], self.test_s2, atol=2e-3))
+
+    def test_densities_in_order(self):
+        self.src.use_kd_tree()
+        self.assertGreaterEqual(self.src.source_densities[0], self.src.source_densities[1])
+
+    def test_timings(self):
+        self.src.use_kd_tree()
+        self.assertEqual(set(self.src.timings), {'filter', 'build', 'density', 'modes'})
+
+    def test_no_points_in_room(self):
+        self.src.all_source_estimates = np.array([[1.0, 1.0, 1.0]])
+        self.assertEqual(self.src.use_kd_tree().shape, (0, 3))
+
+
+class CandidateStoreTestCase(DetermineSourceLocationTestCase):
+    """
+    Test that estimates kept on disk give the same locations
+    """
+
+    def test_same_locations(self):
+        with tempfile.TemporaryDirectory() as directory:
+            test_store = CandidateStore(directory)
+            for chunk in np.array_split(self.test_points, 4):
+                test_store.append(chunk)
+
+            test_src = DetermineSourceLocation('SRP', 'test', test_store,
+                                               room_dim=[0.4, 0.4, 0.4],
+                                               number_of_modes=2)
+            self.assertTrue(np.allclose(test_src.use_kd_tree(), self.src.use_kd_tree()))
+
+
+class LabeledSourcesTestCase(DetermineSourceLocationTestCase):
+    """
+    Test that labeled estimates are clustered per source
+    """
+
+    def setUp(self):
+        super().setUp()
+        # S1 and its label also hold a looser second cloud, S2 does not
+        rng = np.random.default_rng(1)
+        self.test_labeled_points = np.vstack([self.test_points[:400],
+                                              [0.3, 0.1, 0.2] + rng.normal(0, 1e-3, (100, 3)),
+                                              self.test_points[400:600]])
+        self.test_labels = np.repeat([0, 1], [500, 200])
+        self.src = DetermineSourceLocation('SRP', 'test', self.test_labeled_points,
+                                           labels=self.test_labels, room_dim=[0.4, 0.4, 0.4])
+
+    def test_one_location_per_label(self):
+        test_locations = self.src.use_kd_tree()
+        self.assertEqual(test_locations.shape, (2, 3))
+        self.assertTrue(np.allclose(test_locations[0], self.test_s1, atol=2e-3))
+        self.assertTrue(np.allclose(test_locations[1], self.test_s2, atol=2e-3))
+
+    def test_confidences(self):
+        self.src.use_kd_tree()
+        self.assertEqual(self.src.source_confidences[1], 1.0)
+        self.assertGreater(self.src.source_confidences[0], 0.5)
+        self.assertLess(self.src.source_confidences[0], 1.0)
+
+    def test_clean_and_noisy_source(self):
+        rng = np.random.default_rng(2)
+        test_points = np.vstack([self.test_s1 + rng.normal(0, 1e-3, (200, 3)),
+                                 self.test_s2 + rng.normal(0, 2e-2, (200, 3))])
+        self.src.all_source_estimates = test_points
+        self.src.labels = np.repeat([0, 1], 200)
+        self.src.use_kd_tree()
+        self.assertGreater(self.src.source_confidences[0], 0.95)
+        self.assertLess(self.src.source_confidences[1], 0.5)
+
+    def test_clean_and_noisy_rays(self):
+        # Rays of S1 all cross it, rays of S2 only pass close to it
+        rng = np.random.default_rng(2)
+        origins = rng.uniform(0, 0.4, (40, 3)) * [1, 1, 0]
+        targets = np.vstack([np.tile(self.test_s1, (20, 1)),
+                             self.test_s2 + rng.normal(0, 2e-2, (20, 3))])
+        directions = targets - origins
+        directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+        self.src.rays = (origins, directions)
+        self.src.ray_labels = np.repeat([0, 1], 20)
+        self.src.use_kd_tree()
+        self.assertEqual(self.src.source_confidences[0], 1.0)
+        self.assertLess(self.src.source_confidences[1], 0.5)
+
+    def test_label_outside_room(self):
+        self.src.all_source_estimates = self.test_labeled_points.copy()
+        self.src.all_source_estimates[self.test_labels == 1] += 1.0
+        test_locations = self.src.use_kd_tree()
+        self.assertTrue(np.isnan(test_locations[1]).all())
+        self.assertEqual(self.src.source_confidences[1], 0.0)
+
+    def test_labels_must_match(self):
+        with self.assertRaises(ValueError):
+            DetermineSourceLocation('SRP', 'test', self.test_labeled_points,
+                                    labels=self.test_labels[:10], room_dim=[0.4, 0.4, 0.4])
+
+
+class WriteOutputTestCase(DetermineSourceLocationTestCase):
+    """
+    Test that the source locations are saved in binary and loaded back with
+    their metadata, and that csv is still written on request
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.src._microphone_locations = ([0.0, 0.0, 0.0], [0.1, 0.0, 0.0], [0.0, 0.1, 0.0])
+        self.src.filename = os.path.join(self.directory.name, 'test')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_npz_round_trip(self):
+        test_filename = self.src.write_output(self.test_points)
+        self.assertTrue(test_filename.endswith('.npz'))
+
+        test_locations, test_metadata = load_source_locations(test_filename)
+        self.assertEqual(test_locations.dtype, np.float32)
+        self.assertTrue(np.allclose(test_locations, self.test_points, atol=1e-6))
+        self.assertEqual(test_metadata['columns'], ['Width', 'Depth', 'Length'])
+        self.assertTrue(np.array_equal(test_metadata['room_dim'], [0.4, 0.4, 0.4]))
+        self.assertEqual(test_metadata['mic_locations'].shape, (3, 3))
+        self.assertEqual(test_metadata['source_name'], 'test')
+        self.assertEqual(test_metadata['parameters']['algo_name'], 'SRP')
+        self.assertEqual(test_metadata['parameters']['number_of_modes'], 2)
+
+    def test_estimator_parameters(self):
+        test_estimator = SoundSourceLocation('MUSIC', num_sources=2, sampling_rate=8000)
+        test_estimator.fft_size = 512
+        test_estimator.freq_range = [100, 400]
+        test_src = DetermineSourceLocation('MUSIC', 'test', self.test_points,
+                                           *self.src._microphone_locations,
+                                           room_dim=[0.4, 0.4, 0.4],
+                                           parameters=test_estimator.get_parameters())
+        test_src.filename = os.path.join(self.directory.name, 'test_parameters')
+
+        _, test_metadata = load_source_locations(test_src.write_output(self.test_points))
+        test_parameters = test_metadata['parameters']
+        self.assertEqual(test_parameters['estimator'], 'SoundSourceLocation')
+        self.assertEqual(test_parameters['algo_name'], 'MUSIC')
+        self.assertEqual(test_parameters['num_sources'], 2)
+        self.assertEqual(test_parameters['number_of_modes'], 2)
+        self.assertEqual(test_parameters['sampling_rate'], 8000)
+        self.assertEqual(test_parameters['fft_size'], 512)
+        self.assertEqual(test_parameters['freq_range'], [100, 400])
+
+    def test_no_estimator_parameters(self):
+        _, test_metadata = load_source_locations(self.src.write_output(self.test_points))
+        self.assertNotIn('fft_size', test_metadata['parameters'])
+
+    def test_float64(self):
+        self.src.output_dtype = np.dtype(np.float64)
+        test_locations, _ = load_source_locations(self.src.write_output(self.test_points))
+        self.assertTrue(np.array_equal(test_locations, self.test_points))
+
+    def test_csv(self):
+        self.src.output_format = 'csv'
+        test_filename = self.src.write_output(self.test_points)
+        test_locations = np.loadtxt(test_filename, delimiter=',', skiprows=1)
+        self.assertTrue(np.allclose(test_locations, self.test_points))
+
+    def test_invalid_format(self):
+        with self.assertRaises(ValueError):
+            DetermineSourceLocation('SRP', 'test', self.test_points, room_dim=[0.4, 0.4, 0.4],
+                                    output_format='parquet')
+        with self.assertRaises(TypeError):
+            DetermineSourceLocation('SRP', 'test', self.test_points, room_dim=[0.4, 0.4, 0.4],
+                                    output_dtype=np.int32)
+
+
+class CountRaysTestCase(unittest.TestCase):
+    """
+    Test that the rays from a microphone array are counted where they meet
+    the source, rather than where they start
+    """
+
+    def setUp(self):
+        room_dim = np.array([0.5, 0.5, 0.5])
+        self.test_source = np.array([0.2, 0.3, 0.25])
+
+        # Four microphones on a circle, each combination of three finds four
+        # noisy directions to the source and, being planar, their mirror
+        # images below the array
+        angles = np.pi / 2 * np.arange(4)
+        mics = np.c_[0.25 + 0.1 * np.cos(angles), 0.25 + 0.1 * np.sin(angles), np.full(4, 0.03)]
+        self.test_center = mics.mean(axis=0)
+
+        estimator = SoundSourceLocation('SRP', x_dim_max=0.5, y_dim_max=0.5, z_dim_max=0.5)
+        centroids = estimator.get_centroids(mics, np.array(list(combinations(range(4), 3))))
+        origins = np.repeat(centroids, 4, axis=0)
+        directions = self.test_source - origins
+        directions += np.random.default_rng(0).normal(0, np.radians(5), directions.shape) \
+            * np.linalg.norm(directions, axis=1, keepdims=True)
+        directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+        origins = np.vstack([origins, origins])
+        directions = np.vstack([directions, directions * [1, 1, -1]])
+
+        self.test_rays = (origins, directions)
+        self.test_points = estimator.expand_rays(origins - room_dim / 2, directions) + room_dim / 2
+
+    def test_mode_at_source(self):
+        test_src = DetermineSourceLocation('SRP', 'test', self.test_points,
+                                           room_dim=[0.5, 0.5, 0.5], rays=self.test_rays)
+        test_location = test_src.use_kd_tree()[0]
+
+        self.assertLess(np.linalg.norm(test_location - self.test_source), 0.03)
+        self.assertGreater(np.linalg.norm(test_location - self.test_center), 0.15)
+        self.assertGreater(test_src.source_densities[0], 1)
+
+    def test_start_not_counted(self):
+        test_src = DetermineSourceLocation('SRP', 'test', self.test_points,
+                                           room_dim=[0.5, 0.5, 0.5])
+        origins, directions = self.test_rays
+        self.assertTrue(np.all(test_src.count_rays(origins, origins, directions) == 0))
+        self.assertEqual(test_src.count_rays(origins[:1] + 0.1 * directions[:1],
+                                             origins[:1], directions[:1], chunk_size=1)[0], 1)
+
+
+class LocalizeCyclesTestCase(unittest.TestCase):
+    """
+    Test that every cycle is localized and the results are put together
+    """
+
+    def test_aggregate(self):
+        test_cycles = [{'source': [0.1, 0.1, 0.1]}, {'source': [0.1, 0.1, 0.12]},
+                       {'source': [0.1, 0.1, 0.14]}]
+        test_results = localize_cycles(CloudEstimator(), iter(test_cycles), [0.4, 0.4, 0.4], jobs=2)
+
+        self.assertEqual(test_results['locations'].shape, (3, 1, 3))
+        self.assertTrue(np.allclose(test_results['locations'][:, 0, 2], [0.1, 0.12, 0.14], atol=2e-3))
+        self.assertTrue(np.allclose(test_results['location'][0], [0.1, 0.1, 0.12], atol=2e-3))
+        self.assertAlmostEqual(test_results['spread'][0], 0.02, delta=2e-3)
+
+    def test_cycle_outside_room(self):
+        test_cycles = [{'source': [0.1, 0.1, 0.1]}, {'source': [1.0, 1.0, 1.0]}]
+        test_results = localize_cycles(CloudEstimator(), test_cycles, [0.4, 0.4, 0.4], jobs=1)
+
+        self.assertTrue(np.isnan(test_results['locations'][1]).all())
+        self.assertTrue(np.allclose(test_results['location'][0], [0.1, 0.1, 0.1], atol=2e-3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,12 @@
+import os
+import tempfile
 import unittest
+import numpy as np
+
+from scipy.io import wavfile
 
 from scripts.experiment import ExperimentalMicData
+from scripts.preprocess import PrepareData
 
 
 class ExperimentalMicDataTestCase(unittest.TestCase):
@@ -59,5 +65,59 @@ class ReadWavFileTestCase(ExperimentalMicDataTestCase):
                                             mic_location=self.sample_microphone_location)._read_wav_file()
 
 
+class GetSoundDataTestCase(unittest.TestCase):
+    """
+    Test that the simulated signals handed over in memory match the ones
+    saved to and read back from the mat file.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        sample_filename = os.path.join(self.directory.name, 'source.wav')
+        wavfile.write(sample_filename, 16000,
+                      np.random.default_rng(0).standard_normal(4000).astype(np.float32))
+
+        self.src = ExperimentalMicData(sample_filename,
+                                       number_of_mics=4,
+                                       custom_mic_setup='circular',
+                                       room_dim=[50/100, 50/100, 50/100],
+                                       source_dim=[20/100, 30/100, 25/100],
+                                       mic_location=[25/100, 25/100, 3/100],
+                                       phi=0.0,
+                                       r=0.1)
+        self.src.name_to_save_file = os.path.join(self.directory.name, 'simulation.mat')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_matches_mat_file(self):
+        _, output_file_name, converted_mic_locations, _ = self.src.run()
+        test_loaded = next(PrepareData(output_file_name, *converted_mic_locations).load_file())
+        test_in_memory = self.src.get_sound_data()
+
+        self.assertEqual(list(test_in_memory), list(test_loaded))
+        for key, (location, signal) in test_in_memory.items():
+            self.assertEqual(location, test_loaded[key][0])
+            self.assertTrue(np.array_equal(signal, test_loaded[key][1]))
+
+    def test_not_saved(self):
+        _, output_file_name, *_ = self.src.run(save=False)
+        self.assertIsNone(output_file_name)
+        self.assertFalse(os.path.exists(self.src.name_to_save_file))
+        self.assertEqual(len(self.src.get_sound_data()), 4)
+
+    def test_sound_speed(self):
+        self.src.sound_speed = 300.0
+        self.src.run(save=False)
+        self.assertEqual(self.src.room.c, 300.0)
+        test_signals = self.src.get_sound_data()
+
+        self.src.sound_speed = None
+        self.src.run(save=False)
+        self.assertAlmostEqual(self.src.room.c, 343.0, places=0)
+        for key, (_, signal) in self.src.get_sound_data().items():
+            self.assertFalse(np.array_equal(signal, test_signals[key][1]))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,182 @@
+import unittest
+import numpy as np
+
+from scripts.geometry import ray_box_intervals, sample_ray_intervals, \
+    ray_box_endpoints, make_ray_segments, closest_approach, \
+    robust_closest_approach, segment_closest_approach, spherical_cap_points, \
+    combination_geometry
+
+
+class RayBoxIntervalsTestCase(unittest.TestCase):
+    """
+    Test the interval of each ray that lies inside a box
+    """
+
+    def setUp(self):
+        self.lower = -np.ones(3) / 2
+        self.upper = np.ones(3) / 2
+
+    def test_ray_from_center(self):
+        test_enter, test_exit = ray_box_intervals(np.zeros((1, 3)),
+                                                  np.array([[1.0, 0.0, 0.0]]),
+                                                  self.lower, self.upper)
+        self.assertTrue(np.allclose([test_enter[0], test_exit[0]], [0.0, 0.5]))
+
+    def test_ray_limited_by_t_max(self):
+        test_enter, test_exit = ray_box_intervals(np.zeros((1, 3)),
+                                                  np.array([[0.0, 1.0, 0.0]]),
+                                                  self.lower, self.upper, t_max=0.2)
+        self.assertTrue(np.allclose([test_enter[0], test_exit[0]], [0.0, 0.2]))
+
+    def test_ray_entering_box(self):
+        test_enter, test_exit = ray_box_intervals(np.array([[-1.0, 0.0, 0.0]]),
+                                                  np.array([[1.0, 0.0, 0.0]]),
+                                                  self.lower, self.upper)
+        self.assertTrue(np.allclose([test_enter[0], test_exit[0]], [0.5, 1.5]))
+
+    def test_ray_missing_box(self):
+        test_enter, test_exit = ray_box_intervals(np.array([[-1.0, 0.0, 0.0]]),
+                                                  np.array([[-1.0, 0.0, 0.0]]),
+                                                  self.lower, self.upper)
+        self.assertGreater(test_enter[0], test_exit[0])
+
+    def test_ray_parallel_outside_box(self):
+        test_enter, test_exit = ray_box_intervals(np.array([[0.0, 1.0, 0.0]]),
+                                                  np.array([[1.0, 0.0, 0.0]]),
+                                                  self.lower, self.upper)
+        self.assertGreater(test_enter[0], test_exit[0])
+
+
+class SampleRayIntervalsTestCase(unittest.TestCase):
+    """
+    Test that sampled rays match the dense radius inside the interval
+    """
+
+    def test_matches_dense_radius(self):
+        test_origins = np.zeros((2, 3))
+        test_directions = np.array([[1.0, 0.0, 0.0], [0.0, 0.0, -1.0]])
+        test_points = sample_ray_intervals(test_origins, test_directions,
+                                           np.array([0.0, 0.05]),
+                                           np.array([0.03, 0.08]), 0.01)
+        test_radius = np.arange(0, 0.1, 0.01)[:, np.newaxis]
+        dense = np.vstack([test_radius * test_directions[0],
+                           test_radius * test_directions[1]])
+        keep = np.r_[test_radius[:, 0] <= 0.03 + 1e-12,
+                     (test_radius[:, 0] >= 0.05 - 1e-12) & (test_radius[:, 0] <= 0.08 + 1e-12)]
+        self.assertTrue(np.allclose(test_points, dense[keep]))
+
+    def test_empty_interval(self):
+        test_points = sample_ray_intervals(np.zeros((1, 3)), np.array([[1.0, 0.0, 0.0]]),
+                                           np.array([0.5]), np.array([0.1]), 0.01)
+        self.assertEqual(test_points.shape, (0, 3))
+
+    def test_endpoints(self):
+        test_points = ray_box_endpoints(np.zeros((2, 3)),
+                                        np.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]),
+                                        np.array([0.1, 0.5]), np.array([0.2, 0.1]))
+        self.assertTrue(np.allclose(test_points, [[0.1, 0.0, 0.0], [0.2, 0.0, 0.0]]))
+
+
+class ClosestApproachTestCase(unittest.TestCase):
+    """
+    Test the point of closest approach of many lines
+    """
+
+    def setUp(self):
+        self.test_source = np.array([0.1, 0.2, 0.3])
+        rng = np.random.default_rng(0)
+        self.test_origins = rng.uniform(-1, 1, (10, 3))
+        directions = self.test_source - self.test_origins
+        self.test_directions = directions / np.linalg.norm(directions, axis=1)[:, np.newaxis]
+
+    def test_lines_through_one_point(self):
+        self.assertTrue(np.allclose(closest_approach(self.test_origins,
+                                                     self.test_directions),
+                                    self.test_source))
+
+    def test_robust_ignores_outlier(self):
+        test_origins = np.vstack([self.test_origins, [[0.5, 0.5, 0.5]]])
+        test_directions = np.vstack([self.test_directions, [[1.0, 0.0, 0.0]]])
+        test_plain = closest_approach(test_origins, test_directions)
+        test_robust = robust_closest_approach(test_origins, test_directions)
+        self.assertLess(np.linalg.norm(test_robust - self.test_source),
+                        np.linalg.norm(test_plain - self.test_source))
+        self.assertTrue(np.allclose(test_robust, self.test_source, atol=1e-4))
+
+    def test_no_lines(self):
+        with self.assertRaises(ValueError):
+            closest_approach(np.empty((0, 3)), np.empty((0, 3)))
+
+    def test_make_ray_segments_drops_empty(self):
+        test_segments = make_ray_segments(self.test_origins[:3], self.test_directions[:3],
+                                          np.array([0.0, 0.5, 0.0]), np.array([1.0, 0.1, 0.0]))
+        self.assertEqual(len(test_segments), 1)
+        self.assertTrue(np.allclose(test_segments['origin'][0], self.test_origins[0]))
+
+
+class SegmentClosestApproachTestCase(unittest.TestCase):
+    """
+    Test that only the valid part of each ray counts
+    """
+
+    def setUp(self):
+        # The lines meet at [0, -1, 0], behind where every ray starts
+        self.test_origins = np.array([[1.0, 0.0, 0.0], [-1.0, 0.0, 0.0], [0.0, -0.5, 0.0]])
+        self.test_directions = np.array([[1.0, 1.0, 0.0], [-1.0, 1.0, 0.0], [0.0, 2.0, 0.0]])
+        self.test_directions /= np.linalg.norm(self.test_directions, axis=1, keepdims=True)
+        self.test_segments = make_ray_segments(self.test_origins, self.test_directions,
+                                               np.zeros(3), np.full(3, 2.0))
+
+    def test_lines_through_one_point(self):
+        test_source = np.array([0.1, 0.2, 0.3])
+        test_origins = np.random.default_rng(0).uniform(-1, 1, (10, 3))
+        test_directions = test_source - test_origins
+        test_directions /= np.linalg.norm(test_directions, axis=1, keepdims=True)
+        test_segments = make_ray_segments(test_origins, test_directions,
+                                          np.zeros(10), np.full(10, 5.0))
+        self.assertTrue(np.allclose(segment_closest_approach(test_segments), test_source,
+                                    atol=1e-4))
+
+    def test_not_behind_the_rays(self):
+        self.assertTrue(np.allclose(closest_approach(self.test_origins, self.test_directions),
+                                    [0.0, -1.0, 0.0]))
+        for robust in (True, False):
+            self.assertTrue(np.allclose(segment_closest_approach(self.test_segments, robust=robust),
+                                        [0.0, 0.0, 0.0], atol=1e-4))
+
+    def test_no_segments(self):
+        with self.assertRaises(ValueError):
+            segment_closest_approach(self.test_segments[:0])
+
+
+class SphericalCapPointsTestCase(unittest.TestCase):
+    """
+    Test the directions spread over a cap around a direction
+    """
+
+    def test_points_inside_cap(self):
+        test_center = np.array([0.0, 0.6, 0.8])
+        test_points = spherical_cap_points(test_center, 0.1, 20)
+        self.assertEqual(test_points.shape, (21, 3))
+        self.assertTrue(np.allclose(test_points[0], test_center))
+        self.assertTrue(np.allclose(np.linalg.norm(test_points, axis=1), 1.0))
+        self.assertTrue(np.all(np.arccos(np.clip(test_points @ test_center, -1, 1)) <= 0.1 + 1e-12))
+
+
+class CombinationGeometryTestCase(unittest.TestCase):
+    """
+    Test the aperture and conditioning of each combination
+    """
+
+    def test_collinear_and_spread(self):
+        test_points = np.array([[0.0, 0.0, 0.0], [0.1, 0.0, 0.0], [0.2, 0.0, 0.0],
+                                [0.0, 0.2, 0.0]])
+        test_aperture, test_conditioning = combination_geometry(test_points,
+                                                                np.array([[0, 1, 2], [0, 2, 3]]))
+        self.assertTrue(np.allclose(test_aperture, [0.2, np.hypot(0.2, 0.2)]))
+        self.assertAlmostEqual(test_conditioning[0], 0.0)
+        self.assertGreater(test_conditioning[1], 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -48,5 +48,20 @@ class GetCentroidTestCase(unittest.TestCase):
                                     rtol=1e-05, atol=1e-08))
 
 
+class GetCentroidsTestCase(unittest.TestCase):
+    """
+    Test that the centroids of all the combinations are gathered at once.
+    """
+
+    def test_matches_get_centroid(self):
+        test_locations = np.array([[1.0, 2.0, 3.0], [2.0, 3.0, 4.0],
+                                   [3.0, 4.0, 5.0], [4.0, 5.0, 7.0]])
+        test_combinations = np.array([[0, 1, 2], [1, 2, 3]])
+        test_centroids = SoundSourceLocation.get_centroids(test_locations, test_combinations)
+        for centroid, combination in zip(test_centroids, test_combinations):
+            self.assertTrue(np.allclose(centroid, SoundSourceLocation.get_centroid(
+                test_locations[combination].tolist())))
+
+
 if __name__ == '__main__':
     unittest.main()
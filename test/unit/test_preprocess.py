@@ -1,7 +1,16 @@
+import os
+import tempfile
 import unittest
 import numpy as np
+import scipy.io as sio
 
-from scripts.preprocess import PrepareData
+from scripts.preprocess import PrepareData, MatFileChannels
+from .test_segmentation import make_heart_sounds
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
 
 
 class PrepareDataTestCase(unittest.TestCase):
@@ -99,5 +108,140 @@ class GetMicSignalLocationCase(PrepareDataTestCase):
             self.src_default._get_mic_signal_location(test_signal)
 
 
+class MatFileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.test_signals = [np.arange(100, dtype=float) + 1000 * i for i in range(3)]
+        self.test_locations = [[0.0, 0.0, 0.0], [0.1, 0.0, 0.0], [0.0, 0.1, 0.0]]
+
+        self.v5_path = os.path.join(self.directory.name, 'v5.mat')
+        sio.savemat(self.v5_path, {"".join(['mic', str(i + 1)]): signal
+                                   for i, signal in enumerate(self.test_signals)})
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_v73(self):
+        """Writes the signals like MATLAB's save -v7.3: an HDF5 file behind a
+           512 byte header, each row vector stored as one column."""
+        path = os.path.join(self.directory.name, 'v73.mat')
+        with h5py.File(path, 'w', userblock_size=512) as mat_file:
+            for i, signal in enumerate(self.test_signals):
+                mat_file.create_dataset("".join(['mic', str(i + 1)]), data=signal[:, np.newaxis])
+        with open(path, 'r+b') as mat_file:
+            mat_file.write(b'MATLAB 7.3 MAT-file'.ljust(128))
+        return path
+
+
+class MatFileChannelsTestCase(MatFileTestCase):
+    """
+    Test that each channel of v5 and v7.3 .mat files is read lazily.
+    """
+
+    def test_v5_names_and_lengths(self):
+        with MatFileChannels(self.v5_path) as channels:
+            self.assertEqual(channels.names, ['mic1', 'mic2', 'mic3'])
+            self.assertEqual(channels.lengths['mic2'], 100)
+
+    def test_v5_window(self):
+        with MatFileChannels(self.v5_path) as channels:
+            self.assertTrue(np.array_equal(channels.read('mic2', 10, 20),
+                                           self.test_signals[1][10:20]))
+
+    @unittest.skipIf(h5py is None, "h5py is not installed")
+    def test_v73_window(self):
+        with MatFileChannels(self.write_v73()) as channels:
+            self.assertEqual(channels.names, ['mic1', 'mic2', 'mic3'])
+            test_channel = channels.channel('mic3')
+            self.assertEqual(test_channel.shape, (100,))
+            self.assertTrue(np.array_equal(test_channel[40:45], self.test_signals[2][40:45]))
+
+    @unittest.skipIf(h5py is None, "h5py is not installed")
+    def test_v73_mic_number_order(self):
+        self.test_signals = [np.full(100, i, dtype=float) for i in range(12)]
+        test_locations = [[i / 100, 0.0, 0.0] for i in range(12)]
+
+        test_path = self.write_v73()
+        with MatFileChannels(test_path) as channels:
+            self.assertEqual(channels.names, ["".join(['mic', str(i + 1)]) for i in range(12)])
+
+        test_data = next(PrepareData(test_path, *test_locations).load_file())
+        for i in range(12):
+            location, signal = test_data["".join(['mic', str(i + 1)])]
+            self.assertEqual(location, test_locations[i])
+            self.assertTrue(np.all(signal == i))
+
+    def test_v5_decoded_once(self):
+        with MatFileChannels(self.v5_path) as channels:
+            test_first = channels.read('mic1', 0, 10)
+            test_first[:] = -1
+            self.assertTrue(np.array_equal(channels.read('mic1', 0, 10), self.test_signals[0][:10]))
+            self.assertIsNone(channels.read('mic1', 0, 10).base)
+            self.assertEqual(list(channels._decoded), ['mic1'])
+
+    def test_lazy_channel_only_sliced(self):
+        with MatFileChannels(self.v5_path) as channels:
+            with self.assertRaises(TypeError):
+                channels.channel('mic1')[3]
+
+
+class TimeWindowTestCase(MatFileTestCase):
+    """
+    Test that PrepareData only loads the requested time window.
+    """
+
+    def test_whole_recording(self):
+        test_data = next(PrepareData(self.v5_path, *self.test_locations).load_file())
+        self.assertTrue(np.array_equal(test_data['mic3'][1], self.test_signals[2]))
+        self.assertEqual(test_data['mic3'][0], self.test_locations[2])
+
+    def test_window_in_seconds(self):
+        test_data = next(PrepareData(self.v5_path, *self.test_locations,
+                                     time_window=(0.1, 0.25), sampling_rate=100).load_file())
+        self.assertTrue(np.array_equal(test_data['mic1'][1], self.test_signals[0][10:25]))
+
+    @unittest.skipIf(h5py is None, "h5py is not installed")
+    def test_v73_window_in_seconds(self):
+        test_data = next(PrepareData(self.write_v73(), *self.test_locations,
+                                     time_window=(0.5, 0.6), sampling_rate=100).load_file())
+        self.assertTrue(np.array_equal(test_data['mic2'][1], self.test_signals[1][50:60]))
+
+    def test_invalid_window(self):
+        with self.assertRaises(ValueError):
+            PrepareData(self.v5_path, time_window=(0.3, 0.1))
+
+
+class SegmentCyclesTestCase(MatFileTestCase):
+    """
+    Test that load_file yields one heart cycle at a time.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.test_signals = [make_heart_sounds(seed=i) for i in range(3)]
+        sio.savemat(self.v5_path, {"".join(['mic', str(i + 1)]): signal
+                                   for i, signal in enumerate(self.test_signals)})
+
+    def test_cycles(self):
+        test_data = PrepareData(self.v5_path, *self.test_locations, sampling_rate=2000,
+                                segment_cycles=True)
+        test_cycles = list(test_data.load_file())
+
+        self.assertEqual(len(test_cycles), 5)
+        self.assertEqual(len(test_data.cycles), 5)
+        for (start, stop), cycle in zip(test_data.cycles, test_cycles):
+            self.assertTrue(np.array_equal(cycle['mic2'][1], self.test_signals[1][start:stop]))
+            self.assertEqual(cycle['mic2'][0], self.test_locations[1])
+
+    def test_cycles_in_time_window(self):
+        test_data = PrepareData(self.v5_path, *self.test_locations, sampling_rate=2000,
+                                segment_cycles=True, time_window=(0.8, 2.4))
+        list(test_data.load_file())
+
+        self.assertEqual(len(test_data.cycles), 2)
+        self.assertGreaterEqual(test_data.cycles[0][0], 1600)
+        self.assertLessEqual(test_data.cycles[-1][1], 4800)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,128 @@
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from scripts.profiling import Profiler, ProfiledCall, get_profiler, NULL_PROFILER
+from scripts.sound_source_localization import SoundSourceLocation
+from scripts.utils import EstimatorPool
+
+
+def add_one(value):
+    with get_profiler().span('inner'):
+        return value + 1
+
+
+class ProfilerTestCase(unittest.TestCase):
+    """
+    Test that spans are recorded only while a profiler is active.
+    """
+
+    def test_inactive_records_nothing(self):
+        self.assertIs(get_profiler(), NULL_PROFILER)
+        with get_profiler().span('stage'):
+            pass
+        self.assertEqual(NULL_PROFILER.records, [])
+
+    def test_active_records_spans(self):
+        with Profiler() as profiler:
+            self.assertIs(get_profiler(), profiler)
+            with get_profiler().span('stage', combination=(0, 1, 2)):
+                pass
+        self.assertIs(get_profiler(), NULL_PROFILER)
+
+        self.assertEqual(len(profiler.records), 1)
+        self.assertEqual(profiler.records[0]['stage'], 'stage')
+        self.assertEqual(profiler.records[0]['combination'], (0, 1, 2))
+
+    def test_summary(self):
+        profiler = Profiler()
+        profiler.add('stage', 1.0, worker=1)
+        profiler.add('stage', 3.0, worker=2)
+
+        summary = profiler.summary()
+        self.assertEqual(summary['stages']['stage'],
+                         {'count': 2, 'total': 4.0, 'max': 3.0, 'mean': 2.0})
+        self.assertEqual(summary['workers'], {'1': {'stage': 1.0}, '2': {'stage': 3.0}})
+
+    def test_summary_caches(self):
+        profiler = Profiler()
+        profiler.add('setup', 1.0, cached=False)
+        profiler.add('setup', 0.0, cached=True)
+        profiler.add('setup', 0.0, cached=True)
+        profiler.add('stage', 1.0)
+        self.assertEqual(profiler.summary()['caches'], {'setup': {'hits': 2, 'misses': 1}})
+
+    def test_write_files(self):
+        profiler = Profiler()
+        profiler.add('stage', 1.0, combination=(0, 1, 2))
+
+        with tempfile.TemporaryDirectory() as directory:
+            profiler.to_json(os.path.join(directory, 'run.json'))
+            profiler.to_csv(os.path.join(directory, 'run.csv'))
+
+            with open(os.path.join(directory, 'run.json')) as profile_file:
+                self.assertEqual(len(json.load(profile_file)['records']), 1)
+            with open(os.path.join(directory, 'run.csv')) as profile_file:
+                self.assertEqual(len(profile_file.readlines()), 2)
+
+    def test_profiled_call(self):
+        output, records = ProfiledCall(add_one, 'call')(1)
+        self.assertEqual(output, 2)
+        self.assertEqual(sorted(record['stage'] for record in records), ['call', 'inner'])
+
+
+class PipelineProfilingTestCase(unittest.TestCase):
+    """
+    Test that the estimation stages are recorded when profiling.
+    """
+
+    def test_stages_recorded(self):
+        rng = np.random.default_rng(0)
+        mic_locations = [[0.0, 0.0, 0.0], [0.05, 0.0, 0.0], [0.0, 0.05, 0.0],
+                         [0.05, 0.05, 0.01]]
+        sound_data = {"".join(['mic', str(i + 1)]): (location, rng.standard_normal(2048))
+                      for i, location in enumerate(mic_locations)}
+
+        src = SoundSourceLocation('SRP', number_of_mic_splits=1)
+        src.n_grid = 100
+        with Profiler() as profiler:
+            src.process_potential_estimates(sound_data)
+
+        stages = profiler.summary()['stages']
+        for stage in ('stft', 'doa', 'ray_expansion', 'combination', 'ipc'):
+            self.assertIn(stage, stages)
+        self.assertEqual(stages['combination']['count'], 4)
+
+    def test_doa_cache_hits_from_workers(self):
+        from scripts.sound_source_localization import DOA_CACHE
+
+        rng = np.random.default_rng(0)
+        mic_locations = [[0.0, 0.0, 0.0], [0.05, 0.0, 0.0], [0.0, 0.05, 0.0],
+                         [0.05, 0.05, 0.01]]
+        sound_data = {"".join(['mic', str(i + 1)]): (location, rng.standard_normal(2048))
+                      for i, location in enumerate(mic_locations)}
+
+        src = SoundSourceLocation('SRP', number_of_mic_splits=1)
+        src.n_grid = 101
+        DOA_CACHE.clear()
+
+        # Each combination is looked up in the cache of a fresh worker
+        with EstimatorPool(processes=2) as pool:
+            src.pool = pool
+            with Profiler() as profiler:
+                src.process_potential_estimates(sound_data)
+        self.assertEqual(profiler.summary()['caches']['doa_setup'], {'hits': 0, 'misses': 4})
+        self.assertNotIn('doa_setup', profiler.summary()['workers'][str(os.getpid())])
+
+        # A pool of one process looks them up in this process's cache
+        src.pool = EstimatorPool(processes=1)
+        src.process_potential_estimates(sound_data)
+        with Profiler() as profiler:
+            src.process_potential_estimates(sound_data)
+        self.assertEqual(profiler.summary()['caches']['doa_setup'], {'hits': 4, 'misses': 0})
+
+if __name__ == '__main__':
+    unittest.main()
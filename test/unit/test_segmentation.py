@@ -0,0 +1,65 @@
+import unittest
+import numpy as np
+
+from scripts.segmentation import get_envelope, find_heart_sounds, find_cycle_boundaries
+
+
+def make_heart_sounds(sampling_rate=2000, number_of_cycles=5, seed=0):
+    """Returns noise bursts for S1 at 0.2 s and S2 at 0.5 s of every 0.8 s
+       cycle, on a quiet background."""
+    rng = np.random.default_rng(seed)
+    signal = 0.01 * rng.standard_normal(int(0.8 * number_of_cycles * sampling_rate))
+    for k in range(number_of_cycles):
+        for onset, amplitude in ((0.2, 1.0), (0.5, 0.6)):
+            start = int((onset + 0.8 * k) * sampling_rate)
+            signal[start:start + int(0.05 * sampling_rate)] += amplitude * rng.standard_normal(
+                int(0.05 * sampling_rate))
+    return signal
+
+
+class GetEnvelopeTestCase(unittest.TestCase):
+    """
+    Test that the envelope adds up every microphone on the same scale
+    """
+
+    def test_scaled_channels(self):
+        signal = make_heart_sounds()
+        test_envelope = get_envelope([signal, 100 * signal], 2000)
+        self.assertTrue(np.allclose(test_envelope, 2 * get_envelope([signal], 2000)))
+
+    def test_no_signals(self):
+        with self.assertRaises(ValueError):
+            get_envelope([], 2000)
+
+
+class FindCycleBoundariesTestCase(unittest.TestCase):
+    """
+    Test that the heart cycles are split in the long pause after S2
+    """
+
+    def setUp(self):
+        self.test_envelope = get_envelope([make_heart_sounds(), make_heart_sounds(seed=1)], 2000)
+
+    def test_heart_sounds(self):
+        self.assertEqual(len(find_heart_sounds(self.test_envelope, 2000)), 10)
+
+    def test_cycles(self):
+        test_cycles = find_cycle_boundaries(self.test_envelope, 2000)
+        self.assertEqual(len(test_cycles), 5)
+
+        # Every boundary falls in diastole, after S2 and before the next S1
+        for start, _ in test_cycles[1:]:
+            phase = (start / 2000) % 0.8
+            self.assertTrue(phase > 0.55 or phase < 0.2)
+
+    def test_cycles_are_contiguous(self):
+        test_cycles = find_cycle_boundaries(self.test_envelope, 2000)
+        for (_, stop), (start, _) in zip(test_cycles[:-1], test_cycles[1:]):
+            self.assertEqual(stop, start)
+
+    def test_silence(self):
+        self.assertEqual(find_cycle_boundaries(np.zeros(2000), 2000), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,9 @@
+import tempfile
 import unittest
 import numpy as np
 
 from scripts.sound_source_localization import SoundSourceLocation
+from scripts.utils import SharedArray
 
 # TODO:
 #   1) Test one Real case in DifferenceOfArrivalsTestCase
@@ -209,5 +211,433 @@ class DifferenceOfArrivalsTestCase(SoundSourceLocationTestCase):
     #     self.test_difference_of_arrivals(test_signal_list, *test_mic_location)
 
 
+class StftCacheTestCase(unittest.TestCase):
+    """
+    Test that each microphone signal is transformed once and shared by
+    the microphone combinations
+    """
+
+    def setUp(self):
+        self.src = SoundSourceLocation('SRP')
+        rng = np.random.default_rng(0)
+        test_mic_loc = [[0.01, 0.0, 0.0], [0.0, 0.02, 0.0], [0.0, 0.0, 0.03]]
+        self.test_mic_list = ['mic1', 'mic2', 'mic3']
+        self.test_sound_data = dict(zip(self.test_mic_list,
+                                        [(loc, rng.standard_normal(2048))
+                                         for loc in test_mic_loc]))
+
+    def test_cache_keys(self):
+        test_cache = self.src.build_stft_cache(self.test_sound_data)
+        self.assertEqual(list(test_cache.keys()), self.test_mic_list)
+
+    def test_cache_shape(self):
+        test_cache = self.src.build_stft_cache(self.test_sound_data)
+        self.assertEqual(test_cache['mic1'].shape[0], self.src.fft_size // 2 + 1)
+
+    def test_shared_estimates_match(self):
+        test_estimates = self.src.get_estimates(self.test_sound_data, *self.test_mic_list)
+        test_cache = self.src.build_stft_cache(self.test_sound_data)
+        test_spectra = np.array([test_cache[mic] for mic in self.test_mic_list])
+        test_locations = np.array([self.test_sound_data[mic][0]
+                                   for mic in self.test_mic_list])
+        with SharedArray.from_array(test_spectra) as shared_spectra, \
+                SharedArray.from_array(test_locations) as shared_locations:
+            _, test_azimuth, test_colatitude = self.src.locate_combination((shared_spectra,
+                                                                            shared_locations),
+                                                                           0, 1, 2)
+        test_shared_estimates = self.src.estimate_combinations(test_locations,
+                                                               np.array([[0, 1, 2]]),
+                                                               [test_azimuth], [test_colatitude])
+        self.assertTrue(np.allclose(test_estimates, test_shared_estimates))
+
+
+class DOACacheTestCase(unittest.TestCase):
+    """
+    Test that DOA objects are reused for the same microphone geometry
+    """
+
+    def setUp(self):
+        self.src = SoundSourceLocation('SRP')
+        self.test_microphones = np.array([[0.01, 0.0, 0.0], [0.0, 0.02, 0.0],
+                                          [0.0, 0.0, 0.03]])
+
+    def test_same_geometry_is_reused(self):
+        self.assertIs(self.src.get_doa(self.test_microphones),
+                      self.src.get_doa(self.test_microphones.copy()))
+
+    def test_different_geometry_is_not_reused(self):
+        self.assertIsNot(self.src.get_doa(self.test_microphones),
+                         self.src.get_doa(2 * self.test_microphones))
+
+    def test_different_grid_is_not_reused(self):
+        test_doa = self.src.get_doa(self.test_microphones)
+        self.src.n_grid = 100
+        self.assertEqual(self.src.get_doa(self.test_microphones).grid.n_points, 100)
+        self.assertIsNot(self.src.get_doa(self.test_microphones), test_doa)
+
+
+class ClipToRoomTestCase(unittest.TestCase):
+    """
+    Test that clipped rays only keep the radius values inside the room
+    """
+
+    def setUp(self):
+        self.src = SoundSourceLocation('SRP', x_dim_max=0.2, y_dim_max=0.2,
+                                       z_dim_max=0.2, ray_sampling='clipped')
+        self.test_centroid = np.array([0.05, 0.0, 0.0])
+        self.test_directions = np.array([[1.0, 0.0, 0.0], [-1.0, 0.0, 0.0]])
+        self.test_origins = np.tile(self.test_centroid, (2, 1))
+
+    def test_clipped_matches_filtered_radius(self):
+        test_points = self.src.expand_rays(self.test_origins, self.test_directions)
+        dense = np.vstack([self.src.radius * direction + self.test_centroid
+                           for direction in self.test_directions])
+        dense = dense[np.all(np.abs(dense) <= 0.1 + 1e-12, axis=1)]
+        self.assertTrue(np.allclose(test_points, dense))
+
+    def test_endpoints(self):
+        self.src.ray_sampling = 'endpoints'
+        test_points = self.src.expand_rays(self.test_origins, self.test_directions)
+        self.assertTrue(np.allclose(test_points, [[0.05, 0.0, 0.0], [0.1, 0.0, 0.0],
+                                                  [0.05, 0.0, 0.0], [-0.1, 0.0, 0.0]]))
+
+    def test_invalid_ray_sampling(self):
+        with self.assertRaises(ValueError):
+            SoundSourceLocation('SRP', ray_sampling='sparse')
+
+
+class EstimateCombinationsTestCase(unittest.TestCase):
+    """
+    Test that the batched estimates match expanding each combination
+    """
+
+    def setUp(self):
+        self.src = SoundSourceLocation('SRP', number_of_mic_splits=1)
+        self.test_locations = np.array([[0.01, 0.0, 0.0], [0.0, 0.02, 0.0],
+                                        [0.0, 0.0, 0.03], [0.02, 0.02, 0.0]])
+        self.test_combinations = np.array([[0, 1, 2], [1, 2, 3]])
+        self.test_azimuth = [np.array([0.3]), np.array([1.2])]
+        self.test_colatitude = [np.array([1.0]), np.array([2.1])]
+
+    def test_matches_each_combination(self):
+        test_estimates = self.src.estimate_combinations(self.test_locations,
+                                                        self.test_combinations,
+                                                        self.test_azimuth,
+                                                        self.test_colatitude)
+        expected = np.vstack([self.src.radius * np.array([np.cos(azimuth) * np.sin(colatitude),
+                                                          np.sin(azimuth) * np.sin(colatitude),
+                                                          np.cos(colatitude)]).T
+                              + self.test_locations[combination].mean(axis=0)
+                              for combination, azimuth, colatitude in zip(self.test_combinations,
+                                                                          self.test_azimuth,
+                                                                          self.test_colatitude)])
+        self.assertEqual(test_estimates.shape, (2 * len(self.src.radius), 3))
+        self.assertTrue(np.allclose(test_estimates, expected))
+
+    def test_combination_indices(self):
+        test_indices = self.src.get_combination_indices(4)
+        self.assertEqual(test_indices.tolist(), [[0, 1, 2], [0, 1, 3], [0, 2, 3], [1, 2, 3]])
+
+
+class HierarchicalGridSearchTestCase(unittest.TestCase):
+    """
+    Test that the coarse to fine search refines the coarse sphere
+    """
+
+    def setUp(self):
+        import pyroomacoustics as pra
+
+        rng = np.random.default_rng(2)
+        azimuth, colatitude = 0.8, 1.1
+        self.test_direction = np.array([np.cos(azimuth) * np.sin(colatitude),
+                                        np.sin(azimuth) * np.sin(colatitude),
+                                        np.cos(colatitude)])
+        self.test_mics = np.array([[0.05, 0.0, 0.0], [-0.05, 0.02, 0.01],
+                                   [0.0, 0.05, -0.02], [0.01, -0.03, 0.05]])
+
+        room = pra.AnechoicRoom(3, fs=16000)
+        room.add_source(20 * self.test_direction, signal=rng.standard_normal(16000))
+        room.add_microphone_array(pra.MicrophoneArray(self.test_mics.T, fs=16000))
+        room.simulate()
+        self.test_signals = room.mic_array.signals
+
+    def locate(self, grid_search):
+        src = SoundSourceLocation('MUSIC', grid_search=grid_search)
+        src.sound_speed = 343.0
+        src.freq_range = [300, 3500]
+        stft_signal = np.array([src.transform_signal(signal) for signal in self.test_signals])
+        azimuth, colatitude = src.locate_directions(stft_signal, self.test_mics.tolist())
+        direction = np.array([np.cos(azimuth[0]) * np.sin(colatitude[0]),
+                              np.sin(azimuth[0]) * np.sin(colatitude[0]),
+                              np.cos(colatitude[0])])
+        return src, np.degrees(np.arccos(np.clip(direction @ self.test_direction, -1, 1)))
+
+    def test_finer_than_flat_grid(self):
+        _, flat_error = self.locate('flat')
+        _, hierarchical_error = self.locate('hierarchical')
+        self.assertLessEqual(hierarchical_error, flat_error)
+        self.assertLess(hierarchical_error, 1.0)
+
+    def test_cached_coarse_grid_unchanged(self):
+        src, _ = self.locate('hierarchical')
+        self.assertEqual(src.get_doa(self.test_mics).grid.n_points, src.n_coarse_grid)
+
+    def test_invalid_grid_search(self):
+        with self.assertRaises(ValueError):
+            SoundSourceLocation('SRP', grid_search='random')
+
+
+class RaySegmentsTestCase(unittest.TestCase):
+    """
+    Test that the source is located from the ray segments of a simulated
+    recording
+    """
+
+    def setUp(self):
+        import pyroomacoustics as pra
+
+        rng = np.random.default_rng(0)
+        self.room_dim = np.array([0.5, 0.5, 0.5])
+        self.test_source = np.array([0.2, 0.3, 0.25])
+
+        # Eight microphones on a circle on the floor, as in the benchmarks
+        angles = 2 * np.pi * np.arange(8) / 8
+        mics = np.c_[0.25 + 0.1 * np.cos(angles), 0.25 + 0.1 * np.sin(angles), np.zeros(8)]
+
+        room = pra.ShoeBox(self.room_dim, fs=16000, max_order=0)
+        room.add_source(self.test_source, signal=rng.standard_normal(8000))
+        room.add_microphone_array(pra.MicrophoneArray(mics.T, fs=16000))
+        room.simulate()
+
+        self.test_sound_data = {"".join(['mic', str(i + 1)]): (location.tolist(), signal)
+                                for i, (location, signal) in enumerate(zip(mics - self.room_dim / 2,
+                                                                           room.mic_array.signals))}
+
+        self.src = SoundSourceLocation('SRP', number_of_mic_splits=1, x_dim_max=0.5,
+                                       y_dim_max=0.5, z_dim_max=0.5)
+        self.src.sound_speed = pra.constants.get('c')
+        self.src.freq_range = [300, 3500]
+
+    def test_locate_source(self):
+        test_segments = next(self.src.run_estimates(self.test_sound_data, segments=True))
+
+        # Rays pointing into the floor are only on the room boundary
+        self.assertTrue(np.all(test_segments['t_min'] < test_segments['t_max']))
+        self.assertTrue(np.all(test_segments['origin'][:, 2] == 0))
+        self.assertTrue(np.all(test_segments['direction'][:, 2] > 0))
+
+        test_location = self.src.locate_source(test_segments)
+        self.assertTrue(np.all((test_location >= 0) & (test_location <= self.room_dim)))
+        self.assertLess(np.linalg.norm(test_location - self.test_source), 0.06)
+
+    def test_segments_not_stored(self):
+        with self.assertRaises(ValueError):
+            next(self.src.run_estimates(self.test_sound_data, segments=True, store=object()))
+
+
+class LabelRaysTestCase(unittest.TestCase):
+    """
+    Test that the rays of each source keep the same label across
+    combinations
+    """
+
+    def setUp(self):
+        self.src = SoundSourceLocation('SRP', num_sources=2, number_of_mic_splits=1)
+        rng = np.random.default_rng(3)
+        s1, s2 = np.array([1.0, 0.0, 0.0]), np.array([0.0, 0.0, 1.0])
+
+        # Each combination finds the sources in its own order
+        self.test_swapped = rng.random(8) < 0.5
+        blocks = []
+        for swapped in self.test_swapped:
+            block = np.array([s2, s1] if swapped else [s1, s2]) + rng.normal(0, 0.1, (2, 3))
+            blocks.append(block / np.linalg.norm(block, axis=1, keepdims=True))
+        self.test_directions = np.vstack(blocks)
+
+    def test_labels_follow_sources(self):
+        test_labels = self.src.label_rays(self.test_directions, [2] * 8).reshape(8, 2)
+        first = test_labels[0, 1] if self.test_swapped[0] else test_labels[0, 0]
+        for labels, swapped in zip(test_labels, self.test_swapped):
+            self.assertEqual(labels[1 if swapped else 0], first)
+
+    def test_combination_missing_a_source(self):
+        test_labels = self.src.label_rays(np.vstack([self.test_directions[:2], [[0.0, 0.1, 1.0]]]),
+                                          [2, 1])
+        s2_label = test_labels[0] if self.test_swapped[0] else test_labels[1]
+        self.assertEqual(test_labels[2], s2_label)
+
+    def test_more_directions_than_sources(self):
+        with self.assertRaises(ValueError):
+            self.src.label_rays(np.vstack([self.test_directions[:2], [[0.0, 1.0, 0.0]]]), [3])
+
+    def test_labeled_estimates(self):
+        origins = np.zeros((16, 3))
+        test_labels = self.src.label_rays(self.test_directions, [2] * 8)
+        self.src.locate_labeled_rays = lambda sound_data: (origins, self.test_directions,
+                                                           test_labels)
+        test_estimates, test_point_labels = self.src.process_labeled_estimates(None)
+        self.assertEqual(test_estimates.shape, (16 * len(self.src.radius), 3))
+        self.assertEqual(np.bincount(test_point_labels).tolist(), [8 * len(self.src.radius)] * 2)
+
+    def test_labeled_store(self):
+        with self.assertRaises(ValueError):
+            next(self.src.run_estimates({}, store=object(), labeled=True))
+
+
+class CombinationPruningTestCase(unittest.TestCase):
+    """
+    Test that only the best scored microphone combinations are run
+    """
+
+    def setUp(self):
+        rng = np.random.default_rng(4)
+        source = rng.standard_normal(8000)
+
+        # Microphones 1-3 are collinear, microphone 5 only records noise
+        self.test_locations = [[-0.1, 0.0, 0.0], [0.0, 0.0, 0.0], [0.1, 0.0, 0.0],
+                               [0.0, 0.1, 0.02], [0.05, -0.1, 0.04]]
+        signals = [np.roll(source, i) + 0.05 * rng.standard_normal(8000) for i in range(4)]
+        signals.append(rng.standard_normal(8000))
+        self.test_sound_data = {"".join(['mic', str(i + 1)]): (location, signal)
+                                for i, (location, signal) in enumerate(zip(self.test_locations,
+                                                                           signals))}
+
+    def select(self, **kwargs):
+        src = SoundSourceLocation('SRP', number_of_mic_splits=1, **kwargs)
+        src.freq_range = [0, 8000]
+        return src, src.select_combinations(self.test_sound_data)
+
+    def test_no_pruning(self):
+        src, (test_indices, test_stft_cache) = self.select()
+        self.assertEqual(len(test_indices), 10)
+        self.assertIsNone(test_stft_cache)
+        self.assertIsNone(src.combination_scores)
+
+    def test_scores(self):
+        src, _ = self.select(combination_budget=10)
+        test_indices = src.get_combination_indices(5).tolist()
+        scores = dict(zip(map(tuple, test_indices), src.combination_scores))
+
+        self.assertAlmostEqual(scores[(0, 1, 2)], 0.0)
+        self.assertEqual(max(scores, key=scores.get), (0, 2, 3))
+        self.assertLess(scores[(0, 3, 4)], scores[(0, 2, 3)] / 2)
+
+    def test_budget_keeps_order(self):
+        src, (test_indices, test_stft_cache) = self.select(combination_budget=3)
+        all_indices = src.get_combination_indices(5).tolist()
+        best = np.argsort(-src.combination_scores, kind='stable')[:3]
+
+        self.assertEqual(test_indices.tolist(), [all_indices[i] for i in sorted(best)])
+        self.assertEqual(set(test_stft_cache), set(self.test_sound_data))
+
+    def test_threshold_keeps_best(self):
+        src, (test_indices, _) = self.select(combination_threshold=1.0)
+        self.assertEqual(test_indices.tolist(), [[0, 2, 3]])
+
+    def test_invalid_pruning(self):
+        with self.assertRaises(ValueError):
+            SoundSourceLocation('SRP', combination_budget=0)
+        with self.assertRaises(ValueError):
+            SoundSourceLocation('SRP', combination_threshold=1.5)
+
+
+class ResultCacheTestCase(unittest.TestCase):
+    """
+    Test that estimates are read back from the result cache
+    """
+
+    def setUp(self):
+        from scripts.utils import ResultCache
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = ResultCache(self.directory.name)
+
+        rng = np.random.default_rng(5)
+        self.test_sound_data = {"".join(['mic', str(i + 1)]): (location, rng.standard_normal(4000))
+                                for i, location in enumerate([[0.0, 0.0, 0.0], [0.05, 0.0, 0.0],
+                                                              [0.0, 0.05, 0.0], [0.0, 0.0, 0.05]])}
+        self.src = SoundSourceLocation('SRP', number_of_mic_splits=1, result_cache=self.cache)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_second_run_is_cached(self):
+        test_estimates = next(self.src.run_estimates(self.test_sound_data))
+        test_rerun = SoundSourceLocation('SRP', number_of_mic_splits=1, result_cache=self.cache)
+        self.assertTrue(np.array_equal(next(test_rerun.run_estimates(self.test_sound_data)),
+                                       test_estimates))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+        # The rays come back with the estimates
+        for test_values, values in zip(test_rerun.rays, self.src.rays):
+            self.assertTrue(np.array_equal(test_values, values))
+
+    def test_combination_scores_are_cached(self):
+        self.src.combination_budget = 2
+        self.src.mic_combinations_number = 2
+        next(self.src.run_estimates(self.test_sound_data))
+        test_rerun = SoundSourceLocation('SRP', number_of_mic_splits=1, result_cache=self.cache,
+                                         combination_budget=2)
+        test_rerun.mic_combinations_number = 2
+        next(test_rerun.run_estimates(self.test_sound_data))
+        self.assertEqual(self.cache.hits, 1)
+        self.assertTrue(np.array_equal(test_rerun.combination_scores,
+                                       self.src.combination_scores))
+
+    def test_key_changes(self):
+        test_key = self.src.get_result_key(self.test_sound_data)
+        self.assertEqual(test_key, SoundSourceLocation('SRP', number_of_mic_splits=1)
+                         .get_result_key(self.test_sound_data))
+        self.assertNotEqual(test_key, self.src.get_result_key(self.test_sound_data, labeled=True))
+
+        self.src.freq_range = [0, 500]
+        self.assertNotEqual(test_key, self.src.get_result_key(self.test_sound_data))
+
+        self.src.freq_range = [0, 250]
+        changed = dict(self.test_sound_data, mic2=(self.test_sound_data['mic2'][0],
+                                                   self.test_sound_data['mic2'][1] * 2))
+        self.assertNotEqual(test_key, self.src.get_result_key(changed))
+
+
+class StorePotentialEstimatesTestCase(unittest.TestCase):
+    """
+    Test that a rerun into the same candidate store does not count the
+    estimates twice
+    """
+
+    def setUp(self):
+        from scripts.utils import CandidateStore
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = CandidateStore(self.directory.name)
+
+        rng = np.random.default_rng(5)
+        self.test_sound_data = {"".join(['mic', str(i + 1)]): (location, rng.standard_normal(4000))
+                                for i, location in enumerate([[0.0, 0.0, 0.0], [0.05, 0.0, 0.0],
+                                                              [0.0, 0.05, 0.0], [0.0, 0.0, 0.05]])}
+        self.src = SoundSourceLocation('SRP', number_of_mic_splits=1)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_non_empty_store(self):
+        from scripts.utils import CandidateStore
+
+        next(self.src.run_estimates(self.test_sound_data, store=self.store))
+        test_length = len(self.store)
+
+        test_store = CandidateStore(self.directory.name)
+        with self.assertRaises(ValueError):
+            next(self.src.run_estimates(self.test_sound_data, store=test_store))
+        self.assertEqual(len(CandidateStore(self.directory.name)), test_length)
+
+        next(self.src.run_estimates(self.test_sound_data, store=test_store, append=True))
+        self.assertEqual(len(test_store), 2 * test_length)
+
+        test_store.clear()
+        next(self.src.run_estimates(self.test_sound_data, store=test_store))
+        self.assertEqual(len(test_store), test_length)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,82 @@
+import tempfile
+import unittest
+import numpy as np
+import pyroomacoustics as pra
+
+from scripts.srp_phat import SRPPHATSoundSourceLocation
+from scripts.utils import ResultCache
+
+
+class SRPPHATTestCase(unittest.TestCase):
+    """
+    Test the near-field SRP-PHAT search over the room grid.
+    """
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.room_dim = np.array([0.5, 0.5, 0.5])
+        self.source_location = np.array([0.2, 0.3, 0.24])
+
+        room = pra.ShoeBox(self.room_dim, fs=16000, max_order=0)
+        room.add_source(self.source_location, signal=rng.standard_normal(8000))
+        mics = np.array([[0.1, 0.1, 0.05], [0.4, 0.1, 0.06], [0.1, 0.4, 0.07],
+                         [0.4, 0.4, 0.05], [0.25, 0.25, 0.45]]).T
+        room.add_microphone_array(pra.MicrophoneArray(mics, fs=16000))
+        room.simulate()
+
+        self.test_mic_locations = mics.T - self.room_dim / 2
+        self.test_sound_data = {"".join(['mic', str(i + 1)]): (location.tolist(), signal)
+                                for i, (location, signal) in enumerate(zip(self.test_mic_locations,
+                                                                           room.mic_array.signals))}
+
+        self.src = SRPPHATSoundSourceLocation(grid_spacing=0.02, x_dim_max=0.5,
+                                              y_dim_max=0.5, z_dim_max=0.5)
+        self.src.sound_speed = pra.constants.get('c')
+        self.src.freq_range = [0, 8000]
+
+    def test_grid_covers_room(self):
+        self.assertEqual(self.src.grid_shape, (26, 26, 26))
+        self.assertTrue(np.allclose(self.src.grid.min(axis=0), -self.room_dim / 2))
+        self.assertTrue(np.allclose(self.src.grid.max(axis=0), self.room_dim / 2))
+
+    def test_locates_source(self):
+        test_location = self.src.process_potential_estimates(self.test_sound_data)
+        self.assertEqual(test_location.shape, (1, 3))
+        self.assertLess(np.linalg.norm(test_location[0] - self.source_location), 0.02)
+
+    def test_tdoa_table_is_reused(self):
+        self.assertIs(self.src.get_tdoa_table(self.test_mic_locations),
+                      self.src.get_tdoa_table(self.test_mic_locations.copy()))
+
+    def test_tdoa_table_equidistant_point(self):
+        center = np.argmin(np.linalg.norm(self.src.grid, axis=1))
+        test_mics = self.src.grid[center] + np.array([[-0.1, 0.0, 0.0], [0.1, 0.0, 0.0]])
+        pairs, table = self.src.build_tdoa_table(test_mics)
+        self.assertEqual(pairs.tolist(), [[0, 1]])
+        self.assertEqual(table[0, center], 0)
+
+    def test_pair_delay_past_half_fft_size(self):
+        self.src.sound_speed = 30
+        with self.assertRaises(ValueError):
+            self.src.build_tdoa_table(self.test_mic_locations)
+        with self.assertRaises(ValueError):
+            self.src.process_potential_estimates(self.test_sound_data)
+
+    def test_power_is_cached(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.src.result_cache = ResultCache(directory)
+            next(self.src.run_estimates(self.test_sound_data))
+            test_power = self.src.power
+
+            self.src.power = None
+            next(self.src.run_estimates(self.test_sound_data))
+            self.assertEqual(self.src.result_cache.hits, 1)
+            self.assertTrue(np.array_equal(self.src.power, test_power))
+
+    def test_invalid_grid_spacing(self):
+        with self.assertRaises(ValueError):
+            SRPPHATSoundSourceLocation(grid_spacing=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import unittest
+import numpy as np
+
+from scripts.sound_source_localization import SoundSourceLocation
+from scripts.streaming import StreamingSoundSourceLocation
+
+
+class StreamingSoundSourceLocationTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.test_mic_loc = [[0.01, 0.0, 0.0], [0.0, 0.02, 0.0], [0.0, 0.0, 0.03]]
+
+        # One source delayed by a different number of samples on each
+        # microphone
+        source = rng.standard_normal(4200)
+        self.test_signals = np.array([source[delay:delay + 4096] for delay in (0, 3, 7)])
+
+        self.src = StreamingSoundSourceLocation('SRP', self.test_mic_loc,
+                                                forgetting_factor=0.99)
+
+    def stream(self, block_size):
+        return list(self.src.run_stream(self.test_signals[:, i:i + block_size]
+                                        for i in range(0, self.test_signals.shape[1],
+                                                       block_size)))
+
+
+class InitTestCase(StreamingSoundSourceLocationTestCase):
+    """
+    Test that the streaming attributes are set up correctly
+    """
+
+    def test_unsupported_algorithm(self):
+        with self.assertRaises(ValueError):
+            StreamingSoundSourceLocation('TOPS', self.test_mic_loc)
+
+    def test_forgetting_factor(self):
+        with self.assertRaises(ValueError):
+            StreamingSoundSourceLocation('SRP', self.test_mic_loc, forgetting_factor=1.0)
+
+    def test_combinations(self):
+        self.assertEqual(self.src.combinations.tolist(), [[0, 1, 2]])
+
+
+class ProcessBlockTestCase(StreamingSoundSourceLocationTestCase):
+    """
+    Test that blocks are split into hops with a bounded buffer
+    """
+
+    def test_one_update_per_hop(self):
+        test_updates = self.stream(512)
+        self.assertEqual(len(test_updates),
+                         (self.test_signals.shape[1] - self.src.fft_size) // self.src.hop + 1)
+
+    def test_block_size_does_not_matter(self):
+        test_small = self.stream(100)
+        self.src.reset()
+        test_large = self.stream(1000)
+        self.assertTrue(np.allclose(test_small[-1]['azimuth'], test_large[-1]['azimuth']))
+
+    def test_buffer_is_bounded(self):
+        self.stream(1000)
+        self.assertLess(self.src._buffer.shape[1], self.src.fft_size)
+
+    def test_wrong_number_of_microphones(self):
+        with self.assertRaises(ValueError):
+            self.src.process_block(np.zeros((2, 512)))
+
+    def test_matches_batch(self):
+        test_updates = self.stream(512)
+        batch = SoundSourceLocation('SRP')
+        test_spectra = np.array([batch.transform_signal(signal) for signal in self.test_signals])
+        test_azimuth, test_colatitude = batch.locate_directions(test_spectra, self.test_mic_loc)
+        self.assertTrue(np.allclose(test_updates[-1]['azimuth'][0], test_azimuth))
+        self.assertTrue(np.allclose(test_updates[-1]['colatitude'][0], test_colatitude))
+
+
+class ParametersTestCase(StreamingSoundSourceLocationTestCase):
+    """
+    Test that parameters set after construction are used
+    """
+
+    def test_sound_speed_after_construction(self):
+        test_steering = self.src.steering
+        self.src.sound_speed = 343.0
+        test_updates = self.stream(512)
+        self.assertIsNot(self.src.steering, test_steering)
+
+        batch = SoundSourceLocation('SRP')
+        batch.sound_speed = 343.0
+        test_spectra = np.array([batch.transform_signal(signal) for signal in self.test_signals])
+        test_azimuth, test_colatitude = batch.locate_directions(test_spectra, self.test_mic_loc)
+        self.assertTrue(np.allclose(test_updates[-1]['azimuth'][0], test_azimuth))
+        self.assertTrue(np.allclose(test_updates[-1]['colatitude'][0], test_colatitude))
+
+    def test_fft_size_after_construction(self):
+        self.src.fft_size = 512
+        self.src.freq_range = [0, 500]
+        test_updates = self.stream(512)
+        self.assertEqual(self.src.hop, 256)
+        self.assertEqual(self.src.covariance.shape[0], len(self.src.freq_bins))
+        self.assertEqual(len(test_updates), (self.test_signals.shape[1] - 512) // 256 + 1)
+
+    def test_unchanged_setup_is_kept(self):
+        test_steering = self.src.steering
+        self.stream(512)
+        self.assertIs(self.src.steering, test_steering)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,16 @@
+import os
+import pickle
+import tempfile
 import unittest
 import numpy as np
+import pyroomacoustics as pra
 
 from scripts.validations import convert_to_one_list, \
     check_list_of_lists_are_same_length
 
-from scripts.utils import MultiProcessingWithReturnValue
+from scripts.utils import MultiProcessingWithReturnValue, SharedArray, \
+    EstimatorPool, LRUCache, CandidateStore, RIRCache, ResultCache, get_worker_processes, \
+    run_in_workers
 
 
 def target_function(sample_name, *args):
@@ -38,6 +44,274 @@ class MultiProcessingWithReturnValueTestCase(unittest.TestCase):
         self.assertTrue(np.allclose([a[1] for a in test_sam], [b[1] for b in result]))
 
 
+def shared_array_sum(shared_array, *indices):
+    """Test Function. Sums the rows of a shared array."""
+    return np.sum(shared_array.array[list(indices)])
+
+
+class SharedArrayTestCase(unittest.TestCase):
+    """
+    Test that arrays placed in shared memory are read back without copying
+    the data through pickle
+    """
+
+    def setUp(self):
+        self.test_array = np.arange(12, dtype=float).reshape(4, 3)
+        self.shared = SharedArray.from_array(self.test_array)
+
+    def tearDown(self):
+        self.shared.close()
+
+    def test_array_matches(self):
+        self.assertTrue(np.allclose(self.shared.array, self.test_array))
+
+    def test_pickle_matches(self):
+        test_copy = pickle.loads(pickle.dumps(self.shared))
+        self.assertTrue(np.allclose(test_copy.array, self.test_array))
+
+    def test_pickle_does_not_contain_data(self):
+        large_shared = SharedArray.from_array(np.zeros(100000))
+        self.assertLess(len(pickle.dumps(large_shared)), 1000)
+        large_shared.close()
+
+    def test_pooled_indices(self):
+        test_args = ((self.shared, (i,)) for i in range(4))
+        test_sums = MultiProcessingWithReturnValue(shared_array_sum, *test_args).pooled()
+        self.assertEqual(test_sums, [3.0, 12.0, 21.0, 30.0])
+
+
+class EstimatorPoolTestCase(unittest.TestCase):
+    """
+    Test that one worker pool is reused across multiple pooled calls
+    """
+
+    def setUp(self):
+        self.pool = EstimatorPool(processes=2, chunksize=2).start()
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_processes(self):
+        self.assertEqual(self.pool.processes, 2)
+
+    def test_pool_is_reused(self):
+        test_args = [(i, (i, i)) for i in range(6)]
+        first_pool = self.pool._pool
+        first_output = MultiProcessingWithReturnValue(target_function,
+                                                      *test_args).pooled(self.pool)
+        second_output = MultiProcessingWithReturnValue(target_function,
+                                                       *test_args).pooled(self.pool)
+        self.assertIs(self.pool._pool, first_pool)
+        self.assertEqual([a[0] for a in first_output], [b[0] for b in second_output])
+        self.assertEqual([a[1] for a in first_output], [2 * i for i in range(6)])
+
+    def test_close(self):
+        self.pool.close()
+        self.assertIsNone(self.pool._pool)
+
+
+class WorkerProcessesTestCase(unittest.TestCase):
+    """
+    Test that jobs run at once split the CPUs between their pools, and that
+    a pool of one process runs in this process
+    """
+
+    def test_split(self):
+        cpus = os.cpu_count()
+        self.assertEqual(get_worker_processes(), 1)
+        self.assertEqual(get_worker_processes(1), cpus)
+        self.assertEqual(get_worker_processes(2 * cpus), 1)
+
+    def test_single_process_in_process(self):
+        test_pool = EstimatorPool(processes=1)
+        output = MultiProcessingWithReturnValue(target_function, (0, (1, 2))).pooled(test_pool)
+        self.assertEqual(output, [(0, 3)])
+        self.assertIsNone(test_pool._pool)
+
+    def test_run_in_workers(self):
+        test_results = {index: future.result()
+                        for index, future in run_in_workers(abs, [-1, -2, -3, -4], jobs=2)}
+        self.assertEqual(test_results, {0: 1, 1: 2, 2: 3, 3: 4})
+
+    def test_run_in_workers_reads_items_lazily(self):
+        test_read = []
+
+        def items():
+            for item in range(10):
+                test_read.append(item)
+                yield item
+
+        test_runs = run_in_workers(abs, items(), jobs=1)
+        next(test_runs)
+        self.assertLessEqual(len(test_read), 3)
+        test_runs.close()
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    """
+    Test that the least recently used values are evicted and lookups counted
+    """
+
+    def setUp(self):
+        self.cache = LRUCache(maxsize=2)
+
+    def test_hit_and_miss(self):
+        self.cache.get_or_create('a', lambda: 1)
+        self.assertEqual(self.cache.get_or_create('a', lambda: 2), 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_eviction(self):
+        self.cache.get_or_create('a', lambda: 1)
+        self.cache.get_or_create('b', lambda: 2)
+        self.cache.get_or_create('a', lambda: 1)
+        self.cache.get_or_create('c', lambda: 3)
+        self.assertIn('a', self.cache)
+        self.assertNotIn('b', self.cache)
+        self.assertEqual(len(self.cache), 2)
+
+    def test_clear(self):
+        self.cache.get_or_create('a', lambda: 1)
+        self.cache.clear()
+        self.assertEqual(self.cache.info(), {'hits': 0, 'misses': 0,
+                                             'size': 0, 'maxsize': 2})
+
+
+class CandidateStoreTestCase(unittest.TestCase):
+    """
+    Test that candidate points are kept on disk and read back lazily
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = CandidateStore(self.directory.name)
+        self.test_points = np.arange(30, dtype=float).reshape(10, 3)
+        self.store.append(self.test_points[:4])
+        self.store.append(self.test_points[4:])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_length(self):
+        self.assertEqual(len(self.store), 10)
+        self.assertEqual(len(self.store.chunks), 2)
+
+    def test_chunks_are_memory_mapped(self):
+        self.assertTrue(all(isinstance(chunk, np.memmap) for chunk in self.store.iter_chunks()))
+        self.assertTrue(np.array_equal(self.store.to_array(), self.test_points))
+
+    def test_reopen(self):
+        test_store = CandidateStore(self.directory.name)
+        self.assertEqual(len(test_store), 10)
+        self.assertTrue(np.array_equal(test_store.to_array(), self.test_points))
+
+    def test_filter(self):
+        test_kept = self.store.filter(lambda points: points[:, 0] % 2 == 0,
+                                      os.path.join(self.directory.name, 'kept.npy'))
+        self.assertTrue(np.array_equal(test_kept, self.test_points[self.test_points[:, 0] % 2 == 0]))
+
+    def test_clear(self):
+        self.store.clear()
+        self.assertEqual(len(self.store), 0)
+        self.assertEqual(self.store.to_array().shape, (0, 3))
+
+
+class RIRCacheTestCase(unittest.TestCase):
+    """
+    Test that room impulse responses are reused for the same room only.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = RIRCache(self.directory.name)
+        self.test_mics = np.array([[0.2, 0.25, 0.3], [0.25, 0.2, 0.25], [0.03, 0.03, 0.03]])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def make_room(self, seed, source_location=(0.2, 0.3, 0.25)):
+        room = pra.ShoeBox([0.5, 0.5, 0.5], fs=16000, max_order=3)
+        room.add_source(list(source_location),
+                        signal=np.random.default_rng(seed).standard_normal(2000))
+        room.add_microphone_array(pra.MicrophoneArray(self.test_mics, fs=16000))
+        return room
+
+    def test_hit_matches_simulation(self):
+        self.cache.compute_rir(self.make_room(0))
+
+        test_room = self.make_room(1)
+        self.cache.compute_rir(test_room)
+        test_room.simulate()
+
+        room = self.make_room(1)
+        room.simulate()
+
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertTrue(np.allclose(test_room.mic_array.signals, room.mic_array.signals))
+
+    def test_different_source_misses(self):
+        self.cache.compute_rir(self.make_room(0))
+        self.cache.compute_rir(self.make_room(0, source_location=(0.1, 0.3, 0.25)))
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+        self.assertEqual(len(self.cache), 2)
+
+    def test_same_key_for_new_signal(self):
+        self.assertEqual(RIRCache.get_key(self.make_room(0)), RIRCache.get_key(self.make_room(1)))
+
+
+class ResultCacheTestCase(unittest.TestCase):
+    """
+    Test that results are kept on disk and the least recently used are evicted
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.test_result = {'estimates': np.arange(300, dtype=float).reshape(100, 3)}
+        self.cache = ResultCache(self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.put('a', self.test_result)
+        self.assertTrue(np.array_equal(self.cache.get('a')['estimates'],
+                                       self.test_result['estimates']))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_corrupt_result_is_a_miss(self):
+        self.cache.put('a', self.test_result)
+        with open(self.cache.get_filename('a'), 'r+b') as result_file:
+            result_file.truncate(100)
+
+        self.assertIsNone(self.cache.get('a'))
+        self.assertNotIn('a', self.cache)
+        self.assertEqual(self.cache.misses, 1)
+
+        with open(self.cache.get_filename('b'), 'wb') as result_file:
+            result_file.write(b'not a zip file')
+        self.assertIsNone(self.cache.get('b'))
+        self.assertNotIn('b', self.cache)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.put('a', self.test_result)
+        self.cache.max_bytes = 2 * self.cache.size() + 100
+        self.cache.put('b', self.test_result)
+        os.utime(self.cache.get_filename('a'), (0, 0))
+        os.utime(self.cache.get_filename('b'), (1, 1))
+        self.cache.get('a')
+
+        self.cache.put('c', self.test_result)
+        self.assertIn('a', self.cache)
+        self.assertNotIn('b', self.cache)
+        self.assertIn('c', self.cache)
+        self.assertLessEqual(self.cache.size(), self.cache.max_bytes)
+
+    def test_keeps_result_larger_than_cache(self):
+        self.cache.max_bytes = 10
+        self.cache.put('a', self.test_result)
+        self.assertEqual(len(self.cache), 1)
+
+
 class ConvertToOneListTestCase(unittest.TestCase):
     """
     Test that lists inside a list are converted to one list
@@ -0,0 +1,116 @@
+import unittest
+import numpy as np
+
+from scripts.validations import check_signal_array, check_signal_values, \
+    validate_signal_data, validate_mic_locations
+
+
+@validate_signal_data
+def count_signals(data):
+    return len(data)
+
+
+class CheckSignalArrayTestCase(unittest.TestCase):
+    """
+    Test that each signal is checked with array reductions.
+    """
+
+    def test_not_numpy_array(self):
+        with self.assertRaises(TypeError):
+            check_signal_array([1.0, 2.0])
+
+    def test_empty(self):
+        with self.assertRaises(ValueError):
+            check_signal_array(np.array([]))
+
+    def test_contains_none(self):
+        with self.assertRaises(ValueError):
+            check_signal_array(np.array([5, None]))
+
+    def test_contains_empty_string(self):
+        with self.assertRaises(ValueError):
+            check_signal_array(np.array(['5', '']))
+
+
+class CheckSignalValuesTestCase(unittest.TestCase):
+    """
+    Test that each signal is a one dimensional array of finite numbers.
+    """
+
+    def test_valid_signal(self):
+        self.assertEqual(check_signal_values(np.zeros(16000)), 16000)
+
+    def test_not_one_dimensional(self):
+        with self.assertRaises(ValueError):
+            check_signal_values(np.zeros((2, 8)))
+
+    def test_not_numeric(self):
+        with self.assertRaises(TypeError):
+            check_signal_values(np.array(['5', '6']))
+
+    def test_contains_nan(self):
+        with self.assertRaises(ValueError):
+            check_signal_values(np.array([1.0, np.nan]))
+
+    def test_contains_inf(self):
+        with self.assertRaises(ValueError):
+            check_signal_values(np.array([1.0, np.inf]))
+
+
+class ValidateSignalDataTestCase(unittest.TestCase):
+    """
+    Test the signal data decorator with and without trusted input.
+    """
+
+    def test_missing_values_checked_first(self):
+        with self.assertRaises(ValueError):
+            count_signals(np.array([np.array([5]), np.array([""]), np.array([3])]))
+
+    def test_different_lengths(self):
+        with self.assertRaises(ValueError):
+            count_signals([np.zeros(8), np.zeros(9)])
+
+    def test_valid(self):
+        self.assertEqual(count_signals([np.zeros(8), np.ones(8)]), 2)
+
+    def test_trusted_skips_checks(self):
+        self.assertEqual(count_signals([np.array([np.nan]), np.zeros(8)], trusted=True), 2)
+
+
+class ValidateMicLocationsTestCase(unittest.TestCase):
+    """
+    Test that the microphone geometry is validated once as an (n, 3) array.
+    """
+
+    def test_valid(self):
+        test_locations = validate_mic_locations([[0.0, 1.0, 2.0], [3.0, 4.0, 5.0]])
+        self.assertEqual(test_locations.shape, (2, 3))
+        self.assertEqual(test_locations.dtype, np.float64)
+
+    def test_empty(self):
+        with self.assertRaises(ValueError):
+            validate_mic_locations([])
+
+    def test_contains_none(self):
+        with self.assertRaises(ValueError):
+            validate_mic_locations([[0.0, None, 2.0]])
+
+    def test_not_same_length(self):
+        with self.assertRaises(ValueError):
+            validate_mic_locations([[0.0, 1.0, 2.0], [3.0, 4.0]])
+
+    def test_not_three_dimensional(self):
+        with self.assertRaises(ValueError):
+            validate_mic_locations([[0.0, 1.0], [3.0, 4.0]])
+
+    def test_not_float(self):
+        with self.assertRaises(TypeError):
+            validate_mic_locations([[0.0, 1.0, '2']])
+
+    def test_contains_nan(self):
+        with self.assertRaises(ValueError):
+            validate_mic_locations([[0.0, 1.0, np.nan]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,343 @@
+# !/usr/bin/env python
+"""In this script, geometry will contain the ray and room calculations used
+to turn direction of arrival estimates into source location candidates."""
+
+import numpy as np
+
+
+def ray_box_intervals(origins, directions, lower, upper, t_max=np.inf):
+    """Returns the interval of each ray, origin + t * direction, that lies
+       inside an axis-aligned box (slab method). A ray that misses the box
+       has t_enter > t_exit.
+
+       Args:
+           origins: (numpy array) start of each ray, shape (n, 3)
+           directions: (numpy array) direction of each ray, shape (n, 3)
+           lower: (numpy array) lowest corner of the box
+           upper: (numpy array) highest corner of the box
+           t_max: (float) largest distance along each ray. Default: no limit
+
+       Returns:
+           t_enter: (numpy array) where each ray enters the box
+           t_exit: (numpy array) where each ray leaves the box
+    """
+
+    origins = np.atleast_2d(origins)
+    directions = np.atleast_2d(directions)
+
+    # A direction component of zero gives +/- infinity when the origin is
+    # inside that slab (no constraint) and NaN on its boundary (ignored)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inverse = 1.0 / directions
+        t_lower = (np.asarray(lower) - origins) * inverse
+        t_upper = (np.asarray(upper) - origins) * inverse
+
+    t_enter = np.fmax(np.nanmax(np.fmin(t_lower, t_upper), axis=1), 0.0)
+    t_exit = np.fmin(np.nanmin(np.fmax(t_lower, t_upper), axis=1), t_max)
+
+    return t_enter, t_exit
+
+
+def sample_ray_intervals(origins, directions, t_enter, t_exit, spacing):
+    """Returns the points origin + t * direction for every multiple of the
+       spacing that lies inside each ray's interval. These are the same
+       distances as a dense radius of np.arange(0, t_max, spacing).
+
+       Args:
+           origins: (numpy array) start of each ray, shape (n, 3)
+           directions: (numpy array) direction of each ray, shape (n, 3)
+           t_enter: (numpy array) start of each ray's interval
+           t_exit: (numpy array) end of each ray's interval
+           spacing: (float) distance between neighbouring points
+
+       Returns:
+           (numpy array) the sampled points, shape (_, 3)
+    """
+
+    origins = np.atleast_2d(origins)
+    directions = np.atleast_2d(directions)
+
+    # Small slack so that a distance landing exactly on the boundary is kept
+    first = np.ceil(t_enter / spacing - 1e-9).astype(np.int64)
+    last = np.floor(t_exit / spacing + 1e-9).astype(np.int64)
+    counts = np.maximum(last - first + 1, 0)
+
+    ray_index = np.repeat(np.arange(len(counts)), counts)
+    steps = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    distances = (np.repeat(first, counts) + steps) * spacing
+
+    return origins[ray_index] + distances[:, np.newaxis] * directions[ray_index]
+
+
+def ray_box_endpoints(origins, directions, t_enter, t_exit):
+    """Returns the two end points of every ray interval that is not empty.
+
+       Args:
+           origins: (numpy array) start of each ray, shape (n, 3)
+           directions: (numpy array) direction of each ray, shape (n, 3)
+           t_enter: (numpy array) start of each ray's interval
+           t_exit: (numpy array) end of each ray's interval
+
+       Returns:
+           (numpy array) entry and exit point of each ray, shape (_, 3)
+    """
+
+    origins = np.atleast_2d(origins)
+    directions = np.atleast_2d(directions)
+
+    valid = t_enter <= t_exit
+    entries = origins[valid] + t_enter[valid, np.newaxis] * directions[valid]
+    exits = origins[valid] + t_exit[valid, np.newaxis] * directions[valid]
+
+    return np.stack([entries, exits], axis=1).reshape(-1, 3)
+
+
+# One record per ray: where it starts, its unit direction, and the range of
+# distances along it that are valid (inside the room)
+RAY_SEGMENT_DTYPE = np.dtype([('origin', float, (3,)),
+                              ('direction', float, (3,)),
+                              ('t_min', float),
+                              ('t_max', float)])
+
+
+def make_ray_segments(origins, directions, t_min, t_max):
+    """Returns the ray segment records, dropping rays with an empty range,
+       such as rays that miss the room or only touch its boundary.
+
+       Args:
+           origins: (numpy array) start of each ray, shape (n, 3)
+           directions: (numpy array) direction of each ray, shape (n, 3)
+           t_min: (numpy array) start of each ray's valid range
+           t_max: (numpy array) end of each ray's valid range
+
+       Returns:
+           (numpy array) records with the RAY_SEGMENT_DTYPE format
+    """
+
+    valid = t_min < t_max
+    segments = np.empty(np.count_nonzero(valid), dtype=RAY_SEGMENT_DTYPE)
+    segments['origin'] = np.atleast_2d(origins)[valid]
+    segments['direction'] = np.atleast_2d(directions)[valid]
+    segments['t_min'] = t_min[valid]
+    segments['t_max'] = t_max[valid]
+
+    return segments
+
+
+def distance_to_rays(point, origins, directions):
+    """Returns the perpendicular distance from a point to each line.
+
+       Args:
+           point: (numpy array) the point, shape (3,)
+           origins: (numpy array) a point on each line, shape (n, 3)
+           directions: (numpy array) unit direction of each line, shape (n, 3)
+
+       Returns:
+           (numpy array) distance to each line
+    """
+
+    offsets = point - origins
+    along = np.einsum('ij,ij->i', offsets, directions)
+    return np.linalg.norm(offsets - along[:, np.newaxis] * directions, axis=1)
+
+
+def closest_approach(origins, directions, weights=None):
+    """Returns the point with the smallest weighted sum of squared distances
+       to all lines, from a single 3 x 3 linear solve:
+
+           sum_i w_i (I - d_i d_i^T) x = sum_i w_i (I - d_i d_i^T) o_i
+
+       Args:
+           origins: (numpy array) a point on each line, shape (n, 3)
+           directions: (numpy array) unit direction of each line, shape (n, 3)
+           weights: (numpy array) weight of each line. Default: all ones
+
+       Returns:
+           (numpy array) the point of closest approach, shape (3,)
+
+       Raises:
+           ValueError: if there are no lines
+    """
+
+    if len(origins) == 0:
+        raise ValueError("Error. Need at least one ray to locate the source.")
+
+    if weights is None:
+        weights = np.ones(len(origins))
+
+    # Projection onto the plane perpendicular to each direction
+    projections = np.eye(3)[np.newaxis, :, :] - directions[:, :, np.newaxis] * directions[:, np.newaxis, :]
+    projections *= weights[:, np.newaxis, np.newaxis]
+
+    matrix = projections.sum(axis=0)
+    vector = np.einsum('nij,nj->i', projections, origins)
+
+    # Least squares, since parallel lines leave the system singular
+    return np.linalg.lstsq(matrix, vector, rcond=None)[0]
+
+
+def robust_closest_approach(origins, directions, iterations=20, epsilon=1e-6):
+    """Returns the point of closest approach with iteratively reweighted
+       least squares, so lines far from the others (outliers) count less.
+       Each line is weighted by the inverse of its distance to the previous
+       estimate, which minimizes the sum of the distances instead of their
+       squares.
+
+       Args:
+           origins: (numpy array) a point on each line, shape (n, 3)
+           directions: (numpy array) unit direction of each line, shape (n, 3)
+           iterations: (integer) maximum number of reweighting steps
+           epsilon: (float) smallest distance used for a weight, and the
+                    change in the estimate at which to stop
+
+       Returns:
+           (numpy array) the point of closest approach, shape (3,)
+    """
+
+    point = closest_approach(origins, directions)
+
+    for _ in range(iterations):
+        weights = 1.0 / np.maximum(distance_to_rays(point, origins, directions), epsilon)
+        new_point = closest_approach(origins, directions, weights)
+
+        if np.linalg.norm(new_point - point) < epsilon:
+            return new_point
+        point = new_point
+
+    return point
+
+
+def nearest_segment_points(point, segments):
+    """Returns the point of each ray segment nearest to a point, and whether
+       it lies strictly inside the segment rather than at one of its ends.
+
+       Args:
+           point: (numpy array) the point, shape (3,)
+           segments: (numpy array) records with the RAY_SEGMENT_DTYPE format
+
+       Returns:
+           nearest: (numpy array) nearest point of each segment, shape (n, 3)
+           inside: (numpy array) whether each nearest point is inside
+    """
+
+    along = np.einsum('ij,ij->i', point - segments['origin'], segments['direction'])
+    t = np.clip(along, segments['t_min'], segments['t_max'])
+    inside = (along > segments['t_min']) & (along < segments['t_max'])
+
+    return segments['origin'] + t[:, np.newaxis] * segments['direction'], inside
+
+
+def segment_closest_approach(segments, robust=True, iterations=50, epsilon=1e-6):
+    """Returns the point with the smallest sum of distances to all ray
+       segments, or of squared distances when not robust. Unlike
+       closest_approach, only the part of each ray between t_min and t_max
+       counts, so the point cannot fall behind the start of the rays or
+       past where they leave the room.
+
+       Starting from the closest approach of the whole lines, each step
+       finds the nearest point of every segment. A segment whose nearest
+       point is inside it pulls towards its line, one whose nearest point
+       is an end pulls towards that end. When robust, each segment is
+       weighted by the inverse of its distance, as in
+       robust_closest_approach.
+
+       Args:
+           segments: (numpy array) records with the RAY_SEGMENT_DTYPE format
+           robust: (boolean) reweight the segments so outliers count less.
+                   Default is True
+           iterations: (integer) maximum number of steps
+           epsilon: (float) smallest distance used for a weight, and the
+                    change in the estimate at which to stop
+
+       Returns:
+           (numpy array) the point of closest approach, shape (3,)
+
+       Raises:
+           ValueError: if there are no segments
+    """
+
+    origins, directions = segments['origin'], segments['direction']
+    point = closest_approach(origins, directions)
+
+    # Pulls towards the line of a segment, or towards a point for an end
+    line_projections = np.eye(3)[np.newaxis, :, :] - directions[:, :, np.newaxis] * directions[:, np.newaxis, :]
+
+    for _ in range(iterations):
+        nearest, inside = nearest_segment_points(point, segments)
+        projections = np.where(inside[:, np.newaxis, np.newaxis], line_projections, np.eye(3))
+
+        if robust:
+            weights = 1.0 / np.maximum(np.linalg.norm(nearest - point, axis=1), epsilon)
+            projections = projections * weights[:, np.newaxis, np.newaxis]
+
+        new_point = np.linalg.lstsq(projections.sum(axis=0),
+                                    np.einsum('nij,nj->i', projections, nearest), rcond=None)[0]
+
+        if np.linalg.norm(new_point - point) < epsilon:
+            return new_point
+        point = new_point
+
+    return point
+
+
+def spherical_cap_points(center, radius, n_points):
+    """Returns unit directions spread evenly (Fibonacci spiral) over the
+       spherical cap around a direction, with the center direction first.
+
+       Args:
+           center: (numpy array) unit direction at the center of the cap
+           radius: (float) angular radius of the cap in radians
+           n_points: (integer) number of directions around the center
+
+       Returns:
+           (numpy array) unit directions, shape (n_points + 1, 3)
+    """
+
+    center = np.asarray(center, dtype=float)
+    center = center / np.linalg.norm(center)
+
+    # Two unit vectors perpendicular to the center direction
+    helper = np.array([1.0, 0.0, 0.0]) if abs(center[0]) < 0.9 else np.array([0.0, 1.0, 0.0])
+    u = np.cross(helper, center)
+    u /= np.linalg.norm(u)
+    v = np.cross(center, u)
+
+    # The square root spreads the points evenly over the area of the cap
+    index = np.arange(n_points) + 0.5
+    polar = radius * np.sqrt(index / n_points)
+    azimuth = np.pi * (3.0 - np.sqrt(5.0)) * index
+
+    directions = (np.sin(polar)[:, np.newaxis] * (np.cos(azimuth)[:, np.newaxis] * u +
+                                                  np.sin(azimuth)[:, np.newaxis] * v) +
+                  np.cos(polar)[:, np.newaxis] * center)
+
+    return np.vstack([center, directions])
+
+
+def combination_geometry(points, combination_indices):
+    """Returns how well each combination of points is spread out: its
+       aperture, the largest distance between two of its points, and its
+       conditioning, the ratio of the two largest singular values of the
+       centered points. The conditioning is 0 for collinear points and 1
+       when they spread out evenly in a plane.
+
+       Args:
+           points: (numpy array) location of each point, shape (n, 3)
+           combination_indices: (numpy array) indices of each combination,
+                                shape (n_combinations, k)
+
+       Returns:
+           aperture: (numpy array) aperture of each combination
+           conditioning: (numpy array) conditioning of each combination
+    """
+
+    groups = np.asarray(points, dtype=float)[np.asarray(combination_indices)]
+
+    differences = groups[:, :, np.newaxis, :] - groups[:, np.newaxis, :, :]
+    aperture = np.linalg.norm(differences, axis=3).max(axis=(1, 2))
+
+    singular_values = np.linalg.svd(groups - groups.mean(axis=1, keepdims=True),
+                                    compute_uv=False)
+    conditioning = singular_values[:, 1] / np.maximum(singular_values[:, 0], 1e-12)
+
+    return aperture, conditioning
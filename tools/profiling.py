@@ -0,0 +1,169 @@
+# !/usr/bin/env python
+"""In this script, profiling will contain the opt-in timing instrumentation
+used to see where the time goes in each stage of the pipeline."""
+
+import contextlib
+import cProfile
+import csv
+import json
+import os
+import time
+
+
+class Profiler:
+    """Profiler records how long each stage of the pipeline takes. Stages
+       are timed with spans, which do nothing unless a profiler is active.
+       Activate one with a with statement:
+
+           with Profiler('run.prof') as profiler:
+               ...
+           profiler.to_json('run.json')
+
+       Attributes:
+           enabled: (boolean) whether spans are recorded
+           cprofile_path: (string) file to dump cProfile statistics to while
+                          active. Default: None, no cProfile
+           records: (list) dictionary for each span with its stage, seconds,
+                    worker process and any labels such as the combination
+    """
+
+    def __init__(self, cprofile_path=None, enabled=True):
+        """Initializes Profiler with cprofile_path and enabled."""
+        self.enabled = enabled
+        self.cprofile_path = cprofile_path
+        self.records = []
+
+        self._pid = os.getpid()
+        self._cprofile = None
+
+    @contextlib.contextmanager
+    def span(self, stage, **labels):
+        """Times the body of the with statement as one span of the stage.
+
+           Args:
+               stage: (string) name of the stage
+               **labels: extra information, such as the combination
+        """
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start, **labels)
+
+    def add(self, stage, seconds, **labels):
+        """Records a span that was measured some other way."""
+        if self.enabled:
+            self.records.append(dict(labels, stage=stage, seconds=seconds,
+                                     worker=labels.get('worker', os.getpid())))
+
+    def extend(self, records):
+        """Adds spans recorded by another profiler, e.g. in a worker."""
+        if self.enabled:
+            self.records.extend(records)
+
+    def summary(self):
+        """Returns the number of spans, total, mean and maximum seconds of
+           each stage, along with the totals per worker and per combination.
+           Spans labeled with whether a cache had their value, such as
+           doa_setup, also count the hits and misses of their stage.
+        """
+
+        def aggregate(records):
+            stages = {}
+            for record in records:
+                stage = stages.setdefault(record['stage'], {'count': 0, 'total': 0.0,
+                                                            'max': 0.0})
+                stage['count'] += 1
+                stage['total'] += record['seconds']
+                stage['max'] = max(stage['max'], record['seconds'])
+            for stage in stages.values():
+                stage['mean'] = stage['total'] / stage['count']
+            return stages
+
+        def group_by(label):
+            groups = {}
+            for record in self.records:
+                if record.get(label) is not None:
+                    groups.setdefault(str(record[label]), []).append(record)
+            return {key: {stage: values['total'] for stage, values in aggregate(records).items()}
+                    for key, records in groups.items()}
+
+        caches = {}
+        for record in self.records:
+            if record.get('cached') is not None:
+                cache = caches.setdefault(record['stage'], {'hits': 0, 'misses': 0})
+                cache['hits' if record['cached'] else 'misses'] += 1
+
+        return {'stages': aggregate(self.records),
+                'workers': group_by('worker'),
+                'combinations': group_by('combination'),
+                'caches': caches}
+
+    def to_json(self, filename):
+        """Writes the summary and every span to a json file."""
+        with open(filename, mode='w') as profile_file:
+            json.dump({'summary': self.summary(), 'records': self.records},
+                      profile_file, indent=2, default=str)
+
+    def to_csv(self, filename):
+        """Writes every span to a csv file, one row per span."""
+        with open(filename, mode='w', newline='') as profile_file:
+            writer = csv.writer(profile_file, delimiter=',')
+            writer.writerow(['Stage', 'Seconds', 'Worker', 'Combination'])
+            writer.writerows([record['stage'], record['seconds'], record['worker'],
+                              record.get('combination')] for record in self.records)
+
+    def __enter__(self):
+        _ACTIVE_PROFILERS.append(self)
+        if self.cprofile_path is not None:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(self.cprofile_path)
+            self._cprofile = None
+        _ACTIVE_PROFILERS.remove(self)
+
+
+# Used whenever no profiler is active, so spans cost almost nothing
+NULL_PROFILER = Profiler(enabled=False)
+
+_ACTIVE_PROFILERS = []
+
+
+def get_profiler():
+    """Returns the active profiler of this process, or the null profiler.
+       Note: a worker forked while a profiler was active does not record
+       into its copy of that profiler."""
+    if _ACTIVE_PROFILERS and _ACTIVE_PROFILERS[-1]._pid == os.getpid():
+        return _ACTIVE_PROFILERS[-1]
+    return NULL_PROFILER
+
+
+class ProfiledCall:
+    """ProfiledCall runs a function in a worker process under a fresh
+       profiler and returns the function's output along with the spans that
+       were recorded, so they can be merged into the parent's profiler.
+
+       Attributes:
+           func: the function to run
+           stage: (string) name of the span around the whole call
+    """
+
+    def __init__(self, func, stage):
+        """Initializes ProfiledCall with func and stage."""
+        self.func = func
+        self.stage = stage
+
+    def __call__(self, *args):
+        with Profiler() as profiler:
+            with profiler.span(self.stage, combination=args[1:]):
+                output = self.func(*args)
+        return output, profiler.records
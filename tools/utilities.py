@@ -2,11 +2,31 @@
 """This script contains utility functions that are helpful
 for the sound source localization script."""
 
+import hashlib
+import importlib
+import json
 import multiprocessing
+import os
+import tempfile
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import resource_tracker, shared_memory
+
 import numpy as np
 import pyroomacoustics as pra
 
 
+# Shared memory blocks this process has already attached to, by name.
+# Long-lived workers only keep the most recent ones mapped.
+_ATTACHED_SHARED_MEMORY = OrderedDict()
+_MAX_ATTACHED_SHARED_MEMORY = 8
+
+# EstimatorPool of this process when it is itself a worker, e.g. of a batch
+# or of the heart cycles, see start_worker_pool
+_WORKER_POOL = None
+
+
 class MultiProcessingWithReturnValue:
     """MultiProcessingWithReturnValue receives a function and its corresponding
        arguments, as in input, and runs the function on multiple cores.
@@ -21,18 +41,610 @@ class MultiProcessingWithReturnValue:
         self.func = func
         self.args = args
 
+    def __getstate__(self):
+        """The arguments are handed to the workers one at a time by the pool,
+           so they are not pickled again along with every chunk of work."""
+        state = self.__dict__.copy()
+        state['args'] = ()
+        return state
+
     def run(self, *args):
         """Run the function, with its correct function arguments."""
         return self.func(args[0][0], *args[0][1])
 
-    def pooled(self):
-        """Multi-process the function"""
+    def pooled(self, pool=None):
+        """Multi-process the function. A persistent EstimatorPool is reused
+           when given, otherwise a pool is created for this call only.
+
+           Args:
+               pool: (EstimatorPool) long-lived worker pool. Default: None
+        """
+
+        if pool is not None:
+            return pool.map(self.run, self.args)
 
         with multiprocessing.Pool() as pool:
             *sample_output, = pool.map(self.run, self.args)
         return sample_output
 
 
+class LRUCache:
+    """LRUCache keeps the most recently used values up to a maximum size and
+       counts how many lookups were found in it.
+
+       Attributes:
+           maxsize: (integer) maximum number of values to keep
+           hits: (integer) number of lookups found in the cache
+           misses: (integer) number of lookups not found in the cache
+    """
+
+    def __init__(self, maxsize=128):
+        """Initializes LRUCache with maxsize."""
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+        self._values = OrderedDict()
+
+    def get_or_create(self, key, factory):
+        """Returns the cached value for the key, creating it with the
+           factory and evicting the least recently used value on a miss.
+
+           Args:
+               key: hashable key of the value
+               factory: function without arguments that creates the value
+
+           Returns:
+               the cached value
+        """
+        if key in self._values:
+            self.hits += 1
+            self._values.move_to_end(key)
+            return self._values[key]
+
+        self.misses += 1
+        value = self._values[key] = factory()
+        while len(self._values) > self.maxsize:
+            self._values.popitem(last=False)
+        return value
+
+    def info(self):
+        """Returns the hits, misses, current size and maximum size."""
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._values), 'maxsize': self.maxsize}
+
+    def clear(self):
+        """Empties the cache and resets the counters."""
+        self._values.clear()
+        self.hits, self.misses = 0, 0
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, key):
+        return key in self._values
+
+
+def warm_up_worker(modules):
+    """Imports the modules once when a worker process starts, so the first
+       task does not pay for it."""
+    for module in modules:
+        importlib.import_module(module)
+
+
+class EstimatorPool:
+    """EstimatorPool keeps one multiprocessing pool alive so it can be reused
+       across many recordings instead of being started and torn down for
+       every call. With a single process, the function runs in this process
+       and no workers are started.
+
+       Attributes:
+           processes: (integer) number of worker processes. Default is the
+                      number of CPUs
+           chunksize: (integer) number of tasks sent to a worker at once.
+                      Default: None, let the pool decide
+           warm_up_modules: (tuple) modules each worker imports when it
+                            starts. Default: the pyroomacoustics DOA modules
+    """
+
+    def __init__(self, processes=None, chunksize=None,
+                 warm_up_modules=('pyroomacoustics', 'pyroomacoustics.doa')):
+        """Initializes EstimatorPool with processes, chunksize and
+           warm_up_modules."""
+        self.processes = processes or multiprocessing.cpu_count()
+        self.chunksize = chunksize
+        self.warm_up_modules = tuple(warm_up_modules or ())
+
+        self._pool = None
+
+    def start(self):
+        """Starts the worker processes if they are not running yet."""
+        if self._pool is None:
+            # The workers must share this process's resource tracker, or each
+            # would start its own and unlink shared memory when it exits
+            if os.name == 'posix':
+                resource_tracker.ensure_running()
+
+            self._pool = multiprocessing.Pool(self.processes,
+                                              initializer=warm_up_worker,
+                                              initargs=(self.warm_up_modules,))
+        return self
+
+    def map(self, func, iterable):
+        """Runs the function over the iterable on the worker processes.
+
+           Args:
+               func: the function to run
+               iterable: the function's arguments
+
+           Returns:
+               (list) the output of each function call, in order
+        """
+        if self.processes == 1:
+            return list(map(func, iterable))
+        return self.start()._pool.map(func, iterable, self.chunksize)
+
+    def close(self):
+        """Waits for the workers to finish and stops them."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def get_worker_processes(jobs=None):
+    """Returns the number of processes of each job's EstimatorPool when jobs
+       run at once, so together they use about one process per CPU.
+
+       Args:
+           jobs: (integer) number of jobs run at once. Default is the number
+                 of CPUs
+    """
+    cpus = multiprocessing.cpu_count()
+    return max(1, cpus // (jobs or cpus))
+
+
+def start_worker_pool(processes):
+    """Gives this worker process its own EstimatorPool. Used as the
+       initializer of a ProcessPoolExecutor whose jobs run the estimators,
+       which otherwise each start a pool of one process per CPU.
+
+       Args:
+           processes: (integer) number of processes of the pool, see
+                      get_worker_processes
+    """
+    global _WORKER_POOL
+    _WORKER_POOL = EstimatorPool(processes)
+
+
+def get_worker_pool():
+    """Returns the EstimatorPool of this worker process, or None outside of
+       a worker, see start_worker_pool."""
+    return _WORKER_POOL
+
+
+def run_in_workers(func, items, jobs=None):
+    """Runs the function on each item in worker processes, each with its own
+       EstimatorPool, see start_worker_pool. Items are read from the
+       iterable only a few at a time beyond the number of workers, so they
+       are never all held in memory at once.
+
+       Args:
+           func: picklable function of one item
+           items: (iterable) argument of each call
+           jobs: (integer) largest number of calls run at once. Default is
+                 the number of CPUs
+
+       Yields:
+           index: (integer) position of the item in the iterable
+           future: (Future) the finished call, in the order they finish
+    """
+
+    jobs = jobs or os.cpu_count()
+    items = enumerate(items)
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=start_worker_pool,
+                             initargs=(get_worker_processes(jobs),)) as executor:
+        running = {}
+
+        def submit_next():
+            index, item = next(items, (None, None))
+            if index is not None:
+                running[executor.submit(func, item)] = index
+
+        for _ in range(2 * jobs):
+            submit_next()
+
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = running.pop(future)
+                submit_next()
+                yield index, future
+
+
+def attach_shared_memory(name):
+    """Returns the shared memory block with the given name, attaching to it
+       only once per process and closing the least recently used blocks."""
+
+    if name in _ATTACHED_SHARED_MEMORY:
+        _ATTACHED_SHARED_MEMORY.move_to_end(name)
+        return _ATTACHED_SHARED_MEMORY[name]
+
+    _ATTACHED_SHARED_MEMORY[name] = shared_memory.SharedMemory(name=name)
+
+    while len(_ATTACHED_SHARED_MEMORY) > _MAX_ATTACHED_SHARED_MEMORY:
+        _, oldest = _ATTACHED_SHARED_MEMORY.popitem(last=False)
+        try:
+            oldest.close()
+        except BufferError:
+            pass
+
+    return _ATTACHED_SHARED_MEMORY[name]
+
+
+class SharedArray:
+    """SharedArray places a numpy array into shared memory once so that
+       worker processes can read it as a zero-copy numpy view. Pickling a
+       SharedArray only sends the name, shape and data type of the block,
+       never the data itself.
+
+       Attributes:
+           name: (string) name of the shared memory block
+           shape: (tuple) shape of the array
+           dtype: (string) data type of the array
+    """
+
+    def __init__(self, name, shape, dtype):
+        """Initializes SharedArray with name, shape and dtype."""
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype).str
+
+        self._shm = None
+        self._owner = False
+
+    @classmethod
+    def from_array(cls, array):
+        """Copies the array into a new shared memory block.
+
+           Args:
+               array: (numpy array) the array to share
+
+           Returns:
+               (SharedArray) the owner of the shared memory block
+        """
+        array = np.ascontiguousarray(array)
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+
+        shared = cls(shm.name, array.shape, array.dtype)
+        shared._shm, shared._owner = shm, True
+        shared.array[...] = array
+        return shared
+
+    @property
+    def array(self):
+        """Returns the numpy view of the shared memory block, attaching to
+           the block the first time it is used in this process."""
+        if self._shm is None:
+            self._shm = attach_shared_memory(self.name)
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)
+
+    def __getstate__(self):
+        return {'name': self.name, 'shape': self.shape, 'dtype': self.dtype}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._shm = None
+        self._owner = False
+
+    def close(self):
+        """Releases the shared memory block. The owner also removes it."""
+        if self._owner and self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+        self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CandidateStore:
+    """CandidateStore keeps candidate source locations on disk instead of
+       in memory, as a directory of .npy chunks with one [x,y,z] row per
+       point. Chunks are memory-mapped when read, so only the chunk being
+       worked on has to fit in memory while the store is written and
+       filtered. DetermineSourceLocation still builds its KD-tree on the
+       filtered points, which must fit in memory. Opening an existing directory picks
+       up the chunks already written there, to read them;
+       SoundSourceLocation.store_potential_estimates refuses to write to a
+       store that is not empty unless asked to append.
+
+       Attributes:
+           directory: (string) directory holding the chunks
+           dtype: (string) data type of the points. Default: float64
+           chunks: (list) file name of each chunk, in the order written
+    """
+
+    def __init__(self, directory, dtype=np.float64):
+        """Initializes CandidateStore with directory and dtype."""
+        self.directory = directory
+        self.dtype = np.dtype(dtype).str
+
+        os.makedirs(directory, exist_ok=True)
+        self.chunks = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                             if name.startswith('chunk_') and name.endswith('.npy'))
+        self._length = sum(len(chunk) for chunk in self.iter_chunks())
+
+    def append(self, points):
+        """Writes the points to a new chunk.
+
+           Args:
+               points: (numpy array) candidate locations, shape (n, 3)
+        """
+        points = np.asarray(points, dtype=self.dtype).reshape(-1, 3)
+        if len(points) == 0:
+            return
+
+        filename = os.path.join(self.directory, 'chunk_{:06d}.npy'.format(len(self.chunks)))
+        np.save(filename, points)
+        self.chunks.append(filename)
+        self._length += len(points)
+
+    def iter_chunks(self):
+        """Yields each chunk as a read-only memory-mapped array."""
+        for filename in self.chunks:
+            yield np.load(filename, mmap_mode='r')
+
+    def filter(self, mask_func, filename):
+        """Returns the points for which the mask is true, written to one
+           memory-mapped .npy file. The chunks are read twice: once to count
+           the points kept, and once to copy them.
+
+           Args:
+               mask_func: function returning a boolean mask for a chunk
+               filename: (string) .npy file to write the kept points to
+
+           Returns:
+               (numpy memmap) the kept points, shape (n_kept, 3)
+        """
+
+        counts = [np.count_nonzero(mask_func(chunk)) for chunk in self.iter_chunks()]
+
+        kept = np.lib.format.open_memmap(filename, mode='w+', dtype=self.dtype,
+                                         shape=(sum(counts), 3))
+        start = 0
+        for chunk, count in zip(self.iter_chunks(), counts):
+            kept[start:start + count] = chunk[mask_func(chunk)]
+            start += count
+        kept.flush()
+
+        return kept
+
+    def to_array(self):
+        """Returns every point in memory, shape (n, 3)."""
+        if not self.chunks:
+            return np.empty((0, 3), dtype=self.dtype)
+        return np.concatenate(list(self.iter_chunks()))
+
+    def clear(self):
+        """Removes every chunk from the directory."""
+        for filename in self.chunks:
+            os.remove(filename)
+        self.chunks = []
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+
+def save_npz(filename, arrays, compress=False):
+    """Saves the arrays to a .npz file under a temporary name and then
+       renames it, so a reader never sees half a file.
+
+       Args:
+           filename: (string) path of the .npz file
+           arrays: (dictionary) arrays to save, by name
+           compress: (boolean) compresses the arrays. Default: False
+    """
+
+    handle, temporary = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+                                         suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as temporary_file:
+            (np.savez_compressed if compress else np.savez)(temporary_file, **arrays)
+        os.replace(temporary, filename)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+
+class RIRCache:
+    """RIRCache keeps the room impulse responses of simulated rooms on disk,
+       one .npz file per room named by a hash of everything they depend on:
+       the walls and their absorption, the source and microphone positions,
+       the sampling rate, the image source and ray tracing settings and the
+       pyroomacoustics version. A room with the same geometry only needs
+       its signals convolved with the cached responses, which
+       pyroomacoustics does with FFT convolution.
+
+       Attributes:
+           directory: (string) directory holding the responses
+           hits: (integer) number of rooms found in the cache
+           misses: (integer) number of rooms computed and added to it
+    """
+
+    def __init__(self, directory):
+        """Initializes RIRCache with directory."""
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def get_key(room):
+        """Returns the hash of everything the impulse responses of the
+           room depend on."""
+
+        state = {name: flag for name, flag in room.simulator_state.items()
+                 if not name.endswith('_done')}
+        description = {'version': pra.__version__,
+                       'walls': [[wall.corners.tolist(), np.ravel(wall.absorption).tolist(),
+                                  np.ravel(wall.scatter).tolist()] for wall in room.walls],
+                       'sources': [np.ravel(source.position).tolist() for source in room.sources],
+                       'microphones': np.asarray(room.mic_array.R).tolist(),
+                       'fs': room.fs, 't0': room.t0, 'c': room.c,
+                       'max_order': room.max_order,
+                       'max_rand_disp': room.max_rand_disp,
+                       'air_absorption': room.air_absorption,
+                       'min_phase': room.min_phase,
+                       'simulator_state': state,
+                       'rt_args': room.rt_args}
+
+        return hashlib.sha256(json.dumps(description, sort_keys=True,
+                                         default=repr).encode()).hexdigest()
+
+    def get_filename(self, key):
+        return os.path.join(self.directory, ".".join([key, 'npz']))
+
+    def compute_rir(self, room):
+        """Sets the impulse responses of the room, loaded from the cache
+           when the same room was computed before, otherwise computed and
+           added to it. The file is written under a temporary name and then
+           renamed, so parallel runs never read half a file.
+
+           Args:
+               room: (pyroomacoustics Room) room with its sources and
+                     microphones added
+        """
+
+        filename = self.get_filename(self.get_key(room))
+
+        if os.path.exists(filename):
+            self.hits += 1
+            with np.load(filename) as responses:
+                room.rir = [[responses['{}_{}'.format(m, s)] for s in range(len(room.sources))]
+                            for m in range(room.mic_array.M)]
+            return
+
+        self.misses += 1
+        room.compute_rir()
+
+        save_npz(filename, {'{}_{}'.format(m, s): response
+                            for m, responses in enumerate(room.rir)
+                            for s, response in enumerate(responses)})
+
+    def __len__(self):
+        return len([name for name in os.listdir(self.directory) if name.endswith('.npz')])
+
+
+class ResultCache:
+    """ResultCache keeps the estimates of recordings on disk, one .npz file
+       per result named by its key, so later stages can be rerun without
+       running the DOA again. When the files add up to more than the
+       maximum size, the least recently used ones are removed.
+
+       Attributes:
+           directory: (string) directory holding the results
+           max_bytes: (integer) largest total size of the results.
+                      Default: 1 GiB
+           hits: (integer) number of results found in the cache
+           misses: (integer) number of results not found in it
+    """
+
+    def __init__(self, directory, max_bytes=2**30):
+        """Initializes ResultCache with directory and max_bytes."""
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+    def get_filename(self, key):
+        return os.path.join(self.directory, ".".join([key, 'npz']))
+
+    def get(self, key):
+        """Returns the arrays saved under the key, by name, or None when
+           there are none. A file that cannot be read, e.g. cut short by a
+           killed run, is removed and counts as a miss."""
+
+        filename = self.get_filename(key)
+        try:
+            with np.load(filename) as result:
+                arrays = {name: result[name] for name in result.files}
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (zipfile.BadZipFile, ValueError, OSError, KeyError, EOFError):
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            self.misses += 1
+            return None
+
+        # The modification time orders the results by their last use
+        os.utime(filename)
+        self.hits += 1
+        return arrays
+
+    def put(self, key, arrays):
+        """Saves the arrays under the key, then evicts the least recently
+           used results until the cache fits in its maximum size.
+
+           Args:
+               key: (string) key of the result
+               arrays: (dictionary) arrays to save, by name
+        """
+        filename = self.get_filename(key)
+        save_npz(filename, arrays)
+        self.evict(keep=filename)
+
+    def evict(self, keep=None):
+        """Removes the least recently used results, except the one to keep,
+           until the total size is at most the maximum size."""
+
+        results = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npz'):
+                stat = entry.stat()
+                results.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in results)
+        for _, size, path in sorted(results):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def size(self):
+        """Returns the total size of the results in bytes."""
+        return sum(entry.stat().st_size for entry in os.scandir(self.directory)
+                   if entry.name.endswith('.npz'))
+
+    def __len__(self):
+        return len([name for name in os.listdir(self.directory) if name.endswith('.npz')])
+
+    def __contains__(self, key):
+        return os.path.exists(self.get_filename(key))
+
+
 class CustomMicrophoneSetUp:
 
     def __init__(self, custom, center, number_of_microphones_to_use,
@@ -6,6 +6,8 @@ import functools
 import warnings
 import numpy as np
 
+from scripts.profiling import get_profiler
+
 # TODO:
 #  1) Clean up repeatedly used functions. Why can't class decorators inherit from other decorators?
 
@@ -90,6 +92,46 @@ def validate_splits(sample_splits):
         return sample_splits
 
 
+def validate_ray_sampling(sample_ray_sampling):
+    if sample_ray_sampling not in ('radius', 'clipped', 'endpoints'):
+        raise ValueError("Error. Ray sampling must be 'radius', 'clipped' "
+                         "or 'endpoints'.")
+    return sample_ray_sampling
+
+
+def validate_grid_search(sample_grid_search):
+    if sample_grid_search not in ('flat', 'hierarchical'):
+        raise ValueError("Error. Grid search must be 'flat' or 'hierarchical'.")
+    return sample_grid_search
+
+
+def validate_combination_pruning(sample_budget, sample_threshold):
+    if sample_budget is not None and (int(sample_budget) != sample_budget or sample_budget < 1):
+        raise ValueError("Error. Combination budget must be a positive integer.")
+    if sample_threshold is not None and not 0 <= sample_threshold <= 1:
+        raise ValueError("Error. Combination threshold must be between 0 and 1.")
+    return sample_budget, sample_threshold
+
+
+def validate_output_format(sample_format, sample_dtype):
+    if sample_format not in ('npz', 'csv'):
+        raise ValueError("Error. Output format must be 'npz' or 'csv'.")
+    sample_dtype = np.dtype(sample_dtype)
+    if sample_dtype.kind != 'f':
+        raise TypeError("Error. Output type must be a float type.")
+    return sample_format, sample_dtype
+
+
+def validate_time_window(sample_time_window):
+    if sample_time_window is None:
+        return None
+    start, stop = sample_time_window
+    if not 0 <= start < stop:
+        raise ValueError("Error. Time window must start at or after zero "
+                         "and end after it starts.")
+    return start, stop
+
+
 def validate_file_path(func):
     """Validates file_name type and if a .mat file."""
 
@@ -124,26 +166,120 @@ def validate_room_source_dim_and_mic_loc(func):
     return validated
 
 
+def check_signal_array(sample_array):
+    """Checks one microphone signal for missing values with NumPy
+       reductions instead of converting it to a list, so the cost does not
+       grow with the number of Python objects in the signal.
+
+       Args:
+           sample_array: (numpy array) the signal of one microphone
+
+       Raises:
+           TypeError: if the signal is not a numpy array
+           ValueError: if the signal contains None, an empty string, or is
+                       empty
+    """
+
+    if not validate_instance_type(sample_array, np.ndarray):
+        raise TypeError("Error. Signal data is not a numpy array.")
+
+    kind = sample_array.dtype.kind
+    if kind == 'O' and np.equal(sample_array, None).any():
+        raise ValueError("Error. The signal contains None.")
+    if kind in 'OU' and np.equal(sample_array, '').any():
+        raise ValueError("Error. The signal contains an empty string.")
+    if sample_array.size == 0:
+        raise ValueError("Error. The signal is empty.")
+
+
+def check_signal_values(sample_array):
+    """Checks that one microphone signal is a one dimensional array of
+       finite numbers.
+
+       Args:
+           sample_array: (numpy array) the signal of one microphone
+
+       Returns:
+           the number of samples in the signal
+
+       Raises:
+           TypeError: if the signal is not numeric
+           ValueError: if the signal is not one dimensional, or contains NaN
+                       or Inf
+    """
+
+    kind = sample_array.dtype.kind
+    if kind not in 'biufc':
+        raise TypeError("Error. Signal data is not numeric.")
+    if sample_array.ndim != 1:
+        raise ValueError("Error. The signal is not one dimensional.")
+    if kind in 'fc' and not np.isfinite(sample_array).all():
+        raise ValueError("Error. The signal contains NaN or Inf.")
+
+    return sample_array.shape[0]
+
+
 def validate_signal_data(func):
     """Validates the signal data for a numpy array, an empty numpy array,
-       None in the array, an empty string, or if the list is empty."""
+       None in the array, an empty string, a non-numeric type, NaN or Inf,
+       and that every signal has the same number of samples. Passing
+       trusted=True skips the checks, e.g. for data this package wrote."""
 
     @functools.wraps(func)
-    def validated(*args):
-        for sample_array in args[-1]:
-            if not validate_instance_type(sample_array, np.ndarray):
-                raise TypeError("Error. Signal data is not a numpy array.")
-            if None in sample_array.tolist():
-                raise ValueError("Error. The signal contains None.")
-            if "" in sample_array.tolist():
-                raise ValueError("Error. The signal contains an empty string.")
-            if not sample_array.tolist():
-                raise ValueError("Error. The signal is empty.")
+    def validated(*args, trusted=False):
+        if not trusted:
+            with get_profiler().span('validation'):
+                for sample_array in args[-1]:
+                    check_signal_array(sample_array)
+                lengths = {check_signal_values(sample_array) for sample_array in args[-1]}
+                if len(lengths) > 1:
+                    raise ValueError("Error. The signals do not have the same "
+                                     "number of samples.")
         result = func(*args)
         return result
     return validated
 
 
+def validate_mic_locations(sample_locations):
+    """Validates the microphone geometry once, when the array is loaded, so
+       that nothing needs to be checked again for each combination.
+
+       Args:
+           sample_locations: (list) location of each microphone in [x,y,z]
+                             order
+
+       Returns:
+           (numpy array) the microphone locations as floats, shape (n, 3)
+
+       Raises:
+           TypeError: if a microphone location is not a number
+           ValueError: if the list is empty, contains None, NaN or Inf, or
+                       is not one [x,y,z] row per microphone
+    """
+
+    if len(sample_locations) == 0:
+        raise ValueError('Error. Microphone location list is empty.')
+
+    try:
+        locations = np.asarray(sample_locations)
+    except ValueError:
+        raise ValueError('Error. Not all microphone locations have '
+                         'same length!') from None
+
+    if locations.dtype.kind == 'O' and np.equal(locations, None).any():
+        raise ValueError('Error. Microphone location list contains None.')
+    if locations.dtype.kind not in 'biuf':
+        raise TypeError('Error. Microphone location list '
+                        'does not contain a float type.')
+    if locations.ndim != 2 or locations.shape[1] != 3:
+        raise ValueError('Error. Microphone locations must have one [x,y,z] '
+                         'row per microphone.')
+    if not np.isfinite(locations).all():
+        raise ValueError('Error. Microphone location list contains NaN or Inf.')
+
+    return locations.astype(float)
+
+
 class ValidateCentroid:
     """Class decorator which checks if the microphone location list is empty,
        if it contains None, if not all the microphones in list are the